@@ -0,0 +1,55 @@
+"""Download thousands of small files: per-file requests, pipelined requests, and one BATCH request.
+
+    python benchmarks/bench_batch.py --files 10000 --size-kb 4
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from networking import FileServer, download_batch, download_files, download_item
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=10000)
+    parser.add_argument("--size-kb", type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as share, tempfile.TemporaryDirectory() as downloads:
+        os.makedirs(os.path.join(share, "photos"))
+        names = [f"photos/img{i:05d}.raw" for i in range(args.files)]
+        for name in names:
+            with open(os.path.join(share, name), "wb") as f:
+                f.write(os.urandom(args.size_kb * 1024))
+        server = FileServer(share, {}, "127.0.0.1", 0)
+        server.start()
+
+        def per_file():
+            for name in names:
+                download_item("127.0.0.1", server.port, name, "File", downloads, resume=False)
+
+        def pipelined():
+            download_files("127.0.0.1", server.port, names, downloads, resume=False)
+
+        def batch():
+            download_batch("127.0.0.1", server.port, names, downloads)
+
+        size = args.files * args.size_kb * 1024
+        print(f"{'mode':>10} {'seconds':>9} {'files/s':>9} {'MB/s':>8}")
+        for label, run in [("per-file", per_file), ("pipelined", pipelined), ("batch", batch)]:
+            shutil.rmtree(os.path.join(downloads, "photos"), ignore_errors=True)
+            os.makedirs(os.path.join(downloads, "photos"))
+            start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - start
+            print(f"{label:>10} {elapsed:>9.3f} {args.files / elapsed:>9.0f} {size / elapsed / 1e6:>8.1f}")
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
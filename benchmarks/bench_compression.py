@@ -0,0 +1,74 @@
+"""Folder download wall time and bytes on the wire with and without negotiated compression.
+
+Traffic goes through a counting proxy that can also cap the link rate, so the
+trade-off between CPU and bandwidth is visible on loopback:
+
+    python benchmarks/bench_compression.py --mbit 100
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from compression import available_codecs
+from networking import FileServer, download_item
+from proxy import CountingProxy
+
+WORDS = "the quick brown fox jumps over lazy dog file share network packet folder peer".split()
+
+
+def make_corpus(root, kind, size_mb):
+    os.makedirs(root)
+    rng = random.Random(42)
+    per_file = 1024 * 1024
+    for i in range(size_mb):
+        choice = kind if kind != "mixed" else ("text", "logs", "media")[i % 3]
+        if choice == "text":
+            with open(os.path.join(root, f"doc{i}.txt"), "w") as f:
+                while f.tell() < per_file:
+                    f.write(" ".join(rng.choice(WORDS) for _ in range(16)) + "\n")
+        elif choice == "logs":
+            with open(os.path.join(root, f"app{i}.log"), "w") as f:
+                while f.tell() < per_file:
+                    f.write(f"2024-05-{rng.randint(1, 28):02d} INFO worker-{rng.randint(1, 8)} "
+                            f"served request id={rng.randint(0, 10**6)} in {rng.random():.3f}s\n")
+        else:
+            with open(os.path.join(root, f"clip{i}.mp4"), "wb") as f:
+                f.write(os.urandom(per_file))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=48)
+    parser.add_argument("--mbit", type=float, default=None, help="cap the simulated link rate per connection")
+    args = parser.parse_args()
+
+    modes = [("raw", False)] + [(name, [name]) for name in available_codecs()]
+    with tempfile.TemporaryDirectory() as share:
+        corpora = ["text", "logs", "media", "mixed"]
+        for kind in corpora:
+            make_corpus(os.path.join(share, kind), kind, args.size_mb)
+        server = FileServer(share, {}, "127.0.0.1", 0)
+        server.start()
+        proxy = CountingProxy(server.port, args.mbit)
+
+        print(f"{'corpus':>8} {'codec':>6} {'seconds':>9} {'wire MB':>9} {'ratio':>7}")
+        for kind in corpora:
+            for name, compress in modes:
+                with tempfile.TemporaryDirectory() as downloads:
+                    before = proxy.downstream_bytes
+                    start = time.perf_counter()
+                    download_item("127.0.0.1", proxy.port, kind, "Folder", downloads, compress=compress)
+                    elapsed = time.perf_counter() - start
+                    wire = proxy.downstream_bytes - before
+                    print(f"{kind:>8} {name:>6} {elapsed:>9.3f} {wire / 1e6:>9.2f} "
+                          f"{wire / (args.size_mb * 1024 * 1024):>7.3f}")
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Scan time for ~1k addresses: one thread per address versus the selector-based scanner.
+
+Fake peers are bound to loopback addresses in --network: some accept
+connections, some are "silent" (a full accept queue makes the kernel drop
+their SYNs, like a host that does not answer), and the rest refuse at once.
+
+    python benchmarks/bench_discovery.py --network 127.77.0.0/22 --live 20 --silent 200
+"""
+import argparse
+import ipaddress
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from discovery import expand_targets, scan
+
+
+class FakePeers:
+    def __init__(self, network, port, live, silent):
+        hosts = list(expand_targets(network))
+        random.seed(1)
+        chosen = random.sample(hosts, live + silent)
+        self.live = set(chosen[:live])
+        self.sockets = []
+        for ip in chosen:
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind((ip, port))
+            listener.listen(0 if ip not in self.live else 128)
+            self.sockets.append(listener)
+            if ip in self.live:
+                threading.Thread(target=self.accept_loop, args=(listener,), daemon=True).start()
+            else:
+                # Fill the one-slot accept queue; later SYNs are dropped.
+                self.sockets.append(socket.create_connection((ip, port)))
+
+    def accept_loop(self, listener):
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            conn.close()
+
+    def close(self):
+        for sock in self.sockets:
+            sock.close()
+
+
+def thread_per_address(network, port, timeout=0.1):
+    found = []
+
+    def check_ip(ip):
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                s.settimeout(timeout)
+                s.connect((ip, port))
+                found.append(ip)
+        except OSError:
+            pass
+
+    threads = [threading.Thread(target=check_ip, args=(ip,)) for ip in expand_targets(network)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--network", default="127.77.0.0/22")
+    parser.add_argument("--port", type=int, default=5099)
+    parser.add_argument("--live", type=int, default=20)
+    parser.add_argument("--silent", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[128, 256, 512])
+    args = parser.parse_args()
+
+    addresses = ipaddress.ip_network(args.network).num_addresses - 2
+    peers = FakePeers(args.network, args.port, args.live, args.silent)
+    print(f"{addresses} addresses, {args.live} live, {args.silent} silent")
+    print(f"{'scanner':>24} {'seconds':>9} {'found':>6}")
+    runs = [("thread per address", lambda: thread_per_address(args.network, args.port))]
+    for concurrency in args.concurrency:
+        runs.append((f"selectors x{concurrency}",
+                     lambda concurrency=concurrency: scan(args.network, args.port, concurrency=concurrency)))
+    for label, run in runs:
+        start = time.perf_counter()
+        found = run()
+        elapsed = time.perf_counter() - start
+        print(f"{label:>24} {elapsed:>9.3f} {len(set(found) & peers.live):>6}")
+    peers.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Importing a folder of many photos: one file at a time versus the bulk import pipeline.
+
+    python benchmarks/bench_import.py --files 3000 --size-kb 2000 --workers 1,4,8
+
+"one by one" is what Add to Folder did: Node.add_file for each file in turn,
+with an index transaction per file. import_paths copies on a pool of workers
+and records the index a batch at a time; both hash while they copy.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from node import Node
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=3000)
+    parser.add_argument("--size-kb", type=int, default=2000)
+    parser.add_argument("--folders", type=int, default=30, help="subfolders the files are spread over")
+    parser.add_argument("--workers", default="1,4,8")
+    parser.add_argument("--dir", help="where to work (default: a temporary directory)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as work:
+        source = os.path.join(work, "Photos")
+        files = []
+        for i in range(args.files):
+            folder = os.path.join(source, f"day{i % args.folders:03d}")
+            os.makedirs(folder, exist_ok=True)
+            path = os.path.join(folder, f"IMG_{i:05d}.jpg")
+            with open(path, "wb") as f:
+                f.write(os.urandom(args.size_kb * 1024))
+            files.append(path)
+        total = args.files * args.size_kb * 1024
+
+        print(f"{'mode':>14} {'seconds':>9} {'files/s':>9} {'MB/s':>8}")
+        node = Node(os.path.join(work, "serial"))
+        start = time.perf_counter()
+        for path in files:
+            node.add_file(path, "Photos/" + os.path.relpath(path, source).replace(os.sep, "/"))
+        elapsed = time.perf_counter() - start
+        node.index.close()
+        print(f"{'one by one':>14} {elapsed:>9.2f} {args.files / elapsed:>9.0f} {total / elapsed / 1e6:>8.1f}")
+
+        for workers in (int(workers) for workers in args.workers.split(",")):
+            node = Node(os.path.join(work, f"bulk{workers}"))
+            start = time.perf_counter()
+            node.import_paths([source], workers=workers)
+            elapsed = time.perf_counter() - start
+            node.index.close()
+            print(f"{f'{workers} workers':>14} {elapsed:>9.2f} {args.files / elapsed:>9.0f} "
+                  f"{total / elapsed / 1e6:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
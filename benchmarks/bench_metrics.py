@@ -0,0 +1,60 @@
+"""Cost of server metrics: small requests and a large download with metrics off and on.
+
+    python benchmarks/bench_metrics.py --requests 2000 --size-mb 256
+
+Small requests (16 KB files, one connection each) are where per-request
+bookkeeping would show; the large file is where per-send counting would.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metrics import Metrics
+from networking import FileServer, download_file
+
+
+def timed(run):
+    start = time.perf_counter()
+    run()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--size-mb", type=int, default=256)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    size = args.size_mb * 1024 * 1024
+    with tempfile.TemporaryDirectory() as share, tempfile.TemporaryDirectory() as downloads:
+        with open(os.path.join(share, "big.bin"), "wb") as f:
+            for _ in range(args.size_mb):
+                f.write(os.urandom(1024 * 1024))
+        with open(os.path.join(share, "small.bin"), "wb") as f:
+            f.write(os.urandom(16 * 1024))
+        target = os.path.join(downloads, "out.bin")
+
+        print(f"{'metrics':>8} {'small req/s':>12} {'big MB/s':>9}")
+        for metrics in (None, Metrics()):
+            server = FileServer(share, {}, "127.0.0.1", 0, metrics=metrics)
+            server.start()
+
+            def small():
+                for _ in range(args.requests):
+                    download_file("127.0.0.1", server.port, "small.bin", target, resume=False, verify=False)
+
+            small_best = min(timed(small) for _ in range(args.runs))
+            big_best = min(timed(lambda: download_file("127.0.0.1", server.port, "big.bin", target, resume=False,
+                                                       verify=False)) for _ in range(args.runs))
+            server.stop()
+            label = "on" if metrics is not None else "off"
+            print(f"{label:>8} {args.requests / small_best:>12.0f} {size / big_best / 1e6:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""Single-file download time with 1 to 8 parallel range streams.
+
+Each connection goes through a proxy capped at --mbit, which stands in for a
+window- or Wi-Fi-limited TCP stream:
+
+    python benchmarks/bench_parallel_streams.py --mbit 200 --size-mb 256
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from networking import FileServer, download_item
+from proxy import CountingProxy
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=128)
+    parser.add_argument("--mbit", type=float, default=200, help="rate cap per connection, 0 for none")
+    parser.add_argument("--streams", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as share, tempfile.TemporaryDirectory() as downloads:
+        with open(os.path.join(share, "image.iso"), "wb") as f:
+            block = os.urandom(1024 * 1024)
+            for _ in range(args.size_mb):
+                f.write(block)
+        server = FileServer(share, {}, "127.0.0.1", 0)
+        server.start()
+        proxy = CountingProxy(server.port, args.mbit or None)
+        size = args.size_mb * 1024 * 1024
+
+        print(f"{'streams':>8} {'seconds':>9} {'MB/s':>9} {'speedup':>8}")
+        baseline = None
+        for streams in args.streams:
+            start = time.perf_counter()
+            download_item("127.0.0.1", proxy.port, "image.iso", "File", downloads, compress=False,
+                          resume=False, streams=streams, parallel_threshold=1)
+            elapsed = time.perf_counter() - start
+            baseline = baseline or elapsed
+            print(f"{streams:>8} {elapsed:>9.3f} {size / elapsed / 1e6:>9.1f} {baseline / elapsed:>8.2f}")
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""Rate caps and priorities: bulk downloads held to the cap while file lists and small files stay quick.
+
+    python benchmarks/bench_ratelimit.py --cap 20M --bulk 2 --size-mb 40
+
+A download cap (memo --limit) is also measured on the wire: a proxy counts the
+bytes the server actually sends while the client reads through a capped meter,
+over a session and over one connection per request. "ahead" is the most the
+wire ever got in front of the cap, which the stream window and socket buffers
+bound. --check exits 1 if it gets further ahead than --max-ahead-mb, or runs
+faster than the cap after that; --size-mb should be well above --max-ahead-mb.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import networking
+from networking import FileServer, download_file, download_item, request_file_list
+from proxy import CountingProxy
+from ratelimit import RateLimiter, parse_rate
+
+SAMPLE_INTERVAL = 0.1
+
+
+def measure(share, downloads, port, limiter, bulk, size):
+    server = FileServer(share, {}, "127.0.0.1", port, limiter=limiter)
+    server.start()
+    server.index.rescan()
+    latencies, small_times = [], []
+    try:
+        def fetch(i):
+            download_item("127.0.0.1", port, "big.bin", "File", os.path.join(downloads, f"bulk{i}"),
+                          compress=False, resume=False)
+
+        for i in range(bulk):
+            os.makedirs(os.path.join(downloads, f"bulk{i}"), exist_ok=True)
+        started = time.perf_counter()
+        threads = [threading.Thread(target=fetch, args=(i,)) for i in range(bulk)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.3)
+        while any(thread.is_alive() for thread in threads):
+            t = time.perf_counter()
+            request_file_list("127.0.0.1", port)
+            latencies.append(time.perf_counter() - t)
+            t = time.perf_counter()
+            download_file("127.0.0.1", port, "small.bin", os.path.join(downloads, "small.bin"), resume=False)
+            small_times.append(time.perf_counter() - t)
+            time.sleep(0.2)
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+    finally:
+        server.stop()
+        server.index.close()
+    # Unthrottled runs can finish before the first probe.
+    return bulk * size / elapsed, max(latencies, default=None), max(small_times, default=None)
+
+
+def wire_rate(share, downloads, cap, size, use_session):
+    """Download big.bin through a proxy with the client capped at cap; returns (steady bytes/s, most bytes ahead)."""
+    server = FileServer(share, {}, "127.0.0.1", 0)
+    server.start()
+    proxy = CountingProxy(server.port)
+    if not use_session:
+        networking.sessions.legacy[("127.0.0.1", proxy.port)] = float("inf")
+    target = os.path.join(downloads, "capped")
+    os.makedirs(target, exist_ok=True)
+    progress = RateLimiter(cap).meter("127.0.0.1")
+    thread = threading.Thread(target=download_item, args=("127.0.0.1", proxy.port, "big.bin", "File", target),
+                              kwargs={"compress": False, "resume": False, "verify": False, "progress": progress})
+    samples = []
+    try:
+        started = time.perf_counter()
+        thread.start()
+        while thread.is_alive():
+            samples.append((time.perf_counter() - started, proxy.downstream_bytes))
+            time.sleep(SAMPLE_INTERVAL)
+        thread.join()
+        samples.append((time.perf_counter() - started, proxy.downstream_bytes))
+    finally:
+        server.stop()
+        server.index.close()
+    ahead = max(moved - cap * t for t, moved in samples)
+    # Once the window and buffers have filled, the wire can only move as fast as the reader.
+    settled = [(t, moved) for t, moved in samples if t >= samples[-1][0] / 4]
+    (t0, moved0), (t1, moved1) = settled[0], settled[-1]
+    return (moved1 - moved0) / (t1 - t0), ahead
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cap", default="20M")
+    parser.add_argument("--bulk", type=int, default=2)
+    parser.add_argument("--size-mb", type=int, default=40)
+    parser.add_argument("--port", type=int, default=5960)
+    parser.add_argument("--check", action="store_true", help="exit 1 if the wire outruns a capped download")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="how far over the cap counts (0.1 = 10%%)")
+    parser.add_argument("--max-ahead-mb", type=float, default=24, help="how far the wire may lead a capped reader")
+    args = parser.parse_args()
+
+    size = args.size_mb * 1024 * 1024
+    with tempfile.TemporaryDirectory() as share, tempfile.TemporaryDirectory() as downloads:
+        with open(os.path.join(share, "big.bin"), "wb") as f:
+            f.write(os.urandom(size))
+        with open(os.path.join(share, "small.bin"), "wb") as f:
+            f.write(os.urandom(256 * 1024))
+        cap = parse_rate(args.cap)
+        print(f"{'limits':>24} {'bulk MiB/s':>11} {'list max ms':>12} {'256K file max ms':>17}")
+        for port, (label, limiter) in enumerate([
+            ("none", RateLimiter()),
+            (f"global {args.cap}", RateLimiter(cap)),
+            (f"per peer {args.cap}", RateLimiter(peer_rate=cap)),
+        ], args.port):
+            rate, latency, small = measure(share, downloads, port, limiter, args.bulk, size)
+            latency = f"{latency * 1000:.0f}" if latency is not None else "-"
+            small = f"{small * 1000:.0f}" if small is not None else "-"
+            print(f"{label:>24} {rate / 2 ** 20:>11.1f} {latency:>12} {small:>17}")
+
+        print(f"\n{'download cap ' + args.cap:>24} {'wire MiB/s':>11} {'MiB ahead':>12}")
+        over = False
+        for label, use_session in (("session", True), ("connection per request", False)):
+            rate, ahead = wire_rate(share, downloads, cap, size, use_session)
+            over = over or rate > cap * (1 + args.tolerance) or ahead > args.max_ahead_mb * 2 ** 20
+            print(f"{label:>24} {rate / 2 ** 20:>11.1f} {ahead / 2 ** 20:>12.1f}")
+    if args.check and over:
+        print("The wire ran faster than the download cap")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,71 @@
+"""End-to-end download throughput and receiver memory: legacy recv(4096) loop vs download_item.
+
+    python benchmarks/bench_receive.py --size-mb 1024
+"""
+import argparse
+import os
+import socket
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from networking import FileServer, download_item
+
+
+def legacy_download(port, item_name, save_path):
+    with socket.create_connection(("127.0.0.1", port)) as s:
+        s.sendall(f"DOWNLOAD:{item_name}".encode())
+        file_size = struct.unpack("!Q", s.recv(8))[0]
+        received_size = 0
+        with open(os.path.join(save_path, item_name), "wb") as f:
+            while received_size < file_size:
+                chunk = s.recv(4096)
+                if not chunk:
+                    break
+                f.write(chunk)
+                received_size += len(chunk)
+
+
+def measure(download):
+    tracemalloc.start()
+    start = time.perf_counter()
+    download()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=512)
+    parser.add_argument("--chunk-kb", type=int, nargs="+", default=[64, 256, 1024, 4096])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as share, tempfile.TemporaryDirectory() as downloads:
+        with open(os.path.join(share, "payload.bin"), "wb") as f:
+            block = os.urandom(1024 * 1024)
+            for _ in range(args.size_mb):
+                f.write(block)
+        server = FileServer(share, {}, "127.0.0.1", 0)
+        server.start()
+        size = args.size_mb * 1024 * 1024
+
+        runs = [("recv(4096) loop", lambda: legacy_download(server.port, "payload.bin", downloads))]
+        for kb in args.chunk_kb:
+            runs.append((f"recv_into {kb} KiB", lambda kb=kb: download_item(
+                "127.0.0.1", server.port, "payload.bin", "File", downloads, chunk_size=kb * 1024)))
+
+        print(f"{'receiver':>20} {'MB/s':>10} {'peak KiB':>10}")
+        for name, download in runs:
+            elapsed, peak = measure(download)
+            print(f"{name:>20} {size / elapsed / 1e6:>10.1f} {peak / 1024:>10.0f}")
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Loopback send throughput: legacy 4 KiB loop vs buffered vs sendfile.
+
+    python benchmarks/bench_sendfile.py --size-mb 1024
+"""
+import argparse
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transfer import send_file, send_file_buffered
+
+
+def legacy_send(conn, f):
+    while True:
+        chunk = f.read(4096)
+        if not chunk:
+            break
+        conn.sendall(chunk)
+
+
+def drain(listener, result):
+    conn, _ = listener.accept()
+    with conn:
+        buffer = bytearray(1024 * 1024)
+        total = 0
+        while True:
+            n = conn.recv_into(buffer)
+            if not n:
+                break
+            total += n
+    result.append(total)
+
+
+def measure(path, sender):
+    with socket.socket() as listener:
+        listener.bind(("127.0.0.1", 0))
+        listener.listen()
+        result = []
+        receiver = threading.Thread(target=drain, args=(listener, result))
+        receiver.start()
+        start = time.perf_counter()
+        with socket.create_connection(listener.getsockname()) as conn, open(path, "rb") as f:
+            sender(conn, f)
+        receiver.join()
+        return result[0], time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=512)
+    args = parser.parse_args()
+
+    senders = [
+        ("4 KiB loop", legacy_send),
+        ("buffered 1 MiB", lambda conn, f: send_file_buffered(conn, f)),
+        ("sendfile", lambda conn, f: send_file(conn, f)),
+    ]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "payload.bin")
+        with open(path, "wb") as f:
+            block = os.urandom(1024 * 1024)
+            for _ in range(args.size_mb):
+                f.write(block)
+        print(f"{'sender':>16} {'MB/s':>10} {'seconds':>10}")
+        for name, sender in senders:
+            size, elapsed = measure(path, sender)
+            print(f"{name:>16} {size / elapsed / 1e6:>10.1f} {elapsed:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
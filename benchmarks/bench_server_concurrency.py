@@ -0,0 +1,72 @@
+"""File-list latency while N large downloads are in flight.
+
+    python benchmarks/bench_server_concurrency.py --downloads 0 1 2 4 8
+"""
+import argparse
+import logging
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from networking import FileServer
+
+
+def slow_download(port, item_name, stop):
+    # Read slowly so the transfer stays busy for the whole measurement window.
+    with socket.create_connection(("127.0.0.1", port)) as s:
+        s.sendall(f"DOWNLOAD:{item_name}".encode())
+        while not stop.is_set():
+            if not s.recv(65536):
+                break
+            time.sleep(0.01)
+
+
+def file_list_latency(port, samples):
+    timings = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        with socket.create_connection(("127.0.0.1", port)) as s:
+            s.sendall(b"REQUEST_FILE_LIST")
+            s.recv(4096)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--downloads", type=int, nargs="+", default=[0, 1, 2, 4, 8])
+    parser.add_argument("--samples", type=int, default=50)
+    parser.add_argument("--size-mb", type=int, default=512)
+    args = parser.parse_args()
+    # The aborted slow readers make the server log connection resets.
+    logging.disable(logging.ERROR)
+
+    with tempfile.TemporaryDirectory() as share:
+        with open(os.path.join(share, "big.bin"), "wb") as f:
+            f.truncate(args.size_mb * 1024 * 1024)
+        server = FileServer(share, {}, "127.0.0.1", 0)
+        server.start()
+        print(f"{'downloads':>10} {'p50 ms':>10} {'p95 ms':>10} {'max ms':>10}")
+        for n in args.downloads:
+            stop = threading.Event()
+            workers = [threading.Thread(target=slow_download, args=(server.port, "big.bin", stop)) for _ in range(n)]
+            for w in workers:
+                w.start()
+            time.sleep(0.2)
+            timings = sorted(file_list_latency(server.port, args.samples))
+            stop.set()
+            for w in workers:
+                w.join()
+            p95 = timings[int(len(timings) * 0.95) - 1]
+            print(f"{n:>10} {statistics.median(timings):>10.2f} {p95:>10.2f} {timings[-1]:>10.2f}")
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
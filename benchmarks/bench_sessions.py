@@ -0,0 +1,61 @@
+"""Download many small files: one connection per request versus pipelined over one session.
+
+The proxy adds --latency-ms in each direction, like a Wi-Fi hop:
+
+    python benchmarks/bench_sessions.py --files 500 --latency-ms 2
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import networking
+from networking import FileServer, download_file, download_files
+from proxy import CountingProxy
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=500)
+    parser.add_argument("--size-kb", type=int, default=4)
+    parser.add_argument("--latency-ms", type=float, default=2)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as share, tempfile.TemporaryDirectory() as downloads:
+        names = [f"file{i:05d}.bin" for i in range(args.files)]
+        for name in names:
+            with open(os.path.join(share, name), "wb") as f:
+                f.write(os.urandom(args.size_kb * 1024))
+        server = FileServer(share, {}, "127.0.0.1", 0)
+        server.start()
+        legacy_proxy = CountingProxy(server.port, latency=args.latency_ms / 1000)
+        session_proxy = CountingProxy(server.port, latency=args.latency_ms / 1000)
+        # Make the pool treat the first proxy as a peer without sessions.
+        networking.sessions.legacy[("127.0.0.1", legacy_proxy.port)] = float("inf")
+
+        def per_connection():
+            for name in names:
+                download_file("127.0.0.1", legacy_proxy.port, name, os.path.join(downloads, name), resume=False)
+
+        def one_at_a_time():
+            for name in names:
+                download_file("127.0.0.1", session_proxy.port, name, os.path.join(downloads, name), resume=False)
+
+        def pipelined():
+            download_files("127.0.0.1", session_proxy.port, names, downloads, compress=False, resume=False)
+
+        print(f"{'mode':>22} {'seconds':>9} {'files/s':>9}")
+        for label, run in [("connection per file", per_connection), ("session, one at a time", one_at_a_time),
+                           ("session, pipelined", pipelined)]:
+            start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - start
+            print(f"{label:>22} {elapsed:>9.3f} {args.files / elapsed:>9.0f}")
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
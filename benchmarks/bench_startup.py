@@ -0,0 +1,96 @@
+"""Startup cost of the headless node versus the GUI, each measured in fresh interpreters.
+
+    python benchmarks/bench_startup.py --runs 5
+
+"serve ready" is the time from launching `python -m memo serve` until its port
+accepts connections. GUI rows need tkinter, Pillow and sv_ttk; missing ones are
+reported rather than measured.
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SNIPPETS = {
+    "import node (CLI core)": "import node",
+    "import tkinter": "import tkinter",
+    "import PIL + sv_ttk": "import tkinter, PIL.Image, PIL.ImageTk, sv_ttk",
+    "GUI imports + decode icons": (
+        "import tkinter, sv_ttk\n"
+        "from PIL import Image\n"
+        "for name in ('file-icon.png', 'file-icon1.png'):\n"
+        "    Image.open(name).resize((50, 50))\n"
+        "import main"
+    ),
+}
+
+
+def time_snippet(code, runs):
+    best = None
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True)
+        elapsed = time.perf_counter() - started
+        if result.returncode:
+            return None, result.stderr.decode().strip().splitlines()[-1]
+        best = elapsed if best is None else min(best, elapsed)
+    return best, None
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def time_serve(runs):
+    best = None
+    for _ in range(runs):
+        port = free_port()
+        with tempfile.TemporaryDirectory() as share:
+            started = time.perf_counter()
+            process = subprocess.Popen([sys.executable, "-m", "memo", "--host", "127.0.0.1", "--port", str(port),
+                                        "serve", "--no-beacons", "--share", share],
+                                       cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                while True:
+                    try:
+                        socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+                        break
+                    except OSError:
+                        if process.poll() is not None:
+                            return None
+                        time.sleep(0.005)
+                elapsed = time.perf_counter() - started
+            finally:
+                process.terminate()
+                process.wait()
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    baseline, _ = time_snippet("pass", args.runs)
+    print(f"{'step':>28} {'ms (best)':>10} {'over bare python':>17}")
+    print(f"{'bare python':>28} {baseline * 1000:>10.0f}")
+    for label, code in SNIPPETS.items():
+        elapsed, error = time_snippet(code, args.runs)
+        if elapsed is None:
+            print(f"{label:>28} {'n/a':>10}  ({error})")
+        else:
+            print(f"{label:>28} {elapsed * 1000:>10.0f} {(elapsed - baseline) * 1000:>17.0f}")
+    elapsed = time_serve(args.runs)
+    print(f"{'serve ready':>28} {elapsed * 1000 if elapsed else float('nan'):>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Sharing one large file into several folders: full copies versus the content store.
+
+    python benchmarks/bench_store.py --size-mb 512 --copies 3
+
+"copy2 + hash" is what sharing used to cost: a full copy per folder, then a
+separate read of each copy when the index hashed it. The store hashes while it
+copies, keeps one object and links it into each folder (reflink, else hardlink).
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hashing import hash_file
+from store import ContentStore
+
+
+def disk_usage(path):
+    seen = set()
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            st = os.lstat(os.path.join(root, name))
+            if (st.st_dev, st.st_ino) not in seen:
+                seen.add((st.st_dev, st.st_ino))
+                total += st.st_blocks * 512
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=512)
+    parser.add_argument("--copies", type=int, default=3)
+    parser.add_argument("--dir", help="where to work (default: a temporary directory); pick a btrfs/XFS "
+                                      "mount to see reflinks")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as work:
+        src = os.path.join(work, "source.bin")
+        with open(src, "wb") as f:
+            for _ in range(args.size_mb):
+                f.write(os.urandom(1024 * 1024))
+        folders = [f"folder{i}" for i in range(args.copies)]
+
+        print(f"{'mode':>14} {'seconds':>9} {'disk MiB':>9}")
+        share = os.path.join(work, "copy2")
+        start = time.perf_counter()
+        for folder in folders:
+            os.makedirs(os.path.join(share, folder))
+            dest = os.path.join(share, folder, "source.bin")
+            shutil.copy2(src, dest)
+            hash_file(dest)
+        elapsed = time.perf_counter() - start
+        print(f"{'copy2 + hash':>14} {elapsed:>9.2f} {disk_usage(share) / 2 ** 20:>9.0f}")
+        shutil.rmtree(share)
+
+        share = os.path.join(work, "store")
+        store = ContentStore(share)
+        start = time.perf_counter()
+        for folder in folders:
+            os.makedirs(os.path.join(share, folder))
+            store.add(src, os.path.join(share, folder, "source.bin"))
+        elapsed = time.perf_counter() - start
+        print(f"{'store':>14} {elapsed:>9.2f} {disk_usage(share) / 2 ** 20:>9.0f}")
+
+        share = os.path.join(work, "in-place")
+        store = ContentStore(share)
+        start = time.perf_counter()
+        for folder in folders:
+            os.makedirs(os.path.join(share, folder))
+            store.share_in_place(src, os.path.join(share, folder, "source.bin"))
+        elapsed = time.perf_counter() - start
+        print(f"{'in place':>14} {elapsed:>9.2f} {disk_usage(share) / 2 ** 20:>9.0f}")
+
+
+if __name__ == "__main__":
+    main()
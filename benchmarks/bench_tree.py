@@ -0,0 +1,113 @@
+"""File tree refresh cost: rebuilding every node versus the lazy, diffing LazyTree, at 1k/10k/100k entries.
+
+    python benchmarks/bench_tree.py --sizes 1000,10000,100000
+
+Needs a display (on a headless machine run it under xvfb-run). Each share holds
+folders of 100 files plus one flat folder with a tenth of the entries. "stall"
+is the longest single stretch the Tk event loop was blocked: the rebuild does
+all of its work in one call, LazyTree in after() batches.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lazy_tree import LazyTree
+
+
+def make_share(size):
+    flat = size // 10
+    share = {"": [], "flat": [(f"file{i:06d}.bin", False, ("File", "")) for i in range(flat)]}
+    share[""].append(("flat", True, ("Folder", "Public")))
+    for i in range((size - flat) // 100):
+        name = f"folder{i:05d}"
+        share[""].append((name, True, ("Folder", "Public")))
+        share[name] = [(f"file{j:03d}.bin", False, ("File", "")) for j in range(100)]
+    return share
+
+
+def rebuild(tree, share):
+    # What the file tree did before: drop every node, then insert every folder and its files.
+    tree.delete(*tree.get_children())
+    for name, is_folder, values in share[""]:
+        item = tree.insert("", "end", text=name, values=values)
+        for child, _, child_values in share.get(name, []) if is_folder else []:
+            tree.insert(item, "end", text=child, values=child_values)
+
+
+def settle(root, view):
+    """Run the event loop until view has nothing queued; returns the longest single update."""
+    longest = 0
+    while view.pending or view.scheduled is not None:
+        t = time.perf_counter()
+        root.update()
+        longest = max(longest, time.perf_counter() - t)
+    return longest
+
+
+def measure(root, ttk, size):
+    share = make_share(size)
+    tree = ttk.Treeview(root, columns=("Type", "Visibility"), show="tree headings")
+    t = time.perf_counter()
+    rebuild(tree, share)
+    root.update()
+    rebuild_time = time.perf_counter() - t
+    t = time.perf_counter()
+    rebuild(tree, share)
+    root.update()
+    rerun_time = time.perf_counter() - t
+    tree.destroy()
+
+    tree = ttk.Treeview(root, columns=("Type", "Visibility"), show="tree headings")
+    view = LazyTree(tree, lambda path: share.get(path, []))
+    t = time.perf_counter()
+    view.show()
+    stall = settle(root, view)
+    shown = time.perf_counter() - t
+    # Open the flat folder, the worst case for a single expansion.
+    tree.focus("flat")
+    t = time.perf_counter()
+    view.on_open()
+    open_stall = settle(root, view)
+    opened = time.perf_counter() - t
+    t = time.perf_counter()
+    view.refresh()
+    settle(root, view)
+    unchanged = time.perf_counter() - t
+    share["flat"].append(("new.bin", False, ("File", "")))
+    t = time.perf_counter()
+    view.refresh()
+    settle(root, view)
+    one_added = time.perf_counter() - t
+    tree.destroy()
+    return rebuild_time, rerun_time, shown, max(stall, open_stall), opened, unchanged, one_added
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1000,10000,100000")
+    args = parser.parse_args()
+
+    import tkinter as tk
+    from tkinter import ttk
+
+    try:
+        root = tk.Tk()
+    except tk.TclError as e:
+        print(f"Tk is not available ({str(e)}); run under a display or xvfb-run")
+        return 1
+    root.withdraw()
+    print(f"{'entries':>8} {'rebuild ms':>11} {'again ms':>9} | {'lazy show':>10} {'max stall':>10} "
+          f"{'open flat':>10} {'refresh':>8} {'+1 file':>8}")
+    for size in (int(size) for size in args.sizes.split(",")):
+        rebuild_time, rerun_time, shown, stall, opened, unchanged, one_added = measure(root, ttk, size)
+        print(f"{size:>8} {rebuild_time * 1000:>11.0f} {rerun_time * 1000:>9.0f} | {shown * 1000:>10.1f} "
+              f"{stall * 1000:>10.1f} {opened * 1000:>10.0f} {unchanged * 1000:>8.1f} {one_added * 1000:>8.1f}")
+    root.destroy()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,78 @@
+"""Cost of end-to-end verification: downloads with and without checking chunk hashes, and a repaired corruption.
+
+    python benchmarks/bench_verify.py --size-mb 256 --files 2000
+
+The server's hashes come from its index, warmed before timing, as on a node
+that has finished its background hashing. The corruption row sends the file
+through a proxy that flips one bit; only the chunk holding it is fetched again.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hashing import HASH_CHUNK_SIZE, hash_file
+from networking import FileServer, download_batch, download_file
+from proxy import CountingProxy
+
+
+def timed(run):
+    start = time.perf_counter()
+    run()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=256)
+    parser.add_argument("--files", type=int, default=2000)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    size = args.size_mb * 1024 * 1024
+    with tempfile.TemporaryDirectory() as share, tempfile.TemporaryDirectory() as downloads:
+        with open(os.path.join(share, "big.bin"), "wb") as f:
+            for _ in range(args.size_mb):
+                f.write(os.urandom(1024 * 1024))
+        os.makedirs(os.path.join(share, "small"))
+        names = [f"small/f{i:05d}" for i in range(args.files)]
+        for name in names:
+            with open(os.path.join(share, name), "wb") as f:
+                f.write(os.urandom(16 * 1024))
+        server = FileServer(share, {}, "127.0.0.1", 0)
+        server.start()
+        server.index.rescan()
+        for name in ["big.bin"] + names:
+            server.index.manifest(name)
+        target = os.path.join(downloads, "big.bin")
+        small_bytes = args.files * 16 * 1024
+
+        print(f"{'download':>34} {'best s':>8} {'MB/s':>8}")
+        for verify in (False, True):
+            best = min(timed(lambda: download_file("127.0.0.1", server.port, "big.bin", target, resume=False,
+                                                   verify=verify)) for _ in range(args.runs))
+            print(f"{f'{args.size_mb} MB file, verify={verify}':>34} {best:>8.3f} {size / best / 1e6:>8.1f}")
+        for verify in (False, True):
+            def batch():
+                shutil.rmtree(os.path.join(downloads, "small"), ignore_errors=True)
+                download_batch("127.0.0.1", server.port, names, downloads, verify=verify)
+
+            best = min(timed(batch) for _ in range(args.runs))
+            print(f"{f'{args.files} x 16 KB batch, verify={verify}':>34} {best:>8.3f} {small_bytes / best / 1e6:>8.1f}")
+
+        proxy = CountingProxy(server.port, corrupt_at=size // 2)
+        elapsed = timed(lambda: download_file("127.0.0.1", proxy.port, "big.bin", target, resume=False))
+        intact = hash_file(target)["hash"] == hash_file(os.path.join(share, "big.bin"))["hash"]
+        refetched = proxy.downstream_bytes - size
+        print(f"{'one flipped bit, repaired':>34} {elapsed:>8.3f} {size / elapsed / 1e6:>8.1f}"
+              f"   intact={intact}, re-fetched {refetched / 2 ** 20:.1f} MiB "
+              f"(chunk {HASH_CHUNK_SIZE // 2 ** 20} MiB)")
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import socket
+import threading
+import time
+
+
+class CountingProxy:
+    """Loopback TCP relay that counts server-to-client bytes and can cap each connection's rate.
+
+    latency (seconds) delays everything relayed in each direction, so a round trip costs twice that.
+    corrupt_at flips one bit of the downstream byte at that position (counted across all connections), once.
+    """
+
+    def __init__(self, target_port, mbit=None, latency=0, corrupt_at=None):
+        self.target_port = target_port
+        self.bytes_per_second = mbit * 1e6 / 8 if mbit else None
+        self.latency = latency
+        self.corrupt_at = corrupt_at
+        self.downstream_bytes = 0
+        self.lock = threading.Lock()
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+
+    def accept_loop(self):
+        while True:
+            client, _ = self.listener.accept()
+            upstream = socket.create_connection(("127.0.0.1", self.target_port))
+            for sock in (client, upstream):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self.pump, args=(client, upstream, False), daemon=True).start()
+            threading.Thread(target=self.pump, args=(upstream, client, True), daemon=True).start()
+
+    def pump(self, src, dst, downstream):
+        start = time.perf_counter()
+        moved = 0
+        try:
+            while True:
+                data = src.recv(256 * 1024)
+                if not data:
+                    break
+                if self.latency:
+                    time.sleep(self.latency)
+                if downstream:
+                    moved += len(data)
+                    with self.lock:
+                        position = None if self.corrupt_at is None else self.corrupt_at - self.downstream_bytes
+                        if position is not None and 0 <= position < len(data):
+                            data = bytearray(data)
+                            data[position] ^= 1
+                            self.corrupt_at = None
+                        self.downstream_bytes += len(data)
+                dst.sendall(data)
+                if downstream and self.bytes_per_second:
+                    delay = moved / self.bytes_per_second - (time.perf_counter() - start)
+                    if delay > 0:
+                        time.sleep(delay)
+        except OSError:
+            pass
+        finally:
+            try:
+                dst.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
@@ -0,0 +1,307 @@
+"""End-to-end benchmark suite: several headless servers on loopback, timed from a client node, as JSON.
+
+    python benchmarks/suite.py --servers 3 --output results.json
+    python benchmarks/suite.py --baseline results.json   # exit 1 if anything got worse than --tolerance
+
+Each server is a `memo serve` process with its own share, on its own loopback
+address (127.0.0.2, 127.0.0.3, ...) where the OS routes all of 127/8, else on its
+own port of 127.0.0.1. The shares hold the same synthetic content, hard-linked
+from one template: one huge file, many small files, and a deep chain of folders.
+Timings are the median of --runs after one warm-up run; a table goes to stderr
+and the JSON to stdout or --output.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from discovery import scan
+from networking import request_file_list
+from node import Node
+
+SMALL_FILE_SIZE = 4096
+DEEP_FILES_PER_LEVEL = 4
+
+
+def make_template(path, huge_mb, small_files, depth):
+    """Write the share every server gets a hard-linked copy of; returns how many entries it lists."""
+    os.makedirs(path)
+    with open(os.path.join(path, "huge.bin"), "wb") as f:
+        for _ in range(huge_mb):
+            f.write(os.urandom(1024 * 1024))
+    small = os.path.join(path, "small")
+    os.makedirs(small)
+    data = os.urandom(SMALL_FILE_SIZE)
+    for i in range(small_files):
+        # Different contents, so neither the store nor compression can shortcut them.
+        with open(os.path.join(small, f"f{i:05d}.bin"), "wb") as f:
+            f.write(i.to_bytes(4, "big") + data[4:])
+    level = os.path.join(path, "deep")
+    for d in range(depth):
+        level = os.path.join(level, f"level{d:02d}")
+        os.makedirs(level)
+        for i in range(DEEP_FILES_PER_LEVEL):
+            with open(os.path.join(level, f"f{i}.txt"), "wb") as f:
+                f.write(data)
+    # Folders count as entries too: small, deep and each level.
+    return 1 + 1 + small_files + 1 + depth * (1 + DEEP_FILES_PER_LEVEL)
+
+
+def link_tree(src, dst):
+    for root, _, files in os.walk(src):
+        target = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(target, exist_ok=True)
+        for name in files:
+            os.link(os.path.join(root, name), os.path.join(target, name))
+
+
+def free_port(host="127.0.0.1"):
+    with socket.socket() as s:
+        s.bind((host, 0))
+        return s.getsockname()[1]
+
+
+def loopback_aliases_work():
+    try:
+        with socket.socket() as s:
+            s.bind(("127.0.0.2", 0))
+        return True
+    except OSError:
+        return False
+
+
+class Server:
+    def __init__(self, share, host, port, log):
+        self.host = host
+        self.port = port
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "memo", "--host", host, "--port", str(port), "serve", "--share", share,
+             "--no-beacons", "--metrics"],
+            cwd=ROOT, stdout=log, stderr=subprocess.STDOUT)
+
+    def wait_ready(self, entries, timeout=300):
+        """Wait until the server lists the whole share (its index is built); returns the seconds taken."""
+        start = time.perf_counter()
+        while time.perf_counter() - start < timeout:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"server on {self.host}:{self.port} exited with {self.process.returncode}")
+            try:
+                if len(request_file_list(self.host, self.port, depth=None)) >= entries:
+                    return time.perf_counter() - start
+            except OSError:
+                pass
+            time.sleep(0.2)
+        raise TimeoutError(f"server on {self.host}:{self.port} did not index its share in {timeout} s")
+
+    def stop(self):
+        if self.process.poll() is None:
+            # memo serve stops cleanly on Ctrl+C.
+            if os.name == "nt":
+                self.process.terminate()
+            else:
+                self.process.send_signal(signal.SIGINT)
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+
+
+def measure(run, runs, setup=None):
+    """Run once to warm up, then runs more times; returns the timings in seconds."""
+    timings = []
+    for i in range(runs + 1):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        run()
+        if i:
+            timings.append(time.perf_counter() - start)
+    return timings
+
+
+def result(timings, unit="s", work=None, better="lower"):
+    """A result entry; with work (bytes, files...) the value is work per second, else the median time."""
+    median = statistics.median(timings)
+    value = work / median if work is not None else median
+    return {"value": value, "unit": unit, "better": "higher" if work is not None else better,
+            "runs": timings}
+
+
+def peak_rss_mib(children=False):
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak / (2 ** 20 if sys.platform == "darwin" else 1024)
+
+
+def run_suite(args, workdir):
+    template = os.path.join(workdir, "template")
+    entries = make_template(template, args.huge_mb, args.small_files, args.depth)
+    huge_bytes = args.huge_mb * 1024 * 1024
+    aliases = loopback_aliases_work() and not args.no_aliases
+    if aliases:
+        port = free_port()
+        addresses = [(f"127.0.0.{2 + i}", port) for i in range(args.servers)]
+    else:
+        addresses = [("127.0.0.1", free_port()) for _ in range(args.servers)]
+
+    results = {}
+    servers = []
+    log = open(os.path.join(workdir, "servers.log"), "wb")
+    try:
+        for i, (host, port) in enumerate(addresses):
+            share = os.path.join(workdir, f"share{i}")
+            link_tree(template, share)
+            servers.append(Server(share, host, port, log))
+        ready = [server.wait_ready(entries) for server in servers]
+        results["index_ready"] = result(ready)
+
+        first = servers[0]
+        client_share = os.path.join(workdir, "client")
+        client = Node(client_share, host="127.0.0.1", port=first.port, verify_downloads=not args.no_verify)
+        dest = os.path.join(workdir, "downloads")
+
+        def clean():
+            shutil.rmtree(dest, ignore_errors=True)
+            os.makedirs(dest)
+
+        def cold_list():
+            client.file_lists.forget(first.host)
+            client.list_files(first.host, depth=None)
+
+        results["file_list_cold"] = result(measure(cold_list, args.runs))
+        results["file_list_warm"] = result(measure(lambda: client.list_files(first.host, depth=None), args.runs))
+
+        found = []
+        network = "127.0.0.0/24" if aliases else "127.0.0.1/32"
+        results["scan"] = result(measure(lambda: found.append(len(scan(network, first.port))), args.runs))
+        results["scan"]["peers_found"] = found[-1]
+
+        results["single_file"] = result(
+            measure(lambda: client.download(first.host, "huge.bin", "File", dest, peers=[]), args.runs, clean),
+            "MB/s", huge_bytes / 1e6)
+        if aliases and len(servers) > 1:
+            peers = [server.host for server in servers]
+            results["swarm_file"] = result(
+                measure(lambda: client.download(first.host, "huge.bin", "File", dest, peers=peers),
+                        args.runs, clean),
+                "MB/s", huge_bytes / 1e6)
+
+        def from_every_server():
+            threads = []
+            for i, server in enumerate(servers):
+                node = Node(client_share, host="127.0.0.1", port=server.port, verify_downloads=not args.no_verify)
+                target = os.path.join(dest, str(i))
+                os.makedirs(target)
+                threads.append(threading.Thread(target=node.download,
+                                                args=(server.host, "huge.bin", "File", target, [])))
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        results["multi_peer"] = result(measure(from_every_server, args.runs, clean), "MB/s",
+                                       len(servers) * huge_bytes / 1e6)
+        small_names = [f"small/f{i:05d}.bin" for i in range(args.small_files)]
+        results["small_files_batch"] = result(
+            measure(lambda: client.download_small(first.host, small_names, dest), args.runs, clean),
+            "files/s", args.small_files)
+        results["small_folder"] = result(
+            measure(lambda: client.download(first.host, "small", "Folder", dest, peers=[]), args.runs, clean))
+        results["deep_folder"] = result(
+            measure(lambda: client.download(first.host, "deep", "Folder", dest, peers=[]), args.runs, clean))
+        results["client_peak_rss"] = {"value": peak_rss_mib(), "unit": "MiB", "better": "lower"}
+    finally:
+        for server in servers:
+            server.stop()
+        log.close()
+    if servers:
+        # RUSAGE_CHILDREN: the largest peak of any server process that has exited.
+        results["server_peak_rss"] = {"value": peak_rss_mib(children=True), "unit": "MiB", "better": "lower"}
+    return results
+
+
+def compare(results, config, baseline, tolerance):
+    """Print each result against baseline; returns the names that got worse by more than tolerance."""
+    regressions = []
+    if baseline.get("config") != config:
+        sys.stderr.write(f"Note: the baseline was run with {baseline.get('config')}\n")
+    sys.stderr.write(f"\n{'vs baseline':<20} {'before':>10} {'now':>10} {'change':>8}\n")
+    for name, entry in results.items():
+        old = baseline.get("results", {}).get(name)
+        if not old or not old.get("value") or entry.get("value") is None:
+            continue
+        change = entry["value"] / old["value"] - 1
+        worse = -change if entry["better"] == "higher" else change
+        flag = "  WORSE" if worse > tolerance else ""
+        if flag:
+            regressions.append(name)
+        sys.stderr.write(f"{name:<20} {old['value']:>10.3f} {entry['value']:>10.3f} {change * 100:>+7.1f}%{flag}\n")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--servers", type=int, default=3)
+    parser.add_argument("--huge-mb", type=int, default=512)
+    parser.add_argument("--small-files", type=int, default=10000)
+    parser.add_argument("--depth", type=int, default=32, help="levels of nested folders in deep/")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--no-verify", action="store_true", help="download without checking content hashes")
+    parser.add_argument("--no-aliases", action="store_true", help="run every server on 127.0.0.1")
+    parser.add_argument("--dir", help="where to build the shares (default: a temporary directory)")
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    parser.add_argument("--baseline", help="JSON from an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed slowdown before failing (0.1 = 10%%)")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="memo-bench-", dir=args.dir)
+    try:
+        results = run_suite(args, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    sys.stderr.write(f"{'benchmark':<20} {'value':>10} {'unit':<8}\n")
+    for name, entry in results.items():
+        value = "n/a" if entry["value"] is None else f"{entry['value']:.3f}"
+        sys.stderr.write(f"{name:<20} {value:>10} {entry['unit']:<8}\n")
+    report = {
+        "config": {key: value for key, value in vars(args).items()
+                   if key not in ("output", "baseline", "tolerance", "dir")},
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "cpus": os.cpu_count()},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, report["config"], json.load(f), args.tolerance)
+        if regressions:
+            sys.stderr.write(f"Slower than baseline: {', '.join(regressions)}\n")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
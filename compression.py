@@ -0,0 +1,131 @@
+import os
+import struct
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+BLOCK_SIZE = 1024 * 1024
+# Largest block a receiver accepts, raw or on the wire; room for senders using bigger blocks.
+MAX_BLOCK_SIZE = 16 * BLOCK_SIZE
+SAMPLE_SIZE = 64 * 1024
+MIN_COMPRESS_SIZE = 16 * 1024
+MIN_RATIO = 0.9
+# Each compressed block: raw length, wire length. Equal lengths mean the block is stored.
+BLOCK_HEADER = struct.Struct("!II")
+
+INCOMPRESSIBLE_EXTENSIONS = {
+    ".7z", ".aac", ".avi", ".bz2", ".docx", ".flac", ".gif", ".gz", ".heic", ".jar", ".jpeg",
+    ".jpg", ".m4a", ".mkv", ".mov", ".mp3", ".mp4", ".ogg", ".png", ".pptx", ".rar", ".webm",
+    ".webp", ".xlsx", ".xz", ".zip", ".zst",
+}
+
+
+class Codec:
+    """compress(data) -> bytes; decompress(data, max_length) -> bytes, raising ValueError past max_length."""
+
+    def __init__(self, name, codec_id, compress, decompress):
+        self.name = name
+        self.id = codec_id
+        self.compress = compress
+        self.decompress = decompress
+
+
+CODECS = {}
+
+
+def register_codec(codec):
+    CODECS[codec.name] = codec
+
+
+def check_length(data, max_length, complete):
+    # Decompressors stop one byte past max_length, so a block claiming to be small
+    # cannot inflate into gigabytes before anyone looks at it.
+    if not complete or len(data) > max_length:
+        raise ValueError(f"Compressed block does not decompress to at most {max_length} bytes")
+    return data
+
+
+def zstd_decompress(data, max_length):
+    # decompress() would trust the frame's own content size; a stream reader stops where we say.
+    chunks = []
+    received = 0
+    complete = False
+    with zstandard.ZstdDecompressor().stream_reader(data) as reader:
+        while received <= max_length:
+            chunk = reader.read(max_length + 1 - received)
+            if not chunk:
+                complete = True
+                break
+            chunks.append(chunk)
+            received += len(chunk)
+    return check_length(b"".join(chunks), max_length, complete)
+
+
+def zlib_decompress(data, max_length):
+    decompressor = zlib.decompressobj()
+    data = decompressor.decompress(data, max_length + 1)
+    return check_length(data, max_length, decompressor.eof)
+
+
+def lzma_decompress(data, max_length):
+    decompressor = lzma.LZMADecompressor()
+    data = decompressor.decompress(data, max_length + 1)
+    return check_length(data, max_length, decompressor.eof)
+
+
+if zstandard is not None:
+    register_codec(Codec(
+        "zstd", 3,
+        lambda data: zstandard.ZstdCompressor(level=1).compress(data),
+        zstd_decompress,
+    ))
+register_codec(Codec("zlib", 1, lambda data: zlib.compress(data, 1), zlib_decompress))
+if lzma is not None:
+    register_codec(Codec(
+        "lzma", 2,
+        lambda data: lzma.compress(data, preset=0),
+        lzma_decompress,
+    ))
+
+CODECS_BY_ID = {codec.id: codec for codec in CODECS.values()}
+
+
+def available_codecs():
+    return list(CODECS)
+
+
+def negotiate(offered):
+    """Pick the first codec from the peer's comma-separated preference list that we support."""
+    for name in (offered or "").split(","):
+        if name in CODECS:
+            return CODECS[name]
+    return None
+
+
+def choose_codec(path, f, size, codec):
+    """Return codec if a sample of f shrinks enough to be worth it, else None."""
+    if codec is None or size < MIN_COMPRESS_SIZE:
+        return None
+    if os.path.splitext(path)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+        return None
+    position = f.tell()
+    sample = f.read(SAMPLE_SIZE)
+    f.seek(position)
+    if len(zlib.compress(sample, 1)) < len(sample) * MIN_RATIO:
+        return codec
+    return None
+
+
+def compress_block(codec, data):
+    compressed = codec.compress(data)
+    if len(compressed) >= len(data):
+        return BLOCK_HEADER.pack(len(data), len(data)) + data
+    return BLOCK_HEADER.pack(len(data), len(compressed)) + compressed
@@ -0,0 +1,269 @@
+import errno
+import ipaddress
+import json
+import logging
+import os
+import selectors
+import socket
+import struct
+import threading
+import time
+
+DEFAULT_CONCURRENCY = 256
+INITIAL_TIMEOUT = 0.5
+MIN_TIMEOUT = 0.1
+MAX_TIMEOUT = 1.5
+# Windows reports these through its WSA error codes.
+CONNECT_PENDING = {0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY, getattr(errno, "WSAEWOULDBLOCK", 0)}
+CONNECT_REFUSED = {errno.ECONNREFUSED, getattr(errno, "WSAECONNREFUSED", errno.ECONNREFUSED)}
+
+# Beacons go to an administratively scoped multicast group and, for networks
+# that drop multicast, to the local broadcast address as well.
+BEACON_GROUP = "239.255.77.77"
+BEACON_PORT = 5001
+BEACON_VERSION = 1
+BEACON_INTERVAL = 2.0
+PEER_TTL = 3 * BEACON_INTERVAL
+MAX_BEACON_SIZE = 1024
+
+
+class ConnectTimer:
+    """Connect timeout derived from observed round trips, in the manner of TCP's retransmission timer.
+
+    Both accepted and refused connections are samples: a refusal still means a
+    live host answered. Until the first sample the initial timeout applies.
+    """
+
+    def __init__(self, initial=INITIAL_TIMEOUT, minimum=MIN_TIMEOUT, maximum=MAX_TIMEOUT):
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.srtt = None
+        self.rttvar = None
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+    def timeout(self):
+        if self.srtt is None:
+            return self.initial
+        return min(self.maximum, max(self.minimum, self.srtt + 4 * self.rttvar))
+
+
+def local_network(ip, prefix_length=24):
+    return str(ipaddress.ip_network(f"{ip}/{prefix_length}", strict=False))
+
+
+def expand_targets(networks):
+    """Yield every host address in networks, a CIDR string (e.g. "192.168.0.0/22") or a list of them."""
+    if isinstance(networks, str):
+        networks = [networks]
+    for network in networks:
+        network = ipaddress.ip_network(network, strict=False)
+        if network.num_addresses == 1:
+            yield str(network.network_address)
+        else:
+            for host in network.hosts():
+                yield str(host)
+
+
+def scan(networks, port, on_found=None, concurrency=DEFAULT_CONCURRENCY, timer=None, stop_event=None):
+    """Return the addresses in networks that accept TCP connections on port.
+
+    Connects are non-blocking and multiplexed on one selector, with at most
+    `concurrency` outstanding, so a /22 costs a handful of sockets rather than a
+    thousand threads. on_found(ip) is called from the scanning thread as peers answer.
+    """
+    timer = timer or ConnectTimer()
+    targets = expand_targets(networks)
+    selector = selectors.DefaultSelector()
+    pending = {}
+    found = []
+    exhausted = False
+
+    def launch():
+        nonlocal exhausted
+        while not exhausted and len(pending) < concurrency:
+            ip = next(targets, None)
+            if ip is None:
+                exhausted = True
+                return
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            error = sock.connect_ex((ip, port))
+            if error not in CONNECT_PENDING:
+                # Unreachable network, refused at once, and the like.
+                sock.close()
+                continue
+            selector.register(sock, selectors.EVENT_WRITE, ip)
+            pending[sock] = time.monotonic()
+
+    def finish(sock):
+        selector.unregister(sock)
+        del pending[sock]
+        sock.close()
+
+    try:
+        launch()
+        while pending:
+            if stop_event is not None and stop_event.is_set():
+                break
+            timeout = timer.timeout()
+            first_deadline = min(pending.values()) + timeout
+            for key, _ in selector.select(max(0, first_deadline - time.monotonic())):
+                sock = key.fileobj
+                rtt = time.monotonic() - pending[sock]
+                error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if error == 0:
+                    timer.sample(rtt)
+                    found.append(key.data)
+                    if on_found:
+                        on_found(key.data)
+                elif error in CONNECT_REFUSED:
+                    timer.sample(rtt)
+                finish(sock)
+            now = time.monotonic()
+            for sock in [sock for sock, started in pending.items() if now - started >= timeout]:
+                finish(sock)
+            launch()
+    finally:
+        for sock in list(pending):
+            finish(sock)
+        selector.close()
+    logging.debug(f"Scan of {networks} found {len(found)} peers (connect timeout {timer.timeout():.3f}s)")
+    return found
+
+
+class BeaconService:
+    """Announces this instance over UDP and keeps a table of the peers heard from.
+
+    Every interval a small JSON beacon (address, TCP port, share generation,
+    capacity) is multicast and broadcast. A starting instance asks, and every
+    peer that hears the question answers at once, so the table fills within a
+    round trip. Peers are dropped after ttl seconds of silence or when they say
+    goodbye. on_change() is called from the beacon thread whenever the table changes.
+    """
+
+    def __init__(self, host, port, generation=None, capacity=None, on_change=None,
+                 beacon_port=BEACON_PORT, interval=BEACON_INTERVAL, ttl=PEER_TTL):
+        self.host = host
+        self.port = port
+        self.generation = generation or (lambda: 0)
+        self.capacity = capacity or (lambda: {})
+        self.on_change = on_change
+        self.beacon_port = beacon_port
+        self.interval = interval
+        self.ttl = ttl
+        self.instance_id = os.urandom(8).hex()
+        self.peers = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.sock = None
+        self.announcing = False
+
+    def start(self, announce=True):
+        """Join the beacon group; with announce=False only listen, e.g. to list peers without becoming one."""
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, "SO_REUSEPORT"):
+            # Lets several instances on one machine (tests, multiple users) share the port.
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.sock.bind(("", self.beacon_port))
+        try:
+            membership = struct.pack("4s4s", socket.inet_aton(BEACON_GROUP), socket.inet_aton("0.0.0.0"))
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        except OSError as e:
+            logging.warning(f"Multicast unavailable, relying on broadcast beacons: {str(e)}")
+        threading.Thread(target=self.receive_loop, daemon=True).start()
+        if announce:
+            self.announcing = True
+            threading.Thread(target=self.announce_loop, daemon=True).start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.announcing:
+            try:
+                self.announce("bye")
+            except OSError:
+                pass
+        self.sock.close()
+
+    def beacon(self, kind):
+        return json.dumps({
+            "app": "memo",
+            "v": BEACON_VERSION,
+            "kind": kind,
+            "id": self.instance_id,
+            "ip": self.host,
+            "port": self.port,
+            "generation": self.generation(),
+            "capacity": self.capacity(),
+        }).encode()
+
+    def announce(self, kind="beacon", destinations=None):
+        data = self.beacon(kind)
+        for destination in destinations or [BEACON_GROUP, "255.255.255.255"]:
+            try:
+                self.sock.sendto(data, (destination, self.beacon_port))
+            except OSError as e:
+                logging.debug(f"Beacon to {destination} failed: {str(e)}")
+
+    def announce_loop(self):
+        self.announce("query")
+        while not self.stop_event.wait(self.interval):
+            self.announce()
+
+    def receive_loop(self):
+        self.sock.settimeout(1.0)
+        while not self.stop_event.is_set():
+            self.expire()
+            try:
+                data, (source_ip, _) = self.sock.recvfrom(MAX_BEACON_SIZE)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            try:
+                beacon = json.loads(data.decode())
+                if beacon.get("app") == "memo" and beacon.get("id") != self.instance_id:
+                    self.handle(beacon, source_ip)
+            except (ValueError, KeyError, TypeError) as e:
+                logging.debug(f"Ignoring malformed beacon from {source_ip}: {str(e)}")
+
+    def handle(self, beacon, source_ip):
+        # The source address is what this host can actually reach; the beacon's own
+        # "ip" may be an address on another interface.
+        peer_key = (source_ip, beacon["port"])
+        if beacon["kind"] == "bye":
+            with self.lock:
+                changed = self.peers.pop(peer_key, None) is not None
+        else:
+            if beacon["kind"] == "query" and self.announcing:
+                self.announce()
+            entry = {"ip": source_ip, "port": beacon["port"], "generation": beacon.get("generation"),
+                     "capacity": beacon.get("capacity", {}), "id": beacon["id"], "seen": time.monotonic()}
+            with self.lock:
+                old = self.peers.get(peer_key)
+                self.peers[peer_key] = entry
+            changed = old is None or old["generation"] != entry["generation"] or old["id"] != entry["id"]
+        if changed and self.on_change:
+            self.on_change()
+
+    def expire(self):
+        cutoff = time.monotonic() - self.ttl
+        with self.lock:
+            stale = [key for key, entry in self.peers.items() if entry["seen"] < cutoff]
+            for key in stale:
+                del self.peers[key]
+        if stale and self.on_change:
+            self.on_change()
+
+    def live_peers(self):
+        with self.lock:
+            return sorted(self.peers.values(), key=lambda entry: socket.inet_aton(entry["ip"]))
@@ -0,0 +1,373 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from hashing import DIGEST_SIZE, HASH_CHUNK_SIZE, hash_file
+
+# App state (the index database, and later anything else) lives in this hidden
+# folder inside the share and is never listed or served.
+STATE_DIRNAME = ".memo"
+INDEX_FILENAME = "index.sqlite3"
+
+
+def is_internal(name):
+    return name == STATE_DIRNAME or name.endswith((".part", ".part.tag"))
+
+
+MAX_INCREMENTAL_PATHS = 1000
+
+
+def walk_share(shared_directory, prefix=""):
+    """Yield (relative path, is_dir, size, mtime_ns) for prefix ("" is the whole share) and its subtree.
+
+    Linked files are followed (that is how files shared in place appear), but
+    linked folders are skipped, as send_folder skips them: they could lead out
+    of the share, or back into it in a loop.
+    """
+    top = os.path.join(shared_directory, *prefix.split("/")) if prefix else shared_directory
+    if prefix:
+        try:
+            st = os.stat(top)
+        except OSError:
+            return
+        if os.path.isdir(top) and os.path.islink(top):
+            return
+        if not os.path.isdir(top):
+            yield prefix, False, st.st_size, st.st_mtime_ns
+            return
+        yield prefix, True, 0, st.st_mtime_ns
+    stack = [(prefix + "/" if prefix else "", top)]
+    while stack:
+        rel_dir, directory = stack.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            continue
+        for entry in entries:
+            if is_internal(entry.name):
+                continue
+            rel_path = rel_dir + entry.name
+            try:
+                is_dir = entry.is_dir()
+                if is_dir and entry.is_symlink():
+                    continue
+                st = entry.stat()
+            except OSError:
+                continue
+            if is_dir:
+                stack.append((rel_path + "/", entry.path))
+                yield rel_path, True, 0, st.st_mtime_ns
+            else:
+                yield rel_path, False, st.st_size, st.st_mtime_ns
+
+
+def outermost_paths(paths):
+    """Drop every path that is already covered by one of its ancestors in the same set."""
+    paths = set(paths)
+    kept = []
+    for path in sorted(paths):
+        parts = path.split("/")
+        if any("/".join(parts[:i]) in paths for i in range(1, len(parts))):
+            continue
+        if any(is_internal(part) for part in parts):
+            continue
+        kept.append(path)
+    return kept
+
+
+def excluding(folders):
+    """(SQL condition, params) leaving each folder in folders and its contents out of a query on path."""
+    clause, params = "", []
+    for folder in folders:
+        clause += " AND NOT (path = ? OR (path > ? AND path < ?))"
+        params += [folder, folder + "/", folder + "0"]
+    return clause, params
+
+
+class FileIndex:
+    """Persistent path/size/mtime/content-hash index of a shared directory.
+
+    rescan() only stats the tree; files whose (size, mtime) changed are re-hashed
+    on a background pool, and everything else is served from the database.
+
+    Every change is stamped with a generation number that only ever grows, and
+    removed paths leave a tombstone, so peers can ask for "what changed since
+    generation N" instead of the whole listing. Generations start from the
+    creation time, so a rebuilt index never reuses numbers a peer has seen.
+    """
+
+    def __init__(self, shared_directory, db_path=None, hash_workers=2):
+        self.shared_directory = shared_directory
+        if db_path is None:
+            state_dir = os.path.join(shared_directory, STATE_DIRNAME)
+            os.makedirs(state_dir, exist_ok=True)
+            db_path = os.path.join(state_dir, INDEX_FILENAME)
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.hash_pool = ThreadPoolExecutor(max_workers=hash_workers, thread_name_prefix="memo-hash")
+        self.scan_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="memo-scan")
+        self.rescan_lock = threading.Lock()
+        self.queued = set()
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " path TEXT PRIMARY KEY, is_dir INTEGER NOT NULL, size INTEGER NOT NULL,"
+                " mtime_ns INTEGER NOT NULL, hash TEXT, chunk_size INTEGER, chunks BLOB)"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS entries_hash ON entries (hash)")
+            if "gen" not in [row[1] for row in self.db.execute("PRAGMA table_info(entries)")]:
+                self.db.execute("ALTER TABLE entries ADD COLUMN gen INTEGER NOT NULL DEFAULT 0")
+            self.db.execute("CREATE INDEX IF NOT EXISTS entries_gen ON entries (gen)")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS removed (path TEXT PRIMARY KEY, is_dir INTEGER NOT NULL,"
+                " gen INTEGER NOT NULL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            self.db.execute("INSERT OR IGNORE INTO meta VALUES ('base_generation', ?)", (time.time_ns() // 1000,))
+            self.base_generation = self.db.execute(
+                "SELECT value FROM meta WHERE key = 'base_generation'").fetchone()[0]
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+            self.generation = row[0] if row else self.base_generation
+
+    def close(self):
+        self.scan_pool.shutdown(wait=False)
+        self.hash_pool.shutdown(wait=False)
+        with self.lock:
+            self.db.close()
+
+    def next_generation(self):
+        """Advance and persist the generation; call with the lock held, inside the transaction."""
+        self.generation += 1
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('generation', ?)", (self.generation,))
+        return self.generation
+
+    def advance_generation(self):
+        """Start a new generation without changing any entry, e.g. when what is visible changed."""
+        with self.lock, self.db:
+            return self.next_generation()
+
+    def walk(self, prefix=""):
+        """Yield (relative path, is_dir, size, mtime_ns) for prefix and everything below it."""
+        yield from walk_share(self.shared_directory, prefix)
+
+    def known_under(self, prefix=""):
+        query = "SELECT path, is_dir, size, mtime_ns FROM entries"
+        params = ()
+        if prefix:
+            query += " WHERE path = ? OR (path > ? AND path < ?)"
+            params = (prefix, prefix + "/", prefix + "0")
+        with self.lock:
+            return {path: (is_dir, size, mtime_ns) for path, is_dir, size, mtime_ns in self.db.execute(query, params)}
+
+    def rescan(self, prefix=""):
+        """Bring the index in line with the disk under prefix; return (added, removed, changed) paths."""
+        with self.rescan_lock:
+            known = self.known_under(prefix)
+            added, changed, upserts = [], [], []
+            for path, is_dir, size, mtime_ns in self.walk(prefix):
+                old = known.pop(path, None)
+                if old is None:
+                    added.append(path)
+                elif old != (int(is_dir), size, mtime_ns) and not (is_dir and old[0]):
+                    changed.append(path)
+                else:
+                    continue
+                upserts.append((path, int(is_dir), size, mtime_ns))
+            removed = list(known)
+            if upserts or removed:
+                with self.lock, self.db:
+                    gen = self.next_generation()
+                    self.db.executemany(
+                        "INSERT OR REPLACE INTO entries (path, is_dir, size, mtime_ns, gen) VALUES (?, ?, ?, ?, ?)",
+                        [row + (gen,) for row in upserts])
+                    self.db.executemany("DELETE FROM removed WHERE path = ?", [(row[0],) for row in upserts])
+                    self.db.executemany("DELETE FROM entries WHERE path = ?", [(path,) for path in removed])
+                    self.db.executemany("INSERT OR REPLACE INTO removed VALUES (?, ?, ?)",
+                                        [(path, known[path][0], gen) for path in removed])
+            self.schedule_hashing()
+            if added or removed or changed:
+                logging.debug(f"Index rescan: {len(added)} added, {len(removed)} removed, {len(changed)} changed")
+            return added, removed, changed
+
+    def refresh(self, paths):
+        """Re-check only the given paths (a folder covers its subtree); None means everything."""
+        if paths is None or len(paths) > MAX_INCREMENTAL_PATHS:
+            return self.rescan()
+        added, removed, changed = [], [], []
+        for path in outermost_paths(paths):
+            a, r, c = self.rescan(path)
+            added += a
+            removed += r
+            changed += c
+        return added, removed, changed
+
+    def rescan_async(self):
+        return self.scan_pool.submit(self.rescan)
+
+    def schedule_hashing(self):
+        with self.lock:
+            rows = [row for row in self.db.execute(
+                "SELECT path, size, mtime_ns FROM entries WHERE is_dir = 0 AND hash IS NULL")
+                if row not in self.queued]
+            self.queued.update(rows)
+        return [self.hash_pool.submit(self.hash_entry, *row) for row in rows]
+
+    def hash_entry(self, path, size, mtime_ns):
+        try:
+            return self._hash_entry(path, size, mtime_ns)
+        finally:
+            with self.lock:
+                self.queued.discard((path, size, mtime_ns))
+
+    def _hash_entry(self, path, size, mtime_ns):
+        try:
+            manifest = hash_file(os.path.join(self.shared_directory, *path.split("/")))
+        except OSError as e:
+            logging.debug(f"Could not hash {path}: {str(e)}")
+            return None
+        self.store_manifest(path, manifest, size, mtime_ns)
+        return manifest
+
+    def store_manifest(self, path, manifest, size=None, mtime_ns=None):
+        chunks = b"".join(bytes.fromhex(digest) for digest in manifest["chunks"])
+        with self.lock, self.db:
+            # Only record the hash if the file still matches what was hashed.
+            updated = self.db.execute(
+                "UPDATE entries SET hash = ?, chunk_size = ?, chunks = ?, gen = ?"
+                " WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (manifest["hash"], manifest["chunk_size"], chunks, self.generation + 1, path,
+                 manifest["size"] if size is None else size,
+                 manifest["mtime_ns"] if mtime_ns is None else mtime_ns)).rowcount
+            if updated:
+                self.next_generation()
+
+    def get(self, path):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT path, is_dir, size, mtime_ns, hash FROM entries WHERE path = ?", (path,)).fetchone()
+        return self.row_to_entry(row) if row else None
+
+    def entries(self, prefix="", max_depth=None):
+        """Entries under prefix (a folder path, or "" for the whole share), in path order."""
+        query = "SELECT path, is_dir, size, mtime_ns, hash FROM entries"
+        params = ()
+        if prefix:
+            query += " WHERE path > ? AND path < ?"
+            params = (prefix + "/", prefix + "0")
+        query += " ORDER BY path"
+        with self.lock:
+            rows = self.db.execute(query, params).fetchall()
+        base_depth = prefix.count("/") + 1 if prefix else 0
+        for row in rows:
+            if max_depth is not None and row[0].count("/") - base_depth >= max_depth:
+                continue
+            yield self.row_to_entry(row)
+
+    def page(self, cursor="", limit=1000, prefix="", max_depth=None, exclude=(), since=None):
+        """One page of entries after cursor (a path) whose path starts with prefix, in path order.
+
+        max_depth counts path separators beyond those in prefix, and exclude lists
+        folders to leave out with their contents. With since, only entries changed
+        after that generation are returned, plus {"name": ..., "removed": True}
+        tombstones for paths deleted since. Returns (entries, next_cursor), with
+        next_cursor None on the last page.
+        """
+        source = "SELECT path, is_dir, size, mtime_ns, hash, 0 AS removed FROM entries"
+        params = []
+        if since is not None:
+            source = (source + " WHERE gen > ? UNION ALL"
+                      " SELECT path, is_dir, 0, 0, NULL, 1 FROM removed WHERE gen > ?")
+            params += [since, since]
+        query = f"SELECT * FROM ({source}) WHERE path > ?"
+        params.append(cursor)
+        if prefix:
+            query += " AND path >= ? AND path < ?"
+            params += [prefix, prefix + "\U0010ffff"]
+        if max_depth is not None:
+            query += " AND length(path) - length(replace(path, '/', '')) < ?"
+            params.append(prefix.count("/") + max_depth)
+        clause, exclude_params = excluding(exclude)
+        query += clause
+        params += exclude_params
+        query += " ORDER BY path LIMIT ?"
+        params.append(limit + 1)
+        with self.lock:
+            rows = self.db.execute(query, params).fetchall()
+        next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+        entries = []
+        for row in rows[:limit]:
+            entry = self.row_to_entry(row[:5])
+            if row[5]:
+                entry["removed"] = True
+            entries.append(entry)
+        return entries, next_cursor
+
+    @staticmethod
+    def row_to_entry(row):
+        path, is_dir, size, mtime_ns, content_hash = row
+        return {"name": path, "type": "folder" if is_dir else "file", "size": size,
+                "mtime_ns": mtime_ns, "hash": content_hash}
+
+    def manifest(self, path):
+        """Chunk manifest for path, hashing now only if the index has none for the current version."""
+        full_path = os.path.join(self.shared_directory, *path.split("/"))
+        st = os.stat(full_path)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT size, mtime_ns, hash, chunk_size, chunks FROM entries WHERE path = ?", (path,)).fetchone()
+        if row and row[2] and (row[0], row[1]) == (st.st_size, st.st_mtime_ns):
+            size, mtime_ns, content_hash, chunk_size, chunks = row
+            return {
+                "size": size,
+                "mtime_ns": mtime_ns,
+                "chunk_size": chunk_size,
+                "hash": content_hash,
+                "chunks": [chunks[i:i + DIGEST_SIZE].hex() for i in range(0, len(chunks), DIGEST_SIZE)],
+            }
+        manifest = hash_file(full_path, HASH_CHUNK_SIZE)
+        self.record(path, manifest)
+        return manifest
+
+    def record(self, path, manifest):
+        """Index a file whose manifest is already known, e.g. hashed while it was copied into the share."""
+        self.record_many([(path, manifest)])
+
+    def record_many(self, manifests, folders=()):
+        """record() for many (path, manifest) pairs in one transaction, indexing the folders above them too.
+
+        folders names more folders to index, e.g. empty ones made for an import.
+        """
+        paths = [path for path, _ in manifests] + [f"{folder}/" for folder in folders]
+        folders = {}
+        for path in paths:
+            parts = path.split("/")[:-1]
+            for depth in range(1, len(parts) + 1):
+                folder = "/".join(parts[:depth])
+                if folder not in folders:
+                    try:
+                        folders[folder] = os.stat(os.path.join(self.shared_directory, *parts[:depth])).st_mtime_ns
+                    except OSError:
+                        continue
+        with self.lock, self.db:
+            gen = self.next_generation()
+            self.db.executemany(
+                "INSERT OR IGNORE INTO entries (path, is_dir, size, mtime_ns, gen) VALUES (?, 1, 0, ?, ?)",
+                [(folder, mtime_ns, gen) for folder, mtime_ns in folders.items()])
+            self.db.executemany(
+                "INSERT OR REPLACE INTO entries (path, is_dir, size, mtime_ns, hash, chunk_size, chunks, gen)"
+                " VALUES (?, 0, ?, ?, ?, ?, ?, ?)",
+                [(path, manifest["size"], manifest["mtime_ns"], manifest["hash"], manifest["chunk_size"],
+                  b"".join(bytes.fromhex(digest) for digest in manifest["chunks"]), gen)
+                 for path, manifest in manifests])
+            self.db.executemany("DELETE FROM removed WHERE path = ?",
+                                [(path,) for path in folders] + [(path,) for path, _ in manifests])
+
+    def find_by_hash(self, content_hash, exclude=()):
+        """Paths of the files with this content, leaving out the folders in exclude and their contents."""
+        clause, params = excluding(exclude)
+        with self.lock:
+            return [path for path, in self.db.execute(
+                f"SELECT path FROM entries WHERE hash = ?{clause} ORDER BY path", [content_hash] + params)]
@@ -0,0 +1,147 @@
+import hashlib
+import os
+import queue
+import threading
+
+HASH_CHUNK_SIZE = 4 * 1024 * 1024
+DIGEST_SIZE = 32
+
+
+def chunk_digest(data):
+    return hashlib.blake2b(data, digest_size=DIGEST_SIZE).hexdigest()
+
+
+def content_hash(chunk_digests):
+    """Hash of a whole file, computed over its chunk digests so it never needs a second pass."""
+    h = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    for digest in chunk_digests:
+        h.update(bytes.fromhex(digest))
+    return h.hexdigest()
+
+
+def hash_file(path, chunk_size=HASH_CHUNK_SIZE, progress=None):
+    with open(path, "rb") as f:
+        st = os.fstat(f.fileno())
+        buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
+        chunks = []
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            chunks.append(chunk_digest(view[:n]))
+            if progress is not None:
+                progress.add(n)
+    return {
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "chunk_size": chunk_size,
+        "hash": content_hash(chunks),
+        "chunks": chunks,
+    }
+
+
+def data_hash(data, chunk_size=HASH_CHUNK_SIZE):
+    """content_hash of bytes already in memory, equal to hash_file's for a file holding them."""
+    view = memoryview(data)
+    return content_hash(chunk_digest(view[i:i + chunk_size]) for i in range(0, len(view), chunk_size))
+
+
+class ChunkVerifier:
+    """Chunk digests of a file computed from its bytes as they arrive, so checking it needs no second read.
+
+    feed(offset, data) is called after data has been written at offset, from any
+    number of writer threads; with background=True the hashing happens on a
+    thread of its own. A chunk is hashed from the stream only if its bytes arrive
+    in order from its first byte. Any other chunk (the earlier chunks of a resumed
+    download, a chunk split between parallel ranges) is read back from disk by check().
+    """
+
+    def __init__(self, size, chunk_size=HASH_CHUNK_SIZE, background=True, max_pending=32):
+        self.size = size
+        self.chunk_size = chunk_size
+        self.partial = {}
+        self.digests = {}
+        self.thread = None
+        if background:
+            self.queue = queue.Queue(max_pending)
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def feed(self, offset, data):
+        if self.thread is None:
+            self.absorb(offset, memoryview(data))
+        else:
+            # The caller reuses its buffer as soon as this returns.
+            self.queue.put((offset, bytes(data)))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            self.absorb(item[0], memoryview(item[1]))
+
+    def absorb(self, offset, data):
+        while data:
+            index = offset // self.chunk_size
+            chunk_start = index * self.chunk_size
+            n = min(len(data), min(chunk_start + self.chunk_size, self.size) - offset)
+            if n <= 0:
+                return
+            state = self.partial.get(index)
+            if state is None and offset == chunk_start and index not in self.digests:
+                state = self.partial[index] = [hashlib.blake2b(digest_size=DIGEST_SIZE), offset]
+            if state is not None and state[1] == offset:
+                state[0].update(data[:n])
+                state[1] += n
+                if state[1] == min(chunk_start + self.chunk_size, self.size):
+                    self.digests[index] = state[0].hexdigest()
+                    del self.partial[index]
+            else:
+                self.partial.pop(index, None)
+            offset += n
+            data = data[n:]
+
+    def close(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def check(self, manifest, path):
+        """Indices of the chunks of path that do not match manifest."""
+        self.close()
+        digests = self.digests if manifest["chunk_size"] == self.chunk_size else {}
+        bad = []
+        with open(path, "rb") as f:
+            for index, expected in enumerate(manifest["chunks"]):
+                digest = digests.get(index)
+                if digest is None:
+                    f.seek(index * manifest["chunk_size"])
+                    digest = chunk_digest(f.read(manifest["chunk_size"]))
+                if digest != expected:
+                    bad.append(index)
+        return bad
+
+    def content_hash(self):
+        """Hash of the whole file, or None if some chunk did not arrive in order."""
+        self.close()
+        count = (self.size + self.chunk_size - 1) // self.chunk_size
+        if len(self.digests) < count:
+            return None
+        return content_hash(self.digests[index] for index in range(count))
+
+
+class VerifyingWriter:
+    """Write target that hands everything written through it to a ChunkVerifier."""
+
+    def __init__(self, target, verifier, offset=0):
+        self.target = target
+        self.verifier = verifier
+        self.offset = offset
+
+    def write(self, data):
+        n = self.target.write(data)
+        self.verifier.feed(self.offset, data)
+        self.offset += len(data)
+        return n
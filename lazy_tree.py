@@ -0,0 +1,151 @@
+from collections import deque
+
+# Items inserted per after() callback; small enough that the window keeps redrawing.
+BATCH_SIZE = 500
+PLACEHOLDER_TEXT = "…"
+
+
+def sort_key(name, is_folder):
+    return (not is_folder, name.lower(), name)
+
+
+class LazyTree:
+    """Keeps a ttk.Treeview in step with a folder hierarchy without ever building all of it.
+
+    Item ids are the entries' paths ("folder/file"). A folder's children are only
+    inserted once it is opened (<<TreeviewOpen>>); until then it holds a single
+    placeholder so it still shows as expandable. refresh() compares what is shown
+    with what children() returns now and applies only the difference, and every
+    insertion goes through a queue drained batch_size items per after() callback.
+
+    children(path) returns (name, is_folder, values) for the entries directly under
+    path ("" for the top level), in any order; folders come first, then names.
+    can_open(path), if given, is asked before a folder is expanded.
+    """
+
+    def __init__(self, tree, children, can_open=None, batch_size=BATCH_SIZE):
+        self.tree = tree
+        self.children = children
+        self.can_open = can_open
+        self.batch_size = batch_size
+        self.shown = {}
+        self.loaded = set()
+        self.pending = deque()
+        self.scheduled = None
+        self.stale = None
+        tree.bind("<<TreeviewOpen>>", self.on_open, add="+")
+
+    def show(self):
+        """Drop everything and show the top level afresh."""
+        self.pending.clear()
+        self.stale = None
+        self.tree.delete(*self.tree.get_children(""))
+        self.shown.clear()
+        self.loaded = set()
+        self.load("")
+
+    def load(self, path):
+        self.loaded.add(path)
+        if path and self.tree.exists(placeholder(path)):
+            self.tree.delete(placeholder(path))
+        entries = sorted((sort_key(name, is_folder), name, is_folder, values)
+                         for name, is_folder, values in self.children(path))
+        for key, name, is_folder, values in entries:
+            self.pending.append((path, join(path, name), key, "end", name, values, is_folder))
+        self.schedule()
+
+    def unload(self, path):
+        """Forget a folder's children and close it, as if it had never been opened."""
+        if path not in self.loaded or not self.tree.exists(path):
+            return
+        self.forget_under(path)
+        self.tree.delete(*self.tree.get_children(path))
+        self.tree.insert(path, "end", iid=placeholder(path), text=PLACEHOLDER_TEXT)
+        self.tree.item(path, open=False)
+
+    def on_open(self, event=None):
+        path = self.tree.focus()
+        if not path or path in self.loaded or path.endswith("/"):
+            return
+        if self.can_open is not None and not self.can_open(path):
+            self.tree.item(path, open=False)
+            return
+        self.load(path)
+
+    def refresh(self, folders=None):
+        """Bring the shown folders (all of them, or just those in folders) up to date with children()."""
+        if self.pending:
+            # Diffing against a half-inserted folder would queue its missing items twice.
+            requested = set(self.loaded) if folders is None else set(folders)
+            self.stale = requested if self.stale is None else self.stale | requested
+            return
+        targets = set(self.loaded) if folders is None else set(folders) & self.loaded
+        for path in sorted(targets):
+            if path in self.loaded and (not path or self.tree.exists(path)):
+                self.diff(path)
+        self.schedule()
+
+    def diff(self, path):
+        wanted = {}
+        for name, is_folder, values in self.children(path):
+            wanted[join(path, name)] = (sort_key(name, is_folder), name, is_folder, values)
+        shown = [item for item in self.tree.get_children(path) if item in self.shown]
+        removed = [item for item in shown if item not in wanted or self.shown[item][0] != wanted[item][0]]
+        for item in removed:
+            self.forget_under(item)
+            del self.shown[item]
+        if removed:
+            self.tree.delete(*removed)
+        shown = set(shown) - set(removed)
+        for item in shown:
+            key, _, _, values = wanted[item]
+            if self.shown[item][1] != values:
+                self.tree.item(item, values=values)
+                self.shown[item] = (key, values)
+        # Queued in display order, each new item's final position is also where it goes
+        # in when its turn comes: everything before it is either shown or inserted already.
+        for index, (item, (key, name, is_folder, values)) in enumerate(
+                sorted(wanted.items(), key=lambda pair: pair[1][0])):
+            if item not in shown:
+                self.pending.append((path, item, key, index, name, values, is_folder))
+
+    def forget_under(self, path):
+        # Only an opened folder can have anything shown (or opened) inside it.
+        if path not in self.loaded:
+            return
+        prefix = path + "/"
+        for folder in [folder for folder in self.loaded if folder == path or folder.startswith(prefix)]:
+            self.loaded.discard(folder)
+        for item in [item for item in self.shown if item.startswith(prefix)]:
+            del self.shown[item]
+
+    def schedule(self):
+        if self.scheduled is None and self.pending:
+            self.scheduled = self.tree.after(1, self.drain)
+
+    def drain(self):
+        self.scheduled = None
+        for _ in range(self.batch_size):
+            if not self.pending:
+                break
+            parent, item, key, index, name, values, is_folder = self.pending.popleft()
+            if parent not in self.loaded or (parent and not self.tree.exists(parent)) or self.tree.exists(item):
+                continue
+            self.tree.insert(parent, index, iid=item, text=name, values=values)
+            self.shown[item] = (key, values)
+            if is_folder:
+                self.tree.insert(item, "end", iid=placeholder(item), text=PLACEHOLDER_TEXT)
+        if self.pending:
+            self.schedule()
+        elif self.stale is not None:
+            folders, self.stale = self.stale, None
+            self.refresh(folders)
+
+
+def join(path, name):
+    return f"{path}/{name}" if path else name
+
+
+def placeholder(path):
+    # No real entry has an empty name, so a trailing slash never clashes with one.
+    return path + "/"
@@ -4,16 +4,14 @@ import socket
 import os
 import threading
 import shutil
-from PIL import Image, ImageTk
-import sv_ttk
 import datetime
 import sys
 import logging
-import json
-import struct
-import time
-import select
-import zipfile
+import queue
+from file_index import is_internal
+from lazy_tree import LazyTree
+from node import Node, local_ip
+from tasks import TaskScheduler
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -26,6 +24,8 @@ class FileSharingApp(tk.Tk):
         self.resizable(True, True)
 
         # Apply Sun Valley theme
+        import sv_ttk
+
         sv_ttk.set_theme("dark")
 
         self.public_mode = True
@@ -33,16 +33,29 @@ class FileSharingApp(tk.Tk):
         self.sharing_history = []
         self.folders = {}
         self.current_folder = None
-        self.host = self.get_wifi_ip() or socket.gethostbyname(socket.gethostname())
-        self.port = 5000
-
-        # Create a directory for shared files
-        self.shared_directory = os.path.join(os.path.expanduser("~"), "SharedFiles")
-        if not os.path.exists(self.shared_directory):
-            os.makedirs(self.shared_directory)
+        # Serving, indexing and discovery live in the GUI-free node; this window is a client of it.
+        self.node = Node(folders=self.folders)
+        self.port = self.node.port
+        self.shared_directory = self.node.shared_directory
+        self.index = self.node.open_index()
+
+        self.share_changes = queue.Queue()
+        # Network and disk work runs here; results come back to the Tk thread through poll_tasks.
+        self.tasks = TaskScheduler()
+        self.transfer_rows = {}
+        self.discovered = queue.Queue()
+        # CIDR ranges to scan, e.g. ["192.168.0.0/22"]; None scans the local /24.
+        self.scan_networks = None
+        self.scanning = False
+        self.scan_results = set()
+        self.beacon_peers = set()
+        self.beacons_changed = threading.Event()
 
         self.create_widgets()
-        self.start_file_server()
+        self.start_node()
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.after(250, self.poll_share_changes)
+        self.after(250, self.poll_tasks)
 
     def create_widgets(self):
         # Main frame
@@ -53,6 +66,8 @@ class FileSharingApp(tk.Tk):
         title_frame = ttk.Frame(main_frame)
         title_frame.pack(fill=tk.X, pady=10)
 
+        from PIL import Image, ImageTk
+
         self.logo = ImageTk.PhotoImage(Image.open(self.resource_path("file-icon.png")).resize((50, 50)))
         logo_label = ttk.Label(title_frame, image=self.logo)
         logo_label.pack(side=tk.LEFT, padx=(0, 10))
@@ -85,6 +100,13 @@ class FileSharingApp(tk.Tk):
         share_file_button = ttk.Button(file_controls, text="Share File", command=self.share_file, style="Accent.TButton")
         share_file_button.pack(side=tk.LEFT, padx=5)
 
+        # Links to the file where it is instead of copying it; the original must stay put.
+        share_in_place_button = ttk.Button(file_controls, text="Share in Place", command=lambda: self.share_file(in_place=True), style="Accent.TButton")
+        share_in_place_button.pack(side=tk.LEFT, padx=5)
+
+        share_folder_button = ttk.Button(file_controls, text="Share Folder", command=self.share_folder, style="Accent.TButton")
+        share_folder_button.pack(side=tk.LEFT, padx=5)
+
         create_folder_button = ttk.Button(file_controls, text="Create Folder", command=self.create_folder, style="Accent.TButton")
         create_folder_button.pack(side=tk.LEFT, padx=5)
 
@@ -104,6 +126,9 @@ class FileSharingApp(tk.Tk):
         self.file_tree.column("Visibility", width=100, anchor="center")
         self.file_tree.pack(pady=10, fill=tk.BOTH, expand=True)
         self.file_tree.bind("<Double-1>", self.on_item_double_click)
+        self.file_tree.bind("<F5>", lambda event: self.update_file_tree(rescan=True))
+        # Item ids are paths relative to the share; folders fill in when first opened.
+        self.file_view = LazyTree(self.file_tree, self.share_children, self.can_open_folder)
 
         # Devices tab
         devices_frame = ttk.Frame(self.notebook)
@@ -148,32 +173,87 @@ class FileSharingApp(tk.Tk):
         self.history_list = tk.Listbox(history_frame, font=("Segoe UI", 12), bg="#2c2c2c", fg="white", selectbackground="#007acc")
         self.history_list.pack(pady=10, fill=tk.BOTH, expand=True)
 
-        self.update_file_tree()
+        # Transfers tab
+        transfers_frame = ttk.Frame(self.notebook)
+        self.notebook.add(transfers_frame, text="⇅ Transfers")
+
+        transfer_controls = ttk.Frame(transfers_frame)
+        transfer_controls.pack(fill=tk.X, pady=5)
+
+        cancel_button = ttk.Button(transfer_controls, text="Cancel", command=self.cancel_transfer, style="Accent.TButton")
+        cancel_button.pack(side=tk.LEFT, padx=5)
+
+        clear_button = ttk.Button(transfer_controls, text="Clear Finished", command=self.clear_transfers, style="Accent.TButton")
+        clear_button.pack(side=tk.LEFT, padx=5)
+
+        self.transfer_tree = ttk.Treeview(transfers_frame, columns=("Status", "Progress", "Rate", "ETA"), show="tree headings")
+        self.transfer_tree.heading("#0", text="Item")
+        self.transfer_tree.heading("Status", text="Status")
+        self.transfer_tree.heading("Progress", text="Progress")
+        self.transfer_tree.heading("Rate", text="MB/s")
+        self.transfer_tree.heading("ETA", text="ETA")
+        self.transfer_tree.column("Status", width=90, anchor="center")
+        self.transfer_tree.column("Progress", width=180, anchor="center")
+        self.transfer_tree.column("Rate", width=80, anchor="center")
+        self.transfer_tree.column("ETA", width=80, anchor="center")
+        self.transfer_tree.pack(pady=10, fill=tk.BOTH, expand=True)
+
+        self.file_view.show()
 
     def toggle_mode(self):
         self.public_mode = self.mode_var.get()
         self.mode_switch.config(text="Public Mode" if self.public_mode else "Private Mode")
         self.animate_mode_change()
         messagebox.showinfo("Mode Changed", f"Device is now {'Public' if self.public_mode else 'Private'}.")
+        if not self.public_mode:
+            # Private folders opened in public mode must be opened (and access checked) again.
+            for folder_name, folder in self.folders.items():
+                if not folder["public"]:
+                    self.file_view.unload(folder_name)
         self.update_file_tree()
 
-    def animate_mode_change(self):
-        for i in range(5):
-            self.mode_switch.config(text="🌞" if i % 2 == 0 else "🌙")
-            self.update()
-            self.after(100)
-        self.mode_switch.config(text="Public Mode" if self.public_mode else "Private Mode")
+    def animate_mode_change(self, step=0):
+        # One frame per after() callback, so the event loop keeps running between frames.
+        if step < 5:
+            self.mode_switch.config(text="🌞" if step % 2 == 0 else "🌙")
+            self.after(100, self.animate_mode_change, step + 1)
+        else:
+            self.mode_switch.config(text="Public Mode" if self.public_mode else "Private Mode")
 
-    def share_file(self):
-        file_path = filedialog.askopenfilename(title="Select File to Share")
-        if file_path:
-            file_name = os.path.basename(file_path)
-            dest_path = os.path.join(self.shared_directory, file_name)
-            shutil.copy2(file_path, dest_path)
-            self.sharing_history.append(f"📤 Shared file '{file_name}' at {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    def share_file(self, in_place=False):
+        files = filedialog.askopenfilenames(title="Select Files to Share")
+        if files:
+            self.import_into(files, in_place=in_place)
+
+    def share_folder(self):
+        directory = filedialog.askdirectory(title="Select Folder to Share")
+        if directory:
+            self.import_into([directory])
+
+    def import_into(self, sources, folder="", in_place=False):
+        """Share files and folders under folder on a disk task; self.folders and the tree are updated once, at the end."""
+        names = [os.path.basename(os.path.normpath(source)) for source in sources]
+        label = f"'{names[0]}'" if len(names) == 1 else f"{len(names)} items"
+        destination = f" to '{folder}'" if folder else ""
+
+        def imported(result):
+            shared, failed = result
+            if not folder:
+                for name, source in zip(names, sources):
+                    if os.path.isdir(source) and name not in self.folders:
+                        self.folders[name] = {"public": self.public_mode, "files": []}
+            self.sharing_history.append(f"📤 Shared {label}{destination} ({len(shared)} file(s)) at {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
             self.update_history()
             self.update_file_tree()
-            messagebox.showinfo("File Shared", f"File '{file_name}' has been shared successfully!")
+            if failed:
+                src, error = failed[0]
+                messagebox.showwarning("Share", f"{len(shared)} file(s) shared; {len(failed)} could not be, e.g. {src}: {str(error)}")
+            else:
+                messagebox.showinfo("Files Shared", f"{label} shared{destination} ({len(shared)} file(s))!")
+
+        self.tasks.submit(f"📤 {label}{destination}", lambda task: self.node.import_paths(sources, folder, task, in_place),
+                          kind="disk", on_done=imported,
+                          on_error=lambda e: messagebox.showerror("Share Error", f"Failed to share {label}: {str(e)}"))
 
     def create_folder(self):
         folder_name = simpledialog.askstring("Create Folder", "Enter folder name:")
@@ -198,24 +278,19 @@ class FileSharingApp(tk.Tk):
             messagebox.showwarning("Add to Folder", "Please select a folder to add files to.")
             return
 
-        folder_name = self.file_tree.item(selected[0])['text']
-        folder_path = os.path.join(self.shared_directory, folder_name)
+        folder_name = selected[0]
+        folder_path = self.share_path(folder_name)
         if not os.path.isdir(folder_path):
             messagebox.showwarning("Add to Folder", "Please select a folder, not a file.")
             return
 
-        if not self.public_mode and not self.folders[folder_name]["public"]:
+        if not self.folder_is_public(folder_name):
             if not self.check_private_access():
                 return
 
         files = filedialog.askopenfilenames(title="Select Files to Add")
         if files:
-            for file_path in files:
-                file_name = os.path.basename(file_path)
-                dest_path = os.path.join(folder_path, file_name)
-                shutil.copy2(file_path, dest_path)
-            self.update_file_tree()
-            messagebox.showinfo("Files Added", f"{len(files)} file(s) have been added to '{folder_name}'!")
+            self.import_into(files, folder_name)
 
     def toggle_folder_visibility(self):
         selected = self.file_tree.selection()
@@ -223,41 +298,83 @@ class FileSharingApp(tk.Tk):
             messagebox.showwarning("Toggle Visibility", "Please select a folder to toggle visibility.")
             return
 
-        item_name = self.file_tree.item(selected[0])['text']
-        item_path = os.path.join(self.shared_directory, item_name)
+        item_name = selected[0]
+        item_path = self.share_path(item_name)
     
-        if os.path.isdir(item_path):
+        if os.path.isdir(item_path) and "/" not in item_name:
             self.ensure_folder_tracked(item_name)
             self.folders[item_name]["public"] = not self.folders[item_name]["public"]
             visibility = "Public" if self.folders[item_name]["public"] else "Private"
             self.update_file_tree()
             messagebox.showinfo("Visibility Changed", f"Folder '{item_name}' is now {visibility}.")
         else:
-            messagebox.showwarning("Toggle Visibility", "Please select a folder, not a file.")
-
-    def update_file_tree(self):
-        logging.info(f"Updating file tree. Shared directory contents: {os.listdir(self.shared_directory)}")
-        logging.info(f"Current folders: {self.folders}")
-        self.file_tree.delete(*self.file_tree.get_children())
-        for item in os.listdir(self.shared_directory):
-            item_path = os.path.join(self.shared_directory, item)
-            if os.path.isdir(item_path):
-                self.ensure_folder_tracked(item)
-                visibility = "Public" if self.folders[item]["public"] else "Private"
-                folder_id = self.file_tree.insert("", "end", text=item, values=("Folder", visibility))
-                if self.public_mode or self.folders[item]["public"] or self.check_private_access():
-                    for file in os.listdir(item_path):
-                        self.file_tree.insert(folder_id, "end", text=file, values=("File", ""))
+            messagebox.showwarning("Toggle Visibility", "Please select a top-level folder, not a file.")
+
+    def update_file_tree(self, rescan=False):
+        # The watcher keeps the index in step with the disk; rescan only when asked or without one.
+        if rescan or self.node.watcher is None:
+            self.index.rescan_async()
+        self.file_view.refresh()
+
+    def share_path(self, rel_path):
+        return os.path.join(self.shared_directory, *rel_path.split("/"))
+
+    def folder_is_public(self, rel_path):
+        """Whether rel_path's top-level folder may be shown here without an access check."""
+        top = rel_path.split("/")[0]
+        return self.public_mode or self.folders.get(top, {"public": True})["public"]
+
+    def can_open_folder(self, rel_path):
+        return self.folder_is_public(rel_path) or self.check_private_access()
+
+    def share_children(self, rel_path):
+        """(name, is_folder, values) for the file tree, read from disk so new files show at once."""
+        children = []
+        try:
+            entries = list(os.scandir(self.share_path(rel_path) if rel_path else self.shared_directory))
+        except OSError:
+            return children
+        for entry in entries:
+            if is_internal(entry.name):
+                continue
+            try:
+                is_folder = entry.is_dir()
+            except OSError:
+                continue
+            if rel_path:
+                children.append((entry.name, is_folder, ("Folder" if is_folder else "File", "")))
+            elif is_folder:
+                self.ensure_folder_tracked(entry.name)
+                visibility = "Public" if self.folders[entry.name]["public"] else "Private"
+                children.append((entry.name, True, ("Folder", visibility)))
             else:
-                self.file_tree.insert("", "end", text=item, values=("File", "Public"))
-        logging.info("File tree updated successfully")
+                children.append((entry.name, False, ("File", "Public")))
+        return children
+
+    def on_share_changed(self, paths):
+        # Runs on the watcher thread: update the index here, hand the diff to Tk.
+        self.share_changes.put(self.index.refresh(paths))
+
+    def poll_share_changes(self):
+        try:
+            while True:
+                self.apply_share_changes(*self.share_changes.get_nowait())
+        except queue.Empty:
+            pass
+        self.after(250, self.poll_share_changes)
+
+    def apply_share_changes(self, added, removed, changed):
+        for path in removed:
+            if "/" not in path:
+                self.folders.pop(path, None)
+        # Only folders already on screen are re-read; the rest are read when opened.
+        self.file_view.refresh({path.rpartition("/")[0] for path in list(added) + list(removed)})
 
     def on_item_double_click(self, event):
         item = self.file_tree.selection()[0]
         item_type = self.file_tree.item(item, "values")[0]
         if item_type == "File":
-            file_path = os.path.join(self.shared_directory, self.file_tree.item(item, "text"))
-            os.startfile(file_path)
+            os.startfile(self.share_path(item))
 
     def delete_item(self):
         selected = self.file_tree.selection()
@@ -265,61 +382,81 @@ class FileSharingApp(tk.Tk):
             messagebox.showwarning("Delete", "Please select an item to delete.")
             return
 
-        item = selected[0]
-        item_name = self.file_tree.item(item, "text")
-        item_path = os.path.join(self.shared_directory, item_name)
+        item_name = selected[0]
+        item_path = self.share_path(item_name)
 
+        if not self.folder_is_public(item_name) and not self.check_private_access():
+            return
         if os.path.isdir(item_path):
-            if not self.public_mode and not self.folders[item_name]["public"]:
-                if not self.check_private_access():
-                    return
             if messagebox.askyesno("Delete Folder", f"Are you sure you want to delete the folder '{item_name}' and all its contents?"):
-                shutil.rmtree(item_path)
-                del self.folders[item_name]
+                def deleted(_):
+                    self.folders.pop(item_name, None)
+                    self.update_file_tree()
+
+                def delete(task):
+                    shutil.rmtree(item_path)
+                    self.node.store.collect()
+
+                self.tasks.submit(f"🗑 {item_name}", delete, kind="disk", on_done=deleted,
+                                  on_error=self.show_delete_error)
         else:
-            parent = self.file_tree.parent(item)
-            if parent:
-                folder_name = self.file_tree.item(parent, "text")
-                if not self.public_mode and not self.folders[folder_name]["public"]:
-                    if not self.check_private_access():
-                        return
             if messagebox.askyesno("Delete File", f"Are you sure you want to delete the file '{item_name}'?"):
-                os.remove(item_path)
+                def delete(task):
+                    os.remove(item_path)
+                    self.node.store.collect()
+
+                self.tasks.submit(f"🗑 {item_name}", delete, kind="disk",
+                                  on_done=lambda _: self.update_file_tree(), on_error=self.show_delete_error)
 
+    def show_delete_error(self, error):
+        messagebox.showerror("Delete", f"Failed to delete: {str(error)}")
         self.update_file_tree()
 
     def scan_network(self):
+        if self.scanning:
+            return
+        self.scanning = True
         self.devices_list.delete(0, tk.END)
         self.devices_list.insert(tk.END, "🔍 Scanning for devices...")
+        for ip in sorted(self.beacon_peers):
+            self.devices_list.insert(tk.END, f"💻 {ip}")
     
-        def scan():
+        def run_scan():
+            try:
+                self.node.scan(self.scan_networks, self.discovered.put)
+            except Exception as e:
+                logging.error(f"Network scan failed: {str(e)}")
+            finally:
+                self.discovered.put(None)
+
+        # Only the Tk thread touches the list: the scanner queues what it finds and
+        # poll_discovered adds it in batches.
+        self.scan_results = set()
+        threading.Thread(target=run_scan, daemon=True).start()
+        self.after(100, self.poll_discovered)
+
+    def poll_discovered(self):
+        found, finished = [], False
+        try:
+            while True:
+                ip = self.discovered.get_nowait()
+                if ip is None:
+                    finished = True
+                    break
+                found.append(ip)
+        except queue.Empty:
+            pass
+        for ip in found:
+            if ip not in self.scan_results:
+                self.scan_results.add(ip)
+                self.add_device(ip)
+        if not finished:
+            self.after(100, self.poll_discovered)
+            return
+        self.scanning = False
+        if self.devices_list.get(0, tk.END) == ("🔍 Scanning for devices...",):
             self.devices_list.delete(0, tk.END)
-            host = self.get_wifi_ip() or socket.gethostbyname(socket.gethostname())
-            subnet = ".".join(host.split(".")[:-1])
-            
-            def check_ip(ip):
-                try:
-                    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                        s.settimeout(0.1)
-                        s.connect((ip, self.port))
-                        self.devices_list.insert(tk.END, f"💻 {ip}")
-                except:
-                    pass
-
-            threads = []
-            for i in range(1, 255):
-                ip = f"{subnet}.{i}"
-                thread = threading.Thread(target=check_ip, args=(ip,))
-                thread.start()
-                threads.append(thread)
-
-            for thread in threads:
-                thread.join()
-
-            if self.devices_list.size() == 0:
-                self.devices_list.insert(tk.END, "No devices found")
-
-        threading.Thread(target=scan).start()
+            self.devices_list.insert(tk.END, "No devices found")
 
     def add_private_device(self):
         device_ip = self.device_ip_entry.get()
@@ -352,69 +489,83 @@ class FileSharingApp(tk.Tk):
 
         return os.path.join(base_path, relative_path)
 
-    def share_file_list(self):
-        file_list = []
-        for item in os.listdir(self.shared_directory):
-            item_path = os.path.join(self.shared_directory, item)
-            if os.path.isdir(item_path):
-                if self.folders[item]["public"]:
-                    file_list.append({"name": item, "type": "folder", "public": True})
-                    for file in os.listdir(item_path):
-                        file_list.append({"name": f"{item}/{file}", "type": "file", "public": True})
-            else:
-                file_list.append({"name": item, "type": "file", "public": True})
-        
-        return json.dumps(file_list)
-
     def request_file_list(self, ip):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            try:
-                s.settimeout(5)  # Set a timeout of 5 seconds
-                s.connect((ip, self.port))
-                s.sendall(b"REQUEST_FILE_LIST")
-                data = s.recv(4096)
-                return json.loads(data.decode())
-            except socket.timeout:
-                logging.error(f"Connection to {ip} timed out")
-                return None
-            except Exception as e:
-                logging.error(f"Error requesting file list from {ip}: {str(e)}")
-                return None
-
-    def start_file_server(self):
-        def serve():
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.bind((self.host, self.port))
-                s.listen()
-                logging.info(f"File server started on {self.host}:{self.port}")
-                while True:
-                    conn, addr = s.accept()
-                    logging.info(f"Accepted connection from {addr}")
-                    with conn:
-                        try:
-                            data = conn.recv(1024)
-                            if data == b"REQUEST_FILE_LIST":
-                                file_list = self.share_file_list()
-                                conn.sendall(file_list.encode())
-                            elif data.startswith(b"DOWNLOAD:"):
-                                item_name = data[9:].decode()
-                                self.handle_download(conn, item_name)
-                            elif data == b"TEST_CONNECTION":
-                                conn.sendall(b"CONNECTION_OK")
-                        except Exception as e:
-                            logging.error(f"Error handling connection from {addr}: {str(e)}")
-
-        threading.Thread(target=serve, daemon=True).start()
+        try:
+            # Folders and their direct children, as the remote tree shows them.
+            return self.node.list_files(ip, depth=2)
+        except socket.timeout:
+            logging.error(f"Connection to {ip} timed out")
+            return None
+        except Exception as e:
+            logging.error(f"Error requesting file list from {ip}: {str(e)}")
+            return None
+
+    def start_node(self):
+        if self.node.start(on_share_changed=self.on_share_changed, on_peers_changed=self.beacons_changed.set):
+            self.after(250, self.poll_beacons)
+        else:
+            self.scan_network()
+
+    def poll_beacons(self):
+        if self.beacons_changed.is_set():
+            self.beacons_changed.clear()
+            live = set(self.node.live_peers())
+            for ip in self.beacon_peers - live:
+                if ip not in self.scan_results:
+                    self.remove_device(ip)
+            for ip in live - self.beacon_peers:
+                self.add_device(ip)
+            self.beacon_peers = live
+        self.after(250, self.poll_beacons)
+
+    def add_device(self, ip):
+        entries = list(self.devices_list.get(0, tk.END))
+        # Drop the "Scanning..." / "No devices found" placeholders.
+        for i in reversed(range(len(entries))):
+            if not entries[i].startswith("💻"):
+                self.devices_list.delete(i)
+        if f"💻 {ip}" not in entries:
+            self.devices_list.insert(tk.END, f"💻 {ip}")
+
+    def remove_device(self, ip):
+        entries = list(self.devices_list.get(0, tk.END))
+        if f"💻 {ip}" in entries:
+            self.devices_list.delete(entries.index(f"💻 {ip}"))
+
+    def on_close(self):
+        self.tasks.shutdown()
+        self.node.stop()
+        self.destroy()
 
     def on_device_select(self, event):
         selected_indices = self.devices_list.curselection()
         if selected_indices:
             selected_ip = self.devices_list.get(selected_indices[0]).split()[-1]
-            file_list = self.request_file_list(selected_ip)
-            if file_list:
-                self.display_remote_files(file_list, selected_ip)
-            else:
-                messagebox.showerror("Error", f"Unable to retrieve file list from {selected_ip}")
+            cached = self.node.file_lists.get(selected_ip, depth=2)
+            if cached is not None:
+                # Show what we already know straight away and fetch only the changes behind it,
+                # unless the peer's beacon says its share has not changed since.
+                view = self.display_remote_files(cached, selected_ip)
+                generation = self.node.beacon_generation(selected_ip)
+                if generation is not None and generation == self.node.file_lists.generation(selected_ip, depth=2):
+                    return
+                self.tasks.submit(f"File list from {selected_ip}", lambda task: self.request_file_list(selected_ip),
+                                  on_done=lambda file_list: self.refresh_remote_files(view, file_list, cached))
+                return
+
+            def show(file_list):
+                if file_list:
+                    self.display_remote_files(file_list, selected_ip)
+                else:
+                    messagebox.showerror("Error", f"Unable to retrieve file list from {selected_ip}")
+
+            self.tasks.submit(f"File list from {selected_ip}", lambda task: self.request_file_list(selected_ip),
+                              on_done=show)
+
+    def refresh_remote_files(self, view, file_list, shown):
+        if file_list is not None and file_list != shown and view.tree.winfo_exists():
+            view.children = self.remote_children(file_list)
+            view.refresh()
 
     def display_remote_files(self, file_list, remote_ip):
         remote_files_window = tk.Toplevel(self)
@@ -427,20 +578,34 @@ class FileSharingApp(tk.Tk):
         remote_files_tree.column("Type", width=100, anchor="center")
         remote_files_tree.column("Visibility", width=100, anchor="center")
         remote_files_tree.pack(pady=10, fill=tk.BOTH, expand=True)
+        view = LazyTree(remote_files_tree, self.remote_children(file_list))
+        view.show()
+
+        download_button = ttk.Button(remote_files_window, text="Download Selected", command=lambda: self.download_selected(remote_files_tree, remote_ip))
+        download_button.pack(pady=10)
+        return view
+
+    @staticmethod
+    def remote_children(file_list):
+        """A LazyTree children() over a peer's file list, with one node per folder however many files it holds."""
+        children = {"": {}}
+
+        def folder(path):
+            # Files can arrive before (or without) their folder's own entry.
+            if path not in children:
+                parent, _, name = path.rpartition("/")
+                folder(parent).setdefault(name, (name, True, ("Folder", "Public")))
+                children[path] = {}
+            return children[path]
 
         for item in file_list:
+            parent, _, name = item["name"].rpartition("/")
             if item["type"] == "folder":
-                folder_id = remote_files_tree.insert("", "end", text=item["name"], values=("Folder", "Public" if item["public"] else "Private"))
+                folder(item["name"])
+                folder(parent)[name] = (name, True, ("Folder", "Public" if item.get("public", True) else "Private"))
             else:
-                if "/" in item["name"]:
-                    folder, file = item["name"].split("/", 1)
-                    folder_id = remote_files_tree.insert("", "end", text=folder, values=("Folder", "Public"))
-                    remote_files_tree.insert(folder_id, "end", text=file, values=("File", "Public"))
-                else:
-                    remote_files_tree.insert("", "end", text=item["name"], values=("File", "Public"))
-
-        download_button = ttk.Button(remote_files_window, text="Download Selected", command=lambda: self.download_selected(remote_files_tree, remote_ip))
-        download_button.pack(pady=10)
+                folder(parent)[name] = (name, False, ("File", "Public"))
+        return lambda path: list(children.get(path, {}).values())
 
     def download_selected(self, tree, remote_ip):
         selected_items = tree.selection()
@@ -452,84 +617,96 @@ class FileSharingApp(tk.Tk):
         if not save_path:
             return
 
+        # Small files travel together in one batch; folders and large files keep their own transfers.
+        sizes = {entry["name"]: entry["size"] for entry in self.node.file_lists.get(remote_ip, depth=2) or []}
+        small_files = []
+        small_total = 0
         for item in selected_items:
-            item_text = tree.item(item, "text")
+            # Item ids are the paths the peer shares them under.
             item_type = tree.item(item, "values")[0]
-            self.request_download(remote_ip, item_text, item_type, save_path)
+            threshold = self.node.parallel_threshold
+            if item_type == "File" and sizes.get(item, threshold) < threshold:
+                small_files.append(item)
+                small_total += sizes[item]
+            else:
+                self.request_download(remote_ip, item, item_type, save_path)
+        if small_files:
+            self.request_small_downloads(remote_ip, small_files, save_path, small_total)
+
+    def known_peers(self):
+        return [entry.split()[-1] for entry in self.devices_list.get(0, tk.END) if entry.startswith("💻")]
 
     def request_download(self, remote_ip, item_name, item_type, save_path):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            try:
-                s.settimeout(10)  # Set a timeout of 10 seconds
-                s.connect((remote_ip, self.port))
-                s.sendall(f"DOWNLOAD:{item_name}".encode())
-                
-                file_size = struct.unpack("!Q", s.recv(8))[0]
-                received_size = 0
-                
-                if item_type == "Folder":
-                    zip_path = os.path.join(save_path, f"{item_name}.zip")
-                    with open(zip_path, "wb") as f:
-                        while received_size < file_size:
-                            chunk = s.recv(4096)
-                            if not chunk:
-                                break
-                            f.write(chunk)
-                            received_size += len(chunk)
-                    
-                    # Extract the zip file
-                    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                        zip_ref.extractall(save_path)
-                    os.remove(zip_path)
-                else:
-                    file_path = os.path.join(save_path, item_name)
-                    with open(file_path, "wb") as f:
-                        while received_size < file_size:
-                            chunk = s.recv(4096)
-                            if not chunk:
-                                break
-                            f.write(chunk)
-                            received_size += len(chunk)
-                
-                messagebox.showinfo("Download Complete", f"{item_name} has been downloaded successfully.")
-            except socket.timeout:
-                messagebox.showerror("Download Error", f"Connection to {remote_ip} timed out")
-            except Exception as e:
-                messagebox.showerror("Download Error", f"Failed to download {item_name}: {str(e)}")
+        peers = self.known_peers() if self.node.swarm_downloads else []
+
+        def download(task):
+            # Downloads land at save_path/<path as shared>, so make room for any parent folders.
+            os.makedirs(os.path.dirname(os.path.join(save_path, item_name)), exist_ok=True)
+            self.node.download(remote_ip, item_name, item_type, save_path, peers, progress=task)
+
+        # A cancelled download keeps its .part file, so requesting it again resumes it.
+        self.tasks.submit(f"⬇ {item_name} ({remote_ip})", download, kind="transfer",
+                          on_done=lambda _: self.record_download(f"{item_name} from {remote_ip}"),
+                          on_error=lambda e: self.show_download_error(remote_ip, item_name, e))
+
+    def request_small_downloads(self, remote_ip, item_names, save_path, total_size=None):
+        def download(task):
+            if total_size:
+                task.set_total(total_size)
+            return self.node.download_small(remote_ip, item_names, save_path, progress=task)
+
+        def downloaded(missing):
+            if missing:
+                messagebox.showwarning("Download Incomplete", f"{remote_ip} could not send: {', '.join(missing)}")
+            self.record_download(f"{len(item_names) - len(missing)} files from {remote_ip}")
+
+        self.tasks.submit(f"⬇ {len(item_names)} files ({remote_ip})", download, kind="transfer", on_done=downloaded,
+                          on_error=lambda e: self.show_download_error(remote_ip, "files", e))
+
+    def record_download(self, description):
+        self.sharing_history.append(f"📥 Downloaded {description} at {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+        self.update_history()
+
+    def show_download_error(self, remote_ip, item_name, error):
+        if isinstance(error, socket.timeout):
+            messagebox.showerror("Download Error", f"Connection to {remote_ip} timed out")
+        else:
+            messagebox.showerror("Download Error", f"Failed to download {item_name}: {str(error)}")
 
-    def handle_download(self, conn, item_name):
-        item_path = os.path.join(self.shared_directory, item_name)
-        if os.path.isdir(item_path):
-            # Create a temporary zip file
-            zip_path = os.path.join(self.shared_directory, f"{item_name}.zip")
-            with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                for root, _, files in os.walk(item_path):
-                    for file in files:
-                        file_path = os.path.join(root, file)
-                        arcname = os.path.relpath(file_path, item_path)
-                        zipf.write(file_path, arcname)
-            
-            file_size = os.path.getsize(zip_path)
-            conn.sendall(struct.pack("!Q", file_size))
-            
-            with open(zip_path, "rb") as f:
-                while True:
-                    chunk = f.read(4096)
-                    if not chunk:
-                        break
-                    conn.sendall(chunk)
-            
-            os.remove(zip_path)
+    def poll_tasks(self):
+        for task in self.tasks.poll():
+            if task.kind in ("transfer", "disk"):
+                self.show_transfer(task)
+        self.after(250, self.poll_tasks)
+
+    def show_transfer(self, task):
+        if task.total:
+            progress = f"{task.done / task.total:.0%} of {task.total / 1e6:.1f} MB"
         else:
-            file_size = os.path.getsize(item_path)
-            conn.sendall(struct.pack("!Q", file_size))
-            
-            with open(item_path, "rb") as f:
-                while True:
-                    chunk = f.read(4096)
-                    if not chunk:
-                        break
-                    conn.sendall(chunk)
+            progress = f"{task.done / 1e6:.1f} MB"
+        running = task.state == "running"
+        rate = f"{task.rate() / 1e6:.1f}" if running else ""
+        eta = task.eta()
+        eta = f"{int(eta) // 60}:{int(eta) % 60:02d}" if eta is not None else ""
+        values = (task.state.capitalize(), progress, rate, eta)
+        row = self.transfer_rows.get(task.id)
+        if row is None:
+            self.transfer_rows[task.id] = self.transfer_tree.insert("", "end", text=task.title, values=values)
+        elif self.transfer_tree.exists(row):
+            self.transfer_tree.item(row, values=values)
+
+    def cancel_transfer(self):
+        for task_id, row in self.transfer_rows.items():
+            if row in self.transfer_tree.selection():
+                self.tasks.cancel(task_id)
+
+    def clear_transfers(self):
+        for task_id, row in list(self.transfer_rows.items()):
+            task = self.tasks.tasks.get(task_id)
+            if task is None or task.state in ("done", "failed", "cancelled"):
+                self.transfer_tree.delete(row)
+                del self.transfer_rows[task_id]
+                self.tasks.forget(task_id)
 
     def add_manual_device(self):
         ip = simpledialog.askstring("Add Device", "Enter the IP address of the device:")
@@ -537,53 +714,27 @@ class FileSharingApp(tk.Tk):
             self.devices_list.insert(tk.END, f"💻 {ip}")
             messagebox.showinfo("Device Added", f"Device with IP {ip} has been added to the list.")
 
-    def get_wifi_ip(self):
-        import subprocess
-        import re
-
-        try:
-            # For Windows
-            if os.name == 'nt':
-                output = subprocess.check_output(['ipconfig']).decode('utf-8')
-                wifi_section = re.search(r'Wireless LAN adapter WiFi:(.*?)(\n\n|\Z)', output, re.DOTALL)
-                if wifi_section:
-                    ip_match = re.search(r'IPv4 Address[.\s]+: ([^\s]+)', wifi_section.group(1))
-                    if ip_match:
-                        return ip_match.group(1)
-            # For Unix-based systems (Linux, macOS)
-            else:
-                output = subprocess.check_output(['ifconfig']).decode('utf-8')
-                wifi_section = re.search(r'(wlan0|en0):(.*?)(\n\n|\Z)', output, re.DOTALL)
-                if wifi_section:
-                    ip_match = re.search(r'inet\s+(\d+\.\d+\.\d+\.\d+)', wifi_section.group(2))
-                    if ip_match:
-                        return ip_match.group(1)
-        except Exception as e:
-            logging.error(f"Error getting Wi-Fi IP: {e}")
-    
-        return None
-
     def show_current_ip(self):
-        ip = self.get_wifi_ip() or socket.gethostbyname(socket.gethostname())
+        ip = local_ip()
         messagebox.showinfo("Current IP", f"Your current IP address is: {ip}")
 
     def test_connection(self):
         ip = simpledialog.askstring("Test Connection", "Enter the IP address to test:")
         if ip:
-            try:
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                    s.settimeout(5)
-                    s.connect((ip, self.port))
-                    s.sendall(b"TEST_CONNECTION")
-                    response = s.recv(1024)
-                    if response == b"CONNECTION_OK":
-                        messagebox.showinfo("Connection Test", f"Successfully connected to {ip}")
-                    else:
-                        messagebox.showerror("Connection Test", f"Received unexpected response from {ip}")
-            except socket.timeout:
-                messagebox.showerror("Connection Test", f"Connection to {ip} timed out")
-            except Exception as e:
-                messagebox.showerror("Connection Test", f"Failed to connect to {ip}: {str(e)}")
+            def tested(ok):
+                if ok:
+                    messagebox.showinfo("Connection Test", f"Successfully connected to {ip}")
+                else:
+                    messagebox.showerror("Connection Test", f"Received unexpected response from {ip}")
+
+            def failed(error):
+                if isinstance(error, socket.timeout):
+                    messagebox.showerror("Connection Test", f"Connection to {ip} timed out")
+                else:
+                    messagebox.showerror("Connection Test", f"Failed to connect to {ip}: {str(error)}")
+
+            self.tasks.submit(f"Test connection to {ip}", lambda task: self.node.test_connection(ip),
+                              on_done=tested, on_error=failed)
 
 if __name__ == "__main__":
     app = FileSharingApp()
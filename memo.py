@@ -0,0 +1,205 @@
+"""Headless MEMO: run a seed node or talk to peers without the GUI.
+
+    python -m memo serve [--share DIR] [--port 5000] [--metrics] [--metrics-port 9464]
+    python -m memo peers
+    python -m memo ls <peer> [folder]
+    python -m memo get <peer> <path> [--dest DIR]
+    python -m memo add <file or folder>... [--to FOLDER] [--in-place]
+    python -m memo stats <peer>
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from discovery import BEACON_INTERVAL
+from metrics import Metrics
+from networking import request_stats
+from node import DEFAULT_PORT, IMPORT_WORKERS, Node, default_shared_directory
+from ratelimit import RateLimiter, parse_rate, parse_schedule
+
+
+class ConsoleProgress:
+    """Progress sink for downloads that redraws one status line on stderr."""
+
+    def __init__(self, label, interval=0.5):
+        self.label = label
+        self.interval = interval
+        self.total = None
+        self.done = 0
+        self.started = time.monotonic()
+        self.last_draw = 0
+        self.lock = threading.Lock()
+
+    def set_total(self, total):
+        self.total = total
+        self.draw(force=True)
+
+    def add(self, count):
+        with self.lock:
+            self.done += count
+        self.draw()
+
+    def draw(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.last_draw < self.interval:
+            return
+        self.last_draw = now
+        rate = self.done / max(now - self.started, 1e-6) / 1e6
+        status = f"{self.done / 1e6:.1f}/{self.total / 1e6:.1f} MB" if self.total else f"{self.done / 1e6:.1f} MB"
+        sys.stderr.write(f"\r{self.label}: {status} ({rate:.1f} MB/s)")
+        sys.stderr.flush()
+
+    def finish(self):
+        self.draw(force=True)
+        sys.stderr.write("\n")
+
+
+def serve(args):
+    limiter = RateLimiter(parse_rate(args.limit), parse_rate(args.peer_limit), parse_schedule(args.schedule))
+    metrics = Metrics() if args.metrics or args.metrics_port is not None else None
+    node = Node(args.share, args.host, args.port, upload_limiter=limiter, metrics=metrics)
+    node.start(beacons=not args.no_beacons)
+    if args.metrics_port is not None:
+        metrics.serve_http(port=args.metrics_port)
+    logging.info(f"Serving {node.shared_directory} on {node.host}:{node.port}; Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        node.stop()
+
+
+def peers(args):
+    node = Node(host=args.host or "0.0.0.0", port=args.port)
+    # Only listen: announcing would add this short-lived process to every peer's table.
+    if not node.start_beacons(announce=False):
+        return 1
+    time.sleep(args.wait)
+    for ip in node.live_peers():
+        print(ip)
+    node.stop()
+    return 0
+
+
+def ls(args):
+    node = Node(host=args.host or "0.0.0.0", port=args.port)
+    # A trailing slash limits the listing to what is inside the folder, not its siblings.
+    prefix = args.path.strip("/") + "/" if args.path.strip("/") else ""
+    for entry in node.list_files(args.peer, prefix, depth=None if args.recursive else 1):
+        if entry["type"] == "folder":
+            print(f"{'':>12}  {entry['name']}/")
+        else:
+            print(f"{entry['size']:>12}  {entry['name']}")
+    return 0
+
+
+def get(args):
+    node = Node(host=args.host or "0.0.0.0", port=args.port, download_streams=args.streams,
+                download_limiter=RateLimiter(parse_rate(args.limit)), verify_downloads=not args.no_verify)
+    entry = node.find(args.peer, args.path)
+    if entry is None:
+        logging.error(f"{args.peer} does not share {args.path}")
+        return 1
+    item_name = entry["name"]
+    # Downloads land at dest/<path as shared>, so make room for any parent folders.
+    os.makedirs(os.path.dirname(os.path.join(args.dest, item_name)), exist_ok=True)
+    progress = ConsoleProgress(item_name)
+    try:
+        node.download(args.peer, item_name, "Folder" if entry["type"] == "folder" else "File", args.dest,
+                      peers=[], progress=progress)
+    finally:
+        progress.finish()
+    return 0
+
+
+def add(args):
+    node = Node(args.share, host=args.host or "0.0.0.0", port=args.port)
+    progress = ConsoleProgress(f"Adding to {args.to.strip('/') or 'the share'}")
+    try:
+        shared, failed = node.import_paths(args.files, args.to, progress, in_place=args.in_place,
+                                           workers=args.workers)
+    finally:
+        progress.finish()
+        if node.index is not None:
+            node.index.close()
+    logging.info(f"Shared {len(shared)} file(s)" + (f"; {len(failed)} failed" if failed else ""))
+    return 1 if failed else 0
+
+
+def stats(args):
+    print(json.dumps(request_stats(args.peer, args.port), indent=2, sort_keys=True))
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="memo", description="MEMO file sharing without the GUI")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--host", help="address to bind and announce (default: this machine's LAN address)")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    serve_parser = commands.add_parser("serve", help="share a directory until interrupted")
+    serve_parser.add_argument("--share", default=default_shared_directory())
+    serve_parser.add_argument("--no-beacons", action="store_true", help="do not announce this node over UDP")
+    serve_parser.add_argument("--limit", help="upload cap for all peers together, e.g. 5M (bytes/s)")
+    serve_parser.add_argument("--peer-limit", help="upload cap for each peer, e.g. 1M")
+    serve_parser.add_argument("--schedule", help="caps by time of day replacing --limit, e.g. 08:00-18:00=2M")
+    serve_parser.add_argument("--metrics", action="store_true",
+                              help="keep transfer metrics, answered to peers' STATS requests")
+    serve_parser.add_argument("--metrics-port", type=int,
+                              help="also serve metrics as Prometheus text on http://127.0.0.1:PORT/metrics")
+    serve_parser.set_defaults(run=serve)
+
+    peers_parser = commands.add_parser("peers", help="list peers announcing themselves on the network")
+    peers_parser.add_argument("--wait", type=float, default=BEACON_INTERVAL + 0.5,
+                              help="seconds to listen for beacons")
+    peers_parser.set_defaults(run=peers)
+
+    ls_parser = commands.add_parser("ls", help="list what a peer shares")
+    ls_parser.add_argument("peer")
+    ls_parser.add_argument("path", nargs="?", default="")
+    ls_parser.add_argument("-r", "--recursive", action="store_true")
+    ls_parser.set_defaults(run=ls)
+
+    get_parser = commands.add_parser("get", help="download a file or folder from a peer")
+    get_parser.add_argument("peer")
+    get_parser.add_argument("path")
+    get_parser.add_argument("--dest", default=".")
+    get_parser.add_argument("--streams", type=int, default=4)
+    get_parser.add_argument("--limit", help="download cap, e.g. 5M (bytes/s)")
+    get_parser.add_argument("--no-verify", action="store_true",
+                            help="skip checking the download against the peer's content hashes")
+    get_parser.set_defaults(run=get)
+
+    add_parser = commands.add_parser("add", help="share files and folders, stored once however many folders hold them")
+    add_parser.add_argument("files", nargs="+", help="files, or folders to share with everything in them")
+    add_parser.add_argument("--share", default=default_shared_directory())
+    add_parser.add_argument("--to", default="", help="folder in the share to put the files in")
+    add_parser.add_argument("--in-place", action="store_true",
+                            help="link to the files where they are instead of copying them")
+    add_parser.add_argument("--workers", type=int, default=IMPORT_WORKERS, help="files copied at once")
+    add_parser.set_defaults(run=add)
+
+    stats_parser = commands.add_parser("stats", help="show a peer's load and transfer metrics")
+    stats_parser.add_argument("peer")
+    stats_parser.set_defaults(run=stats)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    try:
+        return args.run(args)
+    except (ConnectionError, OSError) as e:
+        logging.error(f"{args.command} failed: {str(e)}")
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,275 @@
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Bucket upper bounds for histograms: seconds for durations, bytes/s for throughput.
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+RATE_BUCKETS = tuple(2 ** 20 * mib for mib in (0.1, 0.5, 1, 5, 10, 25, 50, 100, 250, 500, 1000))
+
+HELP = {
+    "memo_connections_total": "Connections accepted by the file server.",
+    "memo_uploads_active": "Requests being answered right now, queued transfers included.",
+    "memo_downloads_active": "Downloads in progress.",
+    "memo_transfers_queued": "Transfers waiting for a transfer worker.",
+    "memo_transfers_active": "Transfers being sent.",
+    "memo_sessions_active": "Open multiplexed sessions.",
+    "memo_transfer_queue_wait_seconds": "Time transfers waited for a worker.",
+    "memo_upload_bytes_total": "Bytes sent in reply to requests, by command.",
+    "memo_upload_seconds": "Time from reading a request to closing its reply, by command.",
+    "memo_upload_first_byte_seconds": "Time from reading a request to sending the first byte of the reply.",
+    "memo_upload_throughput_bytes_per_second": "Throughput of each transfer sent.",
+    "memo_download_bytes_total": "Payload bytes received.",
+    "memo_download_seconds": "Time to receive one download.",
+    "memo_download_first_byte_seconds": "Time from starting a download to its first byte.",
+    "memo_download_throughput_bytes_per_second": "Throughput of each download.",
+    "memo_upload_errors_total": "Replies that could not be sent.",
+    "memo_download_errors_total": "Downloads that failed or were cancelled.",
+    "memo_file_list_seconds": "Time to bring one peer's file list up to date.",
+    "memo_scan_seconds": "Time taken by one TCP network scan.",
+    "memo_scan_peers_found_total": "Peers found by TCP network scans.",
+}
+
+
+class Metrics:
+    """Counters, gauges and histograms for one node, read through snapshot() or as Prometheus text.
+
+    Instrumented code holds either a Metrics or None and checks before doing
+    anything, so a node without metrics pays one comparison per event. Gauges
+    that already exist as state elsewhere (queue lengths, active transfers) are
+    registered as functions and only read when someone asks.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.gauge_functions = {}
+        self.histograms = {}
+        self.http_server = None
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def add(self, name, delta, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + delta
+
+    def gauge(self, name, function):
+        self.gauge_functions[name] = function
+
+    def observe(self, name, value, buckets=TIME_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def transfer(self, direction, **labels):
+        """A Transfer that records one upload or download under these labels when it finishes."""
+        return Transfer(self, direction, labels)
+
+    def snapshot(self):
+        """Every metric as {name: {"type": ..., "samples": [[labels, value], ...]}}; histograms give a dict."""
+        result = {}
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                result.setdefault(name, {"type": "counter", "samples": []})["samples"].append([dict(labels), value])
+            for (name, labels), value in self.gauges.items():
+                result.setdefault(name, {"type": "gauge", "samples": []})["samples"].append([dict(labels), value])
+            for (name, labels), histogram in self.histograms.items():
+                result.setdefault(name, {"type": "histogram", "samples": []})["samples"].append(
+                    [dict(labels), histogram.to_dict()])
+        for name, function in list(self.gauge_functions.items()):
+            try:
+                result[name] = {"type": "gauge", "samples": [[{}, function()]]}
+            except Exception as e:
+                logging.debug(f"Gauge {name} failed: {str(e)}")
+        return result
+
+    def prometheus_text(self):
+        lines = []
+        for name, metric in sorted(self.snapshot().items()):
+            if name in HELP:
+                lines.append(f"# HELP {name} {HELP[name]}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            for labels, value in metric["samples"]:
+                if metric["type"] != "histogram":
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+                    continue
+                for bound, count in value["buckets"]:
+                    lines.append(f"{name}_bucket{format_labels(dict(labels, le=bound))} {count}")
+                lines.append(f"{name}_sum{format_labels(labels)} {value['sum']}")
+                lines.append(f"{name}_count{format_labels(labels)} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+    def serve_http(self, host="127.0.0.1", port=9464):
+        """Serve prometheus_text() at http://host:port/metrics from a daemon thread; returns the bound port."""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus_text().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.http_server = ThreadingHTTPServer((host, port), Handler)
+        self.http_server.daemon_threads = True
+        threading.Thread(target=self.http_server.serve_forever, daemon=True).start()
+        logging.info(f"Metrics at http://{host}:{self.http_server.server_address[1]}/metrics")
+        return self.http_server.server_address[1]
+
+    def close(self):
+        if self.http_server is not None:
+            self.http_server.shutdown()
+            self.http_server.server_close()
+            self.http_server = None
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self):
+        cumulative = []
+        running = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            running += count
+            cumulative.append([bound, running])
+        return {"count": self.count, "sum": self.sum, "buckets": cumulative}
+
+
+class Transfer:
+    """Times one transfer: bytes, duration, time to first byte and throughput.
+
+    Stands in for a connection (sendall/sendfile, for uploads) or a progress
+    object (set_total/add, for downloads), counting what passes through to
+    target. Parallel range workers share one, so counting takes a lock. Call
+    finish() once, with the error if the transfer failed.
+    """
+
+    def __init__(self, metrics, direction, labels, target=None):
+        self.metrics = metrics
+        self.direction = direction
+        self.labels = labels
+        self.target = target
+        self.started = time.perf_counter()
+        self.first_byte = None
+        self.bytes = 0
+        self.finished = False
+        self.lock = threading.Lock()
+        metrics.add(f"memo_{direction}s_active", 1)
+
+    def wrap(self, target):
+        self.target = target
+        return self
+
+    def count(self, n):
+        with self.lock:
+            if self.first_byte is None and n:
+                self.first_byte = time.perf_counter()
+            self.bytes += n
+
+    def sendall(self, data):
+        self.target.sendall(data)
+        self.count(memoryview(data).nbytes)
+
+    def sendfile(self, f, offset=0, count=None):
+        sent = self.target.sendfile(f, offset, count)
+        self.count(sent)
+        return sent
+
+    def set_total(self, total):
+        if self.target is not None:
+            self.target.set_total(total)
+
+    def add(self, n):
+        self.count(n)
+        if self.target is not None:
+            self.target.add(n)
+
+    def finish(self, error=None):
+        with self.lock:
+            if self.finished:
+                return
+            self.finished = True
+        prefix = f"memo_{self.direction}"
+        self.metrics.add(f"{prefix}s_active", -1)
+        if error is not None:
+            self.metrics.inc(f"{prefix}_errors_total", **self.labels)
+        elapsed = time.perf_counter() - self.started
+        self.metrics.inc(f"{prefix}_bytes_total", self.bytes, **self.labels)
+        self.metrics.observe(f"{prefix}_seconds", elapsed, **self.labels)
+        if self.first_byte is not None:
+            self.metrics.observe(f"{prefix}_first_byte_seconds", self.first_byte - self.started, **self.labels)
+        if self.bytes and elapsed > 0:
+            self.metrics.observe(f"{prefix}_throughput_bytes_per_second", self.bytes / elapsed, RATE_BUCKETS,
+                                 **self.labels)
+
+    def close(self):
+        self.finish()
+        self.target.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __getattr__(self, name):
+        return getattr(self.target, name)
+
+
+def failed(conn, error):
+    """Record that the reply on conn failed, if conn is a Transfer; plain connections are left alone."""
+    if isinstance(conn, Transfer):
+        conn.finish(error)
+
+
+@contextmanager
+def measure(metrics, direction, progress=None, **labels):
+    """Yield progress, wrapped in a Transfer recorded in metrics when the block ends; metrics may be None."""
+    if metrics is None:
+        yield progress
+        return
+    transfer = metrics.transfer(direction, **labels).wrap(progress)
+    try:
+        yield transfer
+    except BaseException as e:
+        transfer.finish(e)
+        raise
+    transfer.finish()
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in sorted(labels.items())) + "}"
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
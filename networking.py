@@ -0,0 +1,764 @@
+import socket
+import os
+import threading
+import logging
+import json
+import struct
+import heapq
+import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from compression import available_codecs, choose_codec, negotiate
+from file_index import FileIndex
+from hashing import ChunkVerifier, VerifyingWriter, chunk_digest
+from metrics import failed
+from protocol import SESSION_VERSION, decode_file_list_page, encode_file_list_page, format_request, read_request
+from ratelimit import BULK, INTERACTIVE, SMALL, SMALL_TRANSFER_SIZE, RateLimiter
+from session import ServerSession, SessionPool, Stream
+from transfer import (CHUNK_SIZE, PARALLEL_THRESHOLD, PARTIAL_SUFFIX, RANGE_HEADER, SOCKET_BUFFER_SIZE,
+                      OffsetWriter, codec_from_id, folder_size, preallocate, read_partial, recv_batch, recv_body,
+                      recv_exact, recv_folder, remove_partial_tag, send_batch, send_body, send_folder,
+                      split_ranges, tune_socket, write_partial_tag)
+
+DEFAULT_PAGE_SIZE = 2000
+MAX_PAGE_SIZE = 10000
+# Times a chunk that fails verification is fetched again before the download gives up.
+MAX_REPAIR_ATTEMPTS = 3
+# Commands the server answers; anything else is counted as "other" so peers cannot mint metric labels.
+COMMANDS = {"REQUEST_FILE_LIST", "DOWNLOAD", "BATCH", "MANIFEST", "LOCATE", "STATS", "TEST_CONNECTION"}
+
+
+class FileServer:
+    def __init__(self, shared_directory, folders, host, port,
+                 max_connections=32, max_transfers=8, backlog=128, request_timeout=10,
+                 socket_buffer_size=SOCKET_BUFFER_SIZE, index=None, limiter=None, metrics=None):
+        self.shared_directory = shared_directory
+        self.folders = folders
+        self.index = index or FileIndex(shared_directory)
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.max_transfers = max_transfers
+        self.backlog = backlog
+        self.request_timeout = request_timeout
+        self.socket_buffer_size = socket_buffer_size
+        # Paces everything the server sends; unlimited unless configured.
+        self.limiter = limiter or RateLimiter()
+        self.private_folders = None
+        self.visibility_generation = 0
+        self.server_socket = None
+        self.sessions = set()
+        self.active_transfers = 0
+        self.pending_transfers = []
+        self.transfer_sequence = itertools.count()
+        self.stats_lock = threading.Lock()
+        self.running = threading.Event()
+        # A metrics.Metrics to record into, or None to skip all of it.
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.gauge("memo_transfers_queued", lambda: len(self.pending_transfers))
+            metrics.gauge("memo_transfers_active", lambda: self.active_transfers)
+            metrics.gauge("memo_sessions_active", lambda: len(self.sessions))
+        # Short requests (file list, connection tests) and bulk transfers get separate
+        # pools so a handful of large downloads can never starve the control traffic.
+        self.control_pool = ThreadPoolExecutor(max_workers=max_connections, thread_name_prefix="memo-control")
+        self.transfer_pool = ThreadPoolExecutor(max_workers=max_transfers, thread_name_prefix="memo-transfer")
+        self.compression_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 2, thread_name_prefix="memo-compress")
+
+    def start(self):
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Accepted connections inherit the listening socket's buffer sizes.
+        tune_socket(self.server_socket, self.socket_buffer_size)
+        self.server_socket.bind((self.host, self.port))
+        self.server_socket.listen(self.backlog)
+        self.port = self.server_socket.getsockname()[1]
+        self.running.set()
+        self.index.rescan_async()
+        logging.info(f"File server started on {self.host}:{self.port}")
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.running.clear()
+        if self.server_socket:
+            # shutdown() wakes the accept() in serve_forever; close() alone leaves it listening.
+            try:
+                self.server_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.server_socket.close()
+        with self.stats_lock:
+            sessions = list(self.sessions)
+        for session in sessions:
+            session.close()
+        self.control_pool.shutdown(wait=False)
+        self.transfer_pool.shutdown(wait=False)
+        self.compression_pool.shutdown(wait=False)
+
+    def serve_forever(self):
+        while self.running.is_set():
+            try:
+                conn, addr = self.server_socket.accept()
+            except OSError:
+                break
+            if self.metrics is not None:
+                self.metrics.inc("memo_connections_total")
+            self.control_pool.submit(self.handle_connection, conn, addr)
+
+    def handle_connection(self, conn, addr):
+        try:
+            conn.settimeout(self.request_timeout)
+            command, argument, options = read_request(conn)
+        except Exception as e:
+            logging.error(f"Error reading request from {addr}: {str(e)}")
+            conn.close()
+            return
+        if command == "SESSION":
+            version = min(int(argument or 1), SESSION_VERSION)
+            with self.stats_lock:
+                # Sessions count against the same limit as control workers; past it the peer
+                # falls back to one connection per request, which the control pool bounds.
+                session = None
+                if len(self.sessions) < self.max_connections:
+                    session = ServerSession(conn, addr, lambda channel, *request: self.control_pool.submit(
+                        self.handle_request, channel, addr, *request), version=version)
+                    self.sessions.add(session)
+            if session is None:
+                logging.warning(f"Refusing session from {addr}: {self.max_connections} sessions already open")
+                conn.close()
+                return
+            # A session lives as long as the peer keeps it open, so it gets its own thread
+            # rather than holding a control worker.
+            threading.Thread(target=self.serve_session, args=(session,), daemon=True).start()
+        else:
+            self.handle_request(conn, addr, command, argument, options)
+
+    def serve_session(self, session):
+        try:
+            session.conn.sendall(struct.pack("!B", session.version))
+            session.run()
+        except OSError as e:
+            logging.debug(f"Session with {session.addr} failed: {str(e)}")
+        finally:
+            with self.stats_lock:
+                self.sessions.discard(session)
+            session.close()
+
+    def handle_request(self, conn, addr, command, argument, options):
+        """Answer one request on conn, a plain connection or a session channel; closes conn when done."""
+        handed_off = False
+        if self.metrics is not None:
+            # Stands in for conn until it is closed, however many hands it passes through.
+            conn = self.metrics.transfer("upload", command=command if command in COMMANDS else "other").wrap(conn)
+        try:
+            if command == "REQUEST_FILE_LIST" and options:
+                page = self.share_file_page(options)
+                self.limiter.wrap(conn, addr[0], INTERACTIVE).sendall(struct.pack("!I", len(page)) + page)
+            elif command == "REQUEST_FILE_LIST":
+                file_list = self.share_file_list()
+                self.limiter.wrap(conn, addr[0], INTERACTIVE).sendall(file_list.encode())
+            elif command == "DOWNLOAD":
+                priority = self.transfer_priority(argument, options)
+                self.submit_transfer(self.serve_download, conn, addr, argument, options, priority, priority=priority)
+                handed_off = True
+            elif command == "BATCH":
+                item_names = json.loads(options["body"].decode())
+                self.submit_transfer(self.serve_batch, conn, addr, item_names, options, priority=SMALL)
+                handed_off = True
+            elif command == "MANIFEST":
+                self.submit_transfer(self.serve_manifest, conn, addr, argument, priority=INTERACTIVE)
+                handed_off = True
+            elif command == "LOCATE":
+                data = json.dumps(self.index.find_by_hash(argument, self.private_folder_names())).encode()
+                conn.sendall(struct.pack("!Q", len(data)) + data)
+            elif command == "STATS":
+                data = json.dumps(self.stats()).encode()
+                conn.sendall(struct.pack("!Q", len(data)) + data)
+            elif command == "TEST_CONNECTION":
+                conn.sendall(b"CONNECTION_OK")
+        except Exception as e:
+            failed(conn, e)
+            logging.error(f"Error handling connection from {addr}: {str(e)}")
+        finally:
+            if not handed_off:
+                conn.close()
+
+    def submit_transfer(self, serve, *args, priority=BULK):
+        """Queue serve(*args) for the transfer pool; a free worker takes the most urgent job waiting."""
+        with self.stats_lock:
+            heapq.heappush(self.pending_transfers,
+                           (priority, next(self.transfer_sequence), serve, args, time.perf_counter()))
+        self.transfer_pool.submit(self.run_next_transfer)
+
+    def run_next_transfer(self):
+        with self.stats_lock:
+            _, _, serve, args, queued = heapq.heappop(self.pending_transfers)
+            self.active_transfers += 1
+        if self.metrics is not None:
+            self.metrics.observe("memo_transfer_queue_wait_seconds", time.perf_counter() - queued)
+        try:
+            serve(*args)
+        finally:
+            with self.stats_lock:
+                self.active_transfers -= 1
+
+    def transfer_priority(self, item_name, options):
+        """SMALL for files (or requested ranges) under SMALL_TRANSFER_SIZE, BULK for the rest and for folders."""
+        if "length" in options:
+            size = int(options["length"])
+        else:
+            try:
+                item_path = os.path.join(self.shared_directory, item_name)
+                size = os.path.getsize(item_path) if not os.path.isdir(item_path) else SMALL_TRANSFER_SIZE
+            except OSError:
+                return SMALL
+        return SMALL if size < SMALL_TRANSFER_SIZE else BULK
+
+    def capacity(self):
+        """What this server can take on, as advertised in discovery beacons."""
+        return {"transfers": self.max_transfers, "active": self.active_transfers, "sessions": len(self.sessions)}
+
+    def stats(self):
+        """What the STATS command answers: capacity() plus a metrics snapshot, None if metrics are off."""
+        return {"capacity": dict(self.capacity(), queued=len(self.pending_transfers)),
+                "metrics": self.metrics.snapshot() if self.metrics is not None else None}
+
+    def serve_download(self, conn, addr, item_name, options, priority=BULK):
+        with conn:
+            try:
+                conn.settimeout(None)
+                self.handle_download(self.limiter.wrap(conn, addr[0], priority), item_name, options)
+            except Exception as e:
+                failed(conn, e)
+                logging.error(f"Error sending {item_name} to {addr}: {str(e)}")
+
+    def serve_batch(self, conn, addr, item_names, options):
+        with conn:
+            try:
+                conn.settimeout(None)
+                total = 0
+                for item_name in item_names:
+                    try:
+                        total += os.path.getsize(os.path.join(self.shared_directory, item_name))
+                    except OSError:
+                        pass
+                conn.sendall(struct.pack("!Q", total))
+                send_batch(self.limiter.wrap(conn, addr[0], SMALL), self.shared_directory, item_names,
+                           negotiate(options.get("compress")), self.compression_pool,
+                           self.content_hash if options.get("verify") else None)
+            except Exception as e:
+                failed(conn, e)
+                logging.error(f"Error sending a batch of {len(item_names)} files to {addr}: {str(e)}")
+
+    def serve_manifest(self, conn, addr, item_name):
+        with conn:
+            try:
+                manifest = self.index.manifest(item_name)
+                data = json.dumps(manifest).encode()
+                self.limiter.wrap(conn, addr[0], INTERACTIVE).sendall(struct.pack("!Q", len(data)) + data)
+            except Exception as e:
+                failed(conn, e)
+                logging.error(f"Error sending manifest of {item_name} to {addr}: {str(e)}")
+
+    def content_hash(self, item_name):
+        """The content hash of a shared file from the index, hashing it only if the index has none yet."""
+        try:
+            return self.index.manifest(item_name)["hash"]
+        except OSError:
+            return None
+
+    def share_file_list(self):
+        file_list = []
+        for entry in self.index.entries(max_depth=2):
+            folder = entry["name"].split("/")[0]
+            if folder != entry["name"] or entry["type"] == "folder":
+                if not self.folders.get(folder, {"public": True})["public"]:
+                    continue
+            entry["public"] = True
+            file_list.append(entry)
+
+        return json.dumps(file_list)
+
+    def private_folder_names(self):
+        return sorted(name for name, folder in list(self.folders.items()) if not folder["public"])
+
+    def share_file_page(self, options):
+        private = self.private_folder_names()
+        if private != self.private_folders:
+            # Hiding or showing a folder changes the listing without touching the index,
+            # so deltas from before this point would be wrong.
+            self.private_folders = private
+            self.visibility_generation = self.index.advance_generation()
+        generation = self.index.generation
+        since = int(options["since"]) if options.get("since") else None
+        if since is not None and not self.visibility_generation <= since <= generation:
+            since = None
+        limit = min(int(options.get("limit", DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        depth = int(options["depth"]) if options.get("depth") else None
+        entries, next_cursor = self.index.page(options.get("cursor", ""), limit, options.get("prefix", ""),
+                                               depth, private, since)
+        return encode_file_list_page(entries, next_cursor, generation, since is not None)
+
+    def handle_download(self, conn, item_name, options=None):
+        options = options or {}
+        codec = negotiate(options.get("compress"))
+        item_path = os.path.join(self.shared_directory, item_name)
+        if os.path.isdir(item_path):
+            # The header carries the total payload so the receiver can show progress;
+            # the folder itself follows as framed entries, written straight from disk.
+            conn.sendall(struct.pack("!Q", folder_size(item_path)))
+            hashes = None
+            if options.get("verify"):
+                hashes = lambda rel_path: self.content_hash(f"{item_name}/{rel_path}")
+            send_folder(conn, item_path, codec, self.compression_pool, hashes)
+        else:
+            with open(item_path, "rb") as f:
+                st = os.fstat(f.fileno())
+                file_size = st.st_size
+                offset, length = 0, file_size
+                if "offset" in options:
+                    # Like HTTP If-Range: a stale validator means the client's partial
+                    # copy is of an older version, so send the whole file again.
+                    if options.get("if-range", file_tag(st)) == file_tag(st):
+                        offset = min(int(options["offset"]), file_size)
+                    length = min(int(options.get("length", file_size - offset)), file_size - offset)
+                    conn.sendall(RANGE_HEADER.pack(file_size, st.st_mtime_ns, offset, length))
+                else:
+                    conn.sendall(struct.pack("!Q", file_size))
+                f.seek(offset)
+                if "compress" in options:
+                    file_codec = choose_codec(item_name, f, length, codec)
+                    conn.sendall(struct.pack("!B", file_codec.id if file_codec else 0))
+                    send_body(conn, f, length, file_codec, self.compression_pool)
+                else:
+                    send_body(conn, f, length)
+
+
+def file_tag(st):
+    return f"{st.st_size}-{st.st_mtime_ns}"
+
+
+def open_connection(ip, port, timeout=10, socket_buffer_size=SOCKET_BUFFER_SIZE):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        tune_socket(s, socket_buffer_size)
+        s.settimeout(timeout)
+        s.connect((ip, port))
+    except BaseException:
+        s.close()
+        raise
+    return s
+
+
+sessions = SessionPool()
+
+
+def open_stream(ip, port, timeout=10, socket_buffer_size=SOCKET_BUFFER_SIZE):
+    """Something to send one request over: a stream on the peer's shared session, or a new connection."""
+    stream = sessions.open_stream(ip, port, timeout, socket_buffer_size)
+    if stream is None:
+        return open_connection(ip, port, timeout, socket_buffer_size)
+    return stream
+
+
+def download_item(ip, port, item_name, item_type, save_path, timeout=10,
+                  chunk_size=CHUNK_SIZE, socket_buffer_size=SOCKET_BUFFER_SIZE, compress=True, resume=True,
+                  streams=1, parallel_threshold=PARALLEL_THRESHOLD, peers=None, progress=None, verify=True):
+    # compress may be True (offer everything we support) or an explicit preference list.
+    # progress (a tasks.Task or anything with set_total/add) follows the bytes received.
+    # verify checks what arrives against the peer's content hashes and fetches bad parts again.
+    codecs = available_codecs() if compress is True else (compress or None)
+    if item_type != "Folder":
+        return download_file(ip, port, item_name, os.path.join(save_path, item_name), timeout,
+                             chunk_size, socket_buffer_size, codecs, resume, streams, parallel_threshold, peers,
+                             progress, verify)
+
+    with open_stream(ip, port, timeout, socket_buffer_size) as s:
+        s.sendall(format_request(f"DOWNLOAD:{item_name}", compress=codecs, verify=1 if verify else None))
+        total = struct.unpack("!Q", recv_exact(s, 8))[0]
+        if progress is not None:
+            progress.set_total(total)
+        _, corrupt = recv_folder(s, os.path.join(save_path, item_name), chunk_size, progress, verify)
+    if corrupt:
+        logging.warning(f"{len(corrupt)} file(s) of {item_name} from {ip} failed verification; fetching them again")
+        download_files(ip, port, [f"{item_name}/{rel_path}" for rel_path in corrupt], save_path, timeout,
+                       chunk_size, socket_buffer_size, codecs, resume=False)
+
+
+def iter_file_list(ip, port, prefix="", depth=None, since=None, page_size=DEFAULT_PAGE_SIZE, timeout=5,
+                   socket_buffer_size=SOCKET_BUFFER_SIZE):
+    """Yield (entries, generation, delta) for each page of a peer's file list.
+
+    With since, the peer sends only what changed after that generation (delta is
+    True), or the full list if it can no longer tell.
+    """
+    cursor = ""
+    while True:
+        with open_stream(ip, port, timeout, socket_buffer_size) as s:
+            s.sendall(format_request("REQUEST_FILE_LIST", cursor=cursor, limit=page_size, prefix=prefix or None,
+                                     depth=depth, since=since))
+            length = struct.unpack("!I", recv_exact(s, 4))[0]
+            entries, cursor, generation, delta = decode_file_list_page(recv_exact(s, length))
+        yield entries, generation, delta
+        if not cursor:
+            return
+
+
+def request_file_list(ip, port, prefix="", depth=None, timeout=5):
+    return [entry for entries, _, _ in iter_file_list(ip, port, prefix, depth, timeout=timeout) for entry in entries]
+
+
+class FileListCache:
+    """Per-peer copies of remote file lists, brought up to date with delta requests."""
+
+    def __init__(self):
+        self.listings = {}
+        self.lock = threading.Lock()
+
+    def get(self, ip, prefix="", depth=None):
+        """The cached list for ip, or None if it has never been fetched."""
+        with self.lock:
+            listing = self.listings.get((ip, prefix, depth))
+        return sorted(listing[1].values(), key=lambda e: e["name"]) if listing else None
+
+    def sync(self, ip, port, prefix="", depth=None, timeout=5):
+        key = (ip, prefix, depth)
+        with self.lock:
+            cached = self.listings.get(key)
+        since, entries = (cached[0], dict(cached[1])) if cached else (None, {})
+        first_page = True
+        for page_entries, generation, delta in iter_file_list(ip, port, prefix, depth, since, timeout=timeout):
+            if first_page:
+                # Changes made while paging carry later generations and come with the next sync.
+                since, first_page = generation, False
+                if not delta:
+                    entries = {}
+            for entry in page_entries:
+                if entry.get("removed"):
+                    entries.pop(entry["name"], None)
+                else:
+                    entries[entry["name"]] = entry
+        with self.lock:
+            self.listings[key] = (since, entries)
+        return sorted(entries.values(), key=lambda e: e["name"])
+
+    def generation(self, ip, prefix="", depth=None):
+        with self.lock:
+            listing = self.listings.get((ip, prefix, depth))
+        return listing[0] if listing else None
+
+    def forget(self, ip):
+        with self.lock:
+            for key in [key for key in self.listings if key[0] == ip]:
+                del self.listings[key]
+
+
+def request_manifest(ip, port, item_name, timeout=10, socket_buffer_size=SOCKET_BUFFER_SIZE):
+    with open_stream(ip, port, timeout, socket_buffer_size) as s:
+        s.sendall(format_request(f"MANIFEST:{item_name}"))
+        length = struct.unpack("!Q", recv_exact(s, 8))[0]
+        return json.loads(recv_exact(s, length).decode())
+
+
+def request_stats(ip, port, timeout=10):
+    """ip's answer to STATS: its capacity and, if it keeps metrics, a metrics snapshot."""
+    with open_stream(ip, port, timeout) as s:
+        s.sendall(format_request("STATS"))
+        length = struct.unpack("!Q", recv_exact(s, 8))[0]
+        return json.loads(recv_exact(s, length).decode())
+
+
+def request_locate(ip, port, content_hash, timeout=10, socket_buffer_size=SOCKET_BUFFER_SIZE):
+    with open_stream(ip, port, timeout, socket_buffer_size) as s:
+        s.sendall(format_request(f"LOCATE:{content_hash}"))
+        length = struct.unpack("!Q", recv_exact(s, 8))[0]
+        return json.loads(recv_exact(s, length).decode())
+
+
+def request_range(s, item_name, offset, length=None, tag=None, codecs=None):
+    send_range_request(s, item_name, offset, length, tag, codecs)
+    return read_range_reply(s, codecs)
+
+
+def send_range_request(s, item_name, offset, length=None, tag=None, codecs=None):
+    s.sendall(format_request(f"DOWNLOAD:{item_name}", offset=offset, length=length, compress=codecs,
+                             **{"if-range": tag}))
+
+
+def read_range_reply(s, codecs=None):
+    file_size, mtime_ns, offset, length = RANGE_HEADER.unpack(recv_exact(s, RANGE_HEADER.size))
+    codec = codec_from_id(recv_exact(s, 1)[0]) if codecs else None
+    return file_size, mtime_ns, offset, length, codec
+
+
+class DownloadCheck:
+    """Checks one downloaded file against the peer's chunk manifest and fetches only failing chunks again.
+
+    The MANIFEST request goes out as soon as the check is created, so the peer
+    looks up its cached hashes while the file is still arriving, and chunks are
+    hashed as they are written; finish() then only compares digests. Peers that
+    cannot send a manifest get their downloads through unchecked.
+    """
+
+    def __init__(self, ip, port, item_name, timeout=10, socket_buffer_size=SOCKET_BUFFER_SIZE, codecs=None):
+        self.ip = ip
+        self.port = port
+        self.item_name = item_name
+        self.timeout = timeout
+        self.socket_buffer_size = socket_buffer_size
+        self.codecs = codecs
+        self.verifier = None
+        self.stream = open_stream(ip, port, timeout, socket_buffer_size)
+        try:
+            self.stream.sendall(format_request(f"MANIFEST:{item_name}"))
+        except BaseException:
+            self.stream.close()
+            raise
+
+    def writer(self, target, file_size, offset=0):
+        """A stand-in for target, which receives the file's bytes from offset on, that hashes them on the way."""
+        if self.verifier is None:
+            self.verifier = ChunkVerifier(file_size)
+        return VerifyingWriter(target, self.verifier, offset)
+
+    def finish(self, part_path, tag):
+        """Verify part_path, a complete download of the version tag, repairing bad chunks in place."""
+        try:
+            length = struct.unpack("!Q", recv_exact(self.stream, 8))[0]
+            manifest = json.loads(recv_exact(self.stream, length).decode())
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not verify {self.item_name} from {self.ip}: {str(e)}")
+            return
+        finally:
+            self.close()
+        if f"{manifest['size']}-{manifest['mtime_ns']}" != tag:
+            raise ConnectionError(f"{self.item_name} changed on {self.ip} during the download")
+        verifier = self.verifier or ChunkVerifier(manifest["size"], manifest["chunk_size"], background=False)
+        bad = verifier.check(manifest, part_path)
+        if bad:
+            logging.warning(f"{len(bad)} chunk(s) of {self.item_name} from {self.ip} failed verification; "
+                            f"fetching them again")
+            self.repair(part_path, manifest, tag, bad)
+
+    def repair(self, part_path, manifest, tag, bad):
+        chunk_size = manifest["chunk_size"]
+        with open(part_path, "r+b") as f:
+            for index in bad:
+                start = index * chunk_size
+                length = min(chunk_size, manifest["size"] - start)
+                for _ in range(MAX_REPAIR_ATTEMPTS):
+                    data = self.fetch(start, length, tag)
+                    if chunk_digest(data) == manifest["chunks"][index]:
+                        break
+                else:
+                    # Keep only the verified part so a resume starts at the bad chunk.
+                    f.truncate(start)
+                    raise ConnectionError(f"{self.item_name} from {self.ip} failed verification "
+                                          f"{MAX_REPAIR_ATTEMPTS} times")
+                f.seek(start)
+                f.write(data)
+
+    def fetch(self, start, length, tag):
+        with open_stream(self.ip, self.port, self.timeout, self.socket_buffer_size) as s:
+            _, _, got_start, got_length, codec = request_range(s, self.item_name, start, length, tag, self.codecs)
+            if (got_start, got_length) != (start, length):
+                raise ConnectionError(f"{self.item_name} changed on {self.ip} during the download")
+            data = BytesIO()
+            recv_body(s, data, length, codec)
+            return data.getvalue()
+
+    def close(self):
+        self.stream.close()
+
+
+def download_file(ip, port, item_name, file_path, timeout=10, chunk_size=CHUNK_SIZE,
+                  socket_buffer_size=SOCKET_BUFFER_SIZE, codecs=None, resume=True,
+                  streams=1, parallel_threshold=PARALLEL_THRESHOLD, peers=None, progress=None, verify=True):
+    """Download one file through a .part file, resuming a previous partial download if present.
+
+    Files with at least parallel_threshold bytes left are fetched as `streams` byte
+    ranges over parallel connections, or from every peer in `peers` that holds the
+    same content. With verify the file is checked against the peer's chunk
+    manifest before it is moved into place (swarm downloads check every chunk anyway).
+    """
+    part_path = file_path + PARTIAL_SUFFIX
+    offset, tag = read_partial(part_path) if resume else (0, None)
+    check = None
+    try:
+        if streams > 1 or peers:
+            with open_stream(ip, port, timeout, socket_buffer_size) as s:
+                file_size, mtime_ns, offset, _, _ = request_range(s, item_name, offset, 0, tag)
+            tag = f"{file_size}-{mtime_ns}"
+            if progress is not None:
+                progress.set_total(file_size)
+            if peers and file_size >= parallel_threshold:
+                from swarm import find_sources, swarm_download
+
+                sources, manifest = find_sources(ip, item_name, peers, port, timeout, socket_buffer_size)
+                if len(sources) > 1:
+                    swarm_download(sources, port, manifest, part_path, timeout, socket_buffer_size,
+                                   progress=progress)
+                    os.replace(part_path, file_path)
+                    remove_partial_tag(part_path)
+                    return
+            if streams > 1 and file_size - offset >= parallel_threshold:
+                if verify:
+                    check = DownloadCheck(ip, port, item_name, timeout, socket_buffer_size, codecs)
+                download_ranges(ip, port, item_name, part_path, file_size, tag, offset, streams,
+                                timeout, chunk_size, socket_buffer_size, codecs, progress, check)
+                if check is not None:
+                    check.finish(part_path, tag)
+                os.replace(part_path, file_path)
+                remove_partial_tag(part_path)
+                return
+
+        if verify:
+            check = DownloadCheck(ip, port, item_name, timeout, socket_buffer_size, codecs)
+        with open_stream(ip, port, timeout, socket_buffer_size) as s:
+            send_range_request(s, item_name, offset, None, tag, codecs)
+            recv_download(s, file_path, codecs, memoryview(bytearray(chunk_size)), progress, report_size=True,
+                          check=check)
+    finally:
+        if check is not None:
+            check.close()
+
+
+def recv_download(s, file_path, codecs=None, view=None, progress=None, report_size=False, check=None):
+    """Read the reply to a ranged DOWNLOAD into file_path's .part file, then move it into place.
+
+    With report_size the reply's file size becomes progress's total; otherwise the
+    caller has set it (several files counted by one task). check, a DownloadCheck,
+    verifies the file before it is moved.
+    """
+    part_path = file_path + PARTIAL_SUFFIX
+    file_size, mtime_ns, offset, length, codec = read_range_reply(s, codecs)
+    if progress is not None and report_size:
+        progress.set_total(file_size)
+        progress.add(offset)
+    with open(part_path, "r+b" if offset else "wb") as f:
+        f.truncate(offset)
+        f.seek(offset)
+        write_partial_tag(part_path, f"{file_size}-{mtime_ns}")
+        preallocate(f, file_size)
+        try:
+            recv_body(s, check.writer(f, file_size, offset) if check else f, length, codec, view, progress)
+        finally:
+            # Drop the preallocated tail so the size of the .part file is the resume point.
+            f.truncate(f.tell())
+
+    if check is not None:
+        check.finish(part_path, f"{file_size}-{mtime_ns}")
+    os.replace(part_path, file_path)
+    remove_partial_tag(part_path)
+
+
+def download_batch(ip, port, item_names, save_path, timeout=10, chunk_size=CHUNK_SIZE,
+                   socket_buffer_size=SOCKET_BUFFER_SIZE, compress=True, progress=None, verify=True):
+    """Download many files in a single BATCH request and return the names the peer could not send.
+
+    Peers that predate BATCH end the reply without a word; they get download_files() instead.
+    With verify, files whose content hash does not match are fetched again one by one.
+    """
+    codecs = available_codecs() if compress is True else (compress or None)
+    with open_stream(ip, port, timeout, socket_buffer_size) as s:
+        s.sendall(format_request("BATCH", body=json.dumps(list(item_names)).encode(), compress=codecs,
+                                 verify=1 if verify else None))
+        try:
+            total = struct.unpack("!Q", recv_exact(s, 8))[0]
+        except ConnectionError:
+            pass
+        else:
+            if progress is not None:
+                progress.set_total(total)
+            _, missing, corrupt = recv_batch(s, save_path, chunk_size, progress, verify)
+            if corrupt:
+                logging.warning(f"{len(corrupt)} file(s) from {ip} failed verification; fetching them again")
+                download_files(ip, port, corrupt, save_path, timeout, chunk_size, socket_buffer_size, codecs,
+                               resume=False)
+            return missing
+    download_files(ip, port, list(item_names), save_path, timeout, chunk_size, socket_buffer_size, compress,
+                   progress=progress, verify=verify)
+    return []
+
+
+def download_files(ip, port, item_names, save_path, timeout=10, chunk_size=CHUNK_SIZE,
+                   socket_buffer_size=SOCKET_BUFFER_SIZE, compress=True, resume=True, progress=None, verify=True):
+    """Download several files from one peer, sending every request before reading the first reply.
+
+    Over a session the requests are pipelined, so n small files cost about one
+    round trip instead of n. Large files are better served by download_item,
+    which can split them across connections. progress only counts bytes; its
+    total is left to the caller. verify works as for download_file.
+    """
+    codecs = available_codecs() if compress is True else (compress or None)
+    view = memoryview(bytearray(chunk_size))
+    pending = []
+    try:
+        for item_name in item_names:
+            s = open_stream(ip, port, timeout, socket_buffer_size)
+            if not isinstance(s, Stream):
+                # Without sessions every request is its own connection; fetch them one at a time.
+                s.close()
+                for name in item_names[len(pending):]:
+                    file_path = os.path.join(save_path, name)
+                    check = DownloadCheck(ip, port, name, timeout, socket_buffer_size, codecs) if verify else None
+                    try:
+                        with open_stream(ip, port, timeout, socket_buffer_size) as single:
+                            offset, tag = read_partial(file_path + PARTIAL_SUFFIX) if resume else (0, None)
+                            send_range_request(single, name, offset, None, tag, codecs)
+                            recv_download(single, file_path, codecs, view, progress, check=check)
+                    finally:
+                        if check is not None:
+                            check.close()
+                break
+            file_path = os.path.join(save_path, item_name)
+            offset, tag = read_partial(file_path + PARTIAL_SUFFIX) if resume else (0, None)
+            check = DownloadCheck(ip, port, item_name, timeout, socket_buffer_size, codecs) if verify else None
+            pending.append((s, file_path, check))
+            send_range_request(s, item_name, offset, None, tag, codecs)
+        for s, file_path, check in pending:
+            recv_download(s, file_path, codecs, view, progress, check=check)
+            s.close()
+    finally:
+        for s, _, check in pending:
+            s.close()
+            if check is not None:
+                check.close()
+
+
+def download_ranges(ip, port, item_name, part_path, file_size, tag, offset, streams, timeout=10,
+                    chunk_size=CHUNK_SIZE, socket_buffer_size=SOCKET_BUFFER_SIZE, codecs=None, progress=None,
+                    check=None):
+    ranges = split_ranges(offset, file_size, streams)
+    if progress is not None:
+        # What an earlier attempt left in the .part file counts as received, as in recv_download.
+        progress.add(offset)
+
+    def fetch(writer, start, length):
+        with open_connection(ip, port, timeout, socket_buffer_size) as s:
+            _, _, got_start, got_length, codec = request_range(s, item_name, start, length, tag, codecs)
+            if (got_start, got_length) != (start, length):
+                raise ConnectionError(f"{item_name} changed on {ip} during the download")
+            recv_body(s, writer, length, codec, memoryview(bytearray(chunk_size)), progress)
+
+    with open(part_path, "r+b" if offset else "wb") as f:
+        write_partial_tag(part_path, tag)
+        preallocate(f, file_size)
+        writers = [OffsetWriter(f.fileno(), start) for start, _ in ranges]
+        try:
+            with ThreadPoolExecutor(max_workers=len(ranges), thread_name_prefix="memo-range") as pool:
+                targets = [check.writer(writer, file_size, start) if check else writer
+                           for writer, (start, _) in zip(writers, ranges)]
+                futures = [pool.submit(fetch, target, start, length)
+                           for target, (start, length) in zip(targets, ranges)]
+                for future in futures:
+                    future.result()
+        finally:
+            # Only the leading run of finished ranges is kept, so a resume can continue from it.
+            resume_point = offset
+            for writer, (start, length) in zip(writers, ranges):
+                resume_point = start + writer.written
+                if writer.written < length:
+                    break
+            f.truncate(resume_point)
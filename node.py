@@ -0,0 +1,307 @@
+import logging
+import os
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from discovery import BeaconService, local_network, scan
+from file_index import FileIndex, is_internal
+from metrics import measure
+from networking import FileListCache, FileServer, download_batch, download_item, request_file_list
+from ratelimit import BULK, SMALL, RateLimiter
+from store import ContentStore
+from transfer import CHUNK_SIZE, PARALLEL_THRESHOLD, SOCKET_BUFFER_SIZE
+from watcher import start_watcher
+
+DEFAULT_PORT = 5000
+# Files copied at once by import_paths; enough to overlap small files' open/close, few enough not to thrash a disk.
+IMPORT_WORKERS = 4
+# Imported files recorded in the index per transaction.
+IMPORT_BATCH = 256
+
+
+def default_shared_directory():
+    return os.path.join(os.path.expanduser("~"), "SharedFiles")
+
+
+def wifi_ip():
+    import re
+    import subprocess
+
+    try:
+        # For Windows
+        if os.name == 'nt':
+            output = subprocess.check_output(['ipconfig']).decode('utf-8')
+            wifi_section = re.search(r'Wireless LAN adapter WiFi:(.*?)(\n\n|\Z)', output, re.DOTALL)
+            if wifi_section:
+                ip_match = re.search(r'IPv4 Address[.\s]+: ([^\s]+)', wifi_section.group(1))
+                if ip_match:
+                    return ip_match.group(1)
+        # For Unix-based systems (Linux, macOS)
+        else:
+            output = subprocess.check_output(['ifconfig']).decode('utf-8')
+            wifi_section = re.search(r'(wlan0|en0):(.*?)(\n\n|\Z)', output, re.DOTALL)
+            if wifi_section:
+                ip_match = re.search(r'inet\s+(\d+\.\d+\.\d+\.\d+)', wifi_section.group(2))
+                if ip_match:
+                    return ip_match.group(1)
+    except Exception as e:
+        logging.error(f"Error getting Wi-Fi IP: {e}")
+
+    return None
+
+
+def local_ip():
+    return wifi_ip() or socket.gethostbyname(socket.gethostname())
+
+
+class Node:
+    """Everything a MEMO peer does apart from drawing windows.
+
+    Owns the share index, the file server, beacon discovery, the share watcher
+    and the cache of remote file lists. The GUI and the command line are both
+    clients of it; nothing here imports tkinter.
+    """
+
+    def __init__(self, shared_directory=None, host=None, port=DEFAULT_PORT, folders=None,
+                 max_connections=32, max_transfers=8, backlog=128, chunk_size=CHUNK_SIZE,
+                 socket_buffer_size=SOCKET_BUFFER_SIZE, compress_transfers=True, download_streams=4,
+                 parallel_threshold=PARALLEL_THRESHOLD, swarm_downloads=True, upload_limiter=None,
+                 download_limiter=None, verify_downloads=True, metrics=None):
+        self.shared_directory = shared_directory or default_shared_directory()
+        self.host = host or local_ip()
+        self.port = port
+        # Folder name -> {"public": bool, ...}; shared with the server, which hides private folders.
+        self.folders = {} if folders is None else folders
+        self.max_connections = max_connections
+        self.max_transfers = max_transfers
+        self.backlog = backlog
+        self.chunk_size = chunk_size
+        self.socket_buffer_size = socket_buffer_size
+        self.compress_transfers = compress_transfers
+        self.download_streams = download_streams
+        self.parallel_threshold = parallel_threshold
+        self.swarm_downloads = swarm_downloads
+        # Check downloads against the peer's content hashes and re-fetch what does not match.
+        self.verify_downloads = verify_downloads
+        # Bandwidth caps (global, per peer, by time of day); unlimited by default.
+        self.upload_limiter = upload_limiter or RateLimiter()
+        self.download_limiter = download_limiter or RateLimiter()
+        # A metrics.Metrics recording transfers, scans and listings; None records nothing.
+        self.metrics = metrics
+        self.file_lists = FileListCache()
+        self.store = ContentStore(self.shared_directory)
+        self.index = None
+        self.file_server = None
+        self.beacons = None
+        self.watcher = None
+
+    def open_index(self):
+        if self.index is None:
+            os.makedirs(self.shared_directory, exist_ok=True)
+            self.index = FileIndex(self.shared_directory)
+        return self.index
+
+    def start(self, beacons=True, watch=True, on_share_changed=None, on_peers_changed=None):
+        """Start serving the share; returns False if beacons were asked for but could not start."""
+        self.open_index()
+        self.file_server = FileServer(
+            self.shared_directory,
+            self.folders,
+            self.host,
+            self.port,
+            max_connections=self.max_connections,
+            max_transfers=self.max_transfers,
+            backlog=self.backlog,
+            socket_buffer_size=self.socket_buffer_size,
+            index=self.index,
+            limiter=self.upload_limiter,
+            metrics=self.metrics,
+        )
+        self.file_server.start()
+        if watch:
+            self.watcher = start_watcher(self.shared_directory, on_share_changed or self.index.refresh)
+        return self.start_beacons(on_peers_changed) if beacons else True
+
+    def start_beacons(self, on_change=None, announce=True):
+        # Peers announce themselves over UDP, so the device list fills without probing
+        # the subnet; the TCP scan is only the fallback when beacons cannot run.
+        beacons = BeaconService(self.host, self.port, lambda: self.index.generation if self.index else 0,
+                                self.file_server.capacity if self.file_server else None, on_change=on_change)
+        try:
+            beacons.start(announce)
+        except OSError as e:
+            logging.warning(f"Beacon discovery unavailable: {str(e)}")
+            return False
+        self.beacons = beacons
+        return True
+
+    def add_file(self, src, rel_path, progress=None, in_place=False):
+        """Share the file src as rel_path, stored once however many places share it.
+
+        With in_place nothing is copied: the share links to src where it is. The
+        returned manifest (None in place) was hashed during the copy, so the index
+        has it without reading the file again.
+        """
+        dest = os.path.join(self.shared_directory, *rel_path.split("/"))
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        manifest = self.import_file(src, rel_path, os.path.getsize(src), progress, in_place)
+        if manifest is not None:
+            self.open_index().record(rel_path, manifest)
+        return manifest
+
+    def import_paths(self, sources, folder="", progress=None, in_place=False, workers=IMPORT_WORKERS):
+        """Share files and whole directories under folder ("" for the top of the share), keeping their layout.
+
+        A directory arrives as folder/<its name>/..., empty subfolders included.
+        Files are copied by a pool of workers, each hashed as it is copied, and
+        recorded in the index a batch at a time. progress gets the total size of
+        everything up front. Returns (shared paths, [(source, error)] for files
+        that could not be shared); anything but an OSError (a cancelled task)
+        stops the import.
+        """
+        jobs, folders = plan_import(sources, folder)
+        for rel_folder in folders:
+            os.makedirs(os.path.join(self.shared_directory, *rel_folder.split("/")), exist_ok=True)
+        if progress is not None:
+            progress.set_total(sum(size for _, _, size in jobs))
+        shared, failed, manifests = [], [], []
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="memo-import") as pool:
+            futures = {pool.submit(self.import_file, src, rel_path, size, progress, in_place): (src, rel_path)
+                       for src, rel_path, size in jobs}
+            try:
+                for future in as_completed(futures):
+                    src, rel_path = futures[future]
+                    try:
+                        manifest = future.result()
+                    except OSError as e:
+                        logging.warning(f"Could not share {src}: {str(e)}")
+                        failed.append((src, e))
+                        continue
+                    shared.append(rel_path)
+                    if manifest is not None:
+                        manifests.append((rel_path, manifest))
+                        if len(manifests) >= IMPORT_BATCH:
+                            self.open_index().record_many(manifests, folders)
+                            manifests, folders = [], []
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+            finally:
+                if manifests or folders:
+                    self.open_index().record_many(manifests, folders)
+        return shared, failed
+
+    def import_file(self, src, rel_path, size, progress=None, in_place=False):
+        dest = os.path.join(self.shared_directory, *rel_path.split("/"))
+        if in_place:
+            self.store.share_in_place(src, dest)
+            if progress is not None:
+                progress.add(size)
+            return None
+        return self.store.add(src, dest, progress)
+
+    def stop(self):
+        if self.beacons:
+            self.beacons.stop()
+        if self.watcher:
+            self.watcher.stop()
+        if self.file_server:
+            self.file_server.stop()
+        if self.index:
+            self.index.close()
+        if self.metrics is not None:
+            self.metrics.close()
+
+    def live_peers(self):
+        """Addresses of peers on our port heard from recently, in address order."""
+        if not self.beacons:
+            return []
+        return [peer["ip"] for peer in self.beacons.live_peers() if peer["port"] == self.port]
+
+    def beacon_generation(self, ip):
+        if self.beacons:
+            for peer in self.beacons.live_peers():
+                if peer["ip"] == ip and peer["port"] == self.port:
+                    return peer["generation"]
+        return None
+
+    def scan(self, networks=None, on_found=None, stop_event=None):
+        """Addresses answering on our port in networks (default: this host's /24)."""
+        started = time.perf_counter()
+        found = scan(networks or local_network(self.host), self.port, on_found, stop_event=stop_event)
+        if self.metrics is not None:
+            self.metrics.observe("memo_scan_seconds", time.perf_counter() - started)
+            self.metrics.inc("memo_scan_peers_found_total", len(found))
+        return found
+
+    def list_files(self, ip, prefix="", depth=2):
+        """ip's file list, brought up to date from the cache; the GUI shows folders and their children."""
+        started = time.perf_counter()
+        entries = self.file_lists.sync(ip, self.port, prefix, depth)
+        if self.metrics is not None:
+            self.metrics.observe("memo_file_list_seconds", time.perf_counter() - started)
+        return entries
+
+    def find(self, ip, path):
+        """ip's entry for path, or None if it does not share it."""
+        path = path.strip("/")
+        for entry in request_file_list(ip, self.port, prefix=path, depth=1):
+            if entry["name"] == path:
+                return entry
+        return None
+
+    def download(self, ip, item_name, item_type, save_path, peers=None, progress=None):
+        if peers is None and self.swarm_downloads:
+            peers = self.live_peers()
+        with measure(self.metrics, "download", progress, kind=item_type.lower()) as progress:
+            download_item(ip, self.port, item_name, item_type, save_path,
+                          chunk_size=self.chunk_size, socket_buffer_size=self.socket_buffer_size,
+                          compress=self.compress_transfers, streams=self.download_streams,
+                          parallel_threshold=self.parallel_threshold, peers=peers or None,
+                          progress=self.download_limiter.meter(ip, BULK, progress), verify=self.verify_downloads)
+
+    def download_small(self, ip, item_names, save_path, progress=None):
+        """Fetch small files in one batch; returns the names ip could not send."""
+        with measure(self.metrics, "download", progress, kind="batch") as progress:
+            return download_batch(ip, self.port, item_names, save_path, chunk_size=self.chunk_size,
+                                  socket_buffer_size=self.socket_buffer_size, compress=self.compress_transfers,
+                                  progress=self.download_limiter.meter(ip, SMALL, progress),
+                                  verify=self.verify_downloads)
+
+    def test_connection(self, ip, timeout=5):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.settimeout(timeout)
+            s.connect((ip, self.port))
+            s.sendall(b"TEST_CONNECTION")
+            return s.recv(1024) == b"CONNECTION_OK"
+
+
+def plan_import(sources, folder=""):
+    """([(source file, share path, size)], [share folders to create]) for importing sources under folder."""
+    folder = folder.strip("/")
+    jobs, folders = [], []
+    for source in sources:
+        source = os.path.normpath(source)
+        base = "/".join(filter(None, [folder, os.path.basename(source)]))
+        if not os.path.isdir(source):
+            jobs.append((source, base, os.path.getsize(source)))
+            continue
+        for root, dirs, files in os.walk(source):
+            dirs[:] = sorted(name for name in dirs if not is_internal(name))
+            rel_root = os.path.relpath(root, source).replace(os.sep, "/")
+            rel_root = base if rel_root == "." else f"{base}/{rel_root}"
+            folders.append(rel_root)
+            for name in sorted(files):
+                if is_internal(name):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    jobs.append((path, f"{rel_root}/{name}", os.path.getsize(path)))
+                except OSError as e:
+                    logging.warning(f"Skipping {path}: {str(e)}")
+    for _, rel_path, _ in jobs:
+        if "/" in rel_path:
+            folders.append(rel_path.rpartition("/")[0])
+    return jobs, sorted(set(folders))
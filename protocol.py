@@ -0,0 +1,164 @@
+import struct
+
+MAX_REQUEST_SIZE = 64 * 1024
+MAX_REQUEST_BODY = 16 * 1024 * 1024
+
+# Session protocol: after a "SESSION:<version>" request and a one-byte reply with
+# the agreed version, both sides exchange frames of (request id, type, payload
+# length) + payload. A request frame carries an ordinary request; the reply comes
+# back as data frames for the same id and ends with an end frame. Cancel asks
+# the server to stop a reply the client no longer wants. From version 2 the
+# server sends a reply's data only while it holds credit for it: a window of
+# bytes to begin with, then whatever the client grants with credit frames as
+# it reads, so a slow reader holds up its own reply rather than filling memory.
+SESSION_VERSION = 2
+FRAME_HEADER = struct.Struct("!IBI")
+FRAME_REQUEST = 1
+FRAME_DATA = 2
+FRAME_END = 3
+FRAME_CANCEL = 4
+FRAME_CREDIT = 5
+CREDIT = struct.Struct("!I")
+
+# Binary file-list page: version, flags, the sender's index generation, string
+# count, entry count, next-cursor length; then the cursor, the string table
+# (u16 length + UTF-8 each) and the entries. Folder paths and names are stored
+# once in the table and referenced by index.
+FILE_LIST_VERSION = 2
+PAGE_HEADER = struct.Struct("!BBQIIH")
+PAGE_IS_DELTA = 1
+STRING_LENGTH = struct.Struct("!H")
+LIST_ENTRY = struct.Struct("!IIBQQ")
+ENTRY_IS_FOLDER = 1
+ENTRY_HAS_HASH = 2
+ENTRY_REMOVED = 4
+HASH_BYTES = 32
+
+
+def format_request(head, body=None, **options):
+    """Encode a request; a body (bytes) follows the blank line and is announced by a body=<length> option."""
+    if body is not None:
+        options["body"] = len(body)
+    lines = [head]
+    for key, value in options.items():
+        if value is None:
+            continue
+        if isinstance(value, (list, tuple)):
+            value = ",".join(str(v) for v in value)
+        lines.append(f"{key}={value}")
+    return ("\n".join(lines) + "\n\n").encode() + (body or b"")
+
+
+def read_request(conn):
+    """Return (command, argument, options) for one request read from conn.
+
+    Requests are a head line such as ``DOWNLOAD:<name>`` followed by optional
+    ``key=value`` lines and a blank line, then the body if a ``body`` option
+    gives its length. Older peers send the bare head with no newline at all,
+    which is still accepted.
+    """
+    data = conn.recv(1024)
+    if b"\n" in data:
+        while b"\n\n" not in data:
+            if len(data) > MAX_REQUEST_SIZE:
+                raise ValueError("Request header too large")
+            chunk = conn.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+    return parse_request(data, conn)
+
+
+def parse_request(data, conn=None):
+    """Parse a request already in data; conn, if given, supplies the rest of a body not yet read."""
+    head, _, rest = data.partition(b"\n\n")
+    lines = head.decode().split("\n")
+    command, _, argument = lines[0].partition(":")
+    options = {}
+    for line in lines[1:]:
+        if not line:
+            break
+        key, _, value = line.partition("=")
+        options[key] = value
+    if "body" in options:
+        size = int(options["body"])
+        if size > MAX_REQUEST_BODY:
+            raise ValueError("Request body too large")
+        while conn is not None and len(rest) < size:
+            chunk = conn.recv(min(size - len(rest), 1024 * 1024))
+            if not chunk:
+                break
+            rest += chunk
+        if len(rest) < size:
+            raise ConnectionError("Request body was cut short")
+        options["body"] = rest[:size]
+    return command, argument, options
+
+
+def encode_file_list_page(entries, next_cursor=None, generation=0, delta=False):
+    strings = {}
+
+    def intern(value):
+        if value not in strings:
+            strings[value] = len(strings)
+        return strings[value]
+
+    body = bytearray()
+    for entry in entries:
+        folder, _, name = entry["name"].rpartition("/")
+        flags = ENTRY_IS_FOLDER if entry["type"] == "folder" else 0
+        if entry.get("hash"):
+            flags |= ENTRY_HAS_HASH
+        if entry.get("removed"):
+            flags |= ENTRY_REMOVED
+        body += LIST_ENTRY.pack(intern(folder), intern(name), flags, entry.get("size") or 0,
+                                entry.get("mtime_ns") or 0)
+        if flags & ENTRY_HAS_HASH:
+            body += bytes.fromhex(entry["hash"])
+
+    cursor = (next_cursor or "").encode()
+    page = bytearray(PAGE_HEADER.pack(FILE_LIST_VERSION, PAGE_IS_DELTA if delta else 0, generation, len(strings),
+                                      len(entries), len(cursor)))
+    page += cursor
+    for value in strings:
+        encoded = value.encode()
+        page += STRING_LENGTH.pack(len(encoded)) + encoded
+    page += body
+    return bytes(page)
+
+
+def decode_file_list_page(page):
+    """Return (entries, next_cursor, generation, delta) from a page built by encode_file_list_page."""
+    version, page_flags, generation, string_count, entry_count, cursor_length = PAGE_HEADER.unpack_from(page, 0)
+    if version != FILE_LIST_VERSION:
+        raise ValueError(f"Unsupported file list version {version}")
+    offset = PAGE_HEADER.size
+    next_cursor = page[offset:offset + cursor_length].decode() or None
+    offset += cursor_length
+    strings = []
+    for _ in range(string_count):
+        (length,) = STRING_LENGTH.unpack_from(page, offset)
+        offset += STRING_LENGTH.size
+        strings.append(page[offset:offset + length].decode())
+        offset += length
+    entries = []
+    for _ in range(entry_count):
+        folder_index, name_index, flags, size, mtime_ns = LIST_ENTRY.unpack_from(page, offset)
+        offset += LIST_ENTRY.size
+        content_hash = None
+        if flags & ENTRY_HAS_HASH:
+            content_hash = page[offset:offset + HASH_BYTES].hex()
+            offset += HASH_BYTES
+        folder = strings[folder_index]
+        name = strings[name_index]
+        entry = {
+            "name": f"{folder}/{name}" if folder else name,
+            "type": "folder" if flags & ENTRY_IS_FOLDER else "file",
+            "size": size,
+            "mtime_ns": mtime_ns,
+            "hash": content_hash,
+        }
+        if flags & ENTRY_REMOVED:
+            entry["removed"] = True
+        entries.append(entry)
+    return entries, next_cursor, generation, bool(page_flags & PAGE_IS_DELTA)
@@ -0,0 +1,220 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+
+# Priority classes, most urgent first: file lists and manifests, then small
+# files, then bulk transfers. Waiters for a bucket are served in this order.
+INTERACTIVE = 0
+SMALL = 1
+BULK = 2
+# Files below this size count as SMALL.
+SMALL_TRANSFER_SIZE = 8 * 1024 * 1024
+
+# Throttled sends go out in pieces of this size, so a waiting interactive reply
+# is never stuck behind one large write.
+QUANTUM = 256 * 1024
+BURST_SECONDS = 0.25
+MIN_BURST = 64 * 1024
+SCHEDULE_CHECK_INTERVAL = 30
+
+UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_rate(text):
+    """Bytes per second from "500K", "2M", "1.5G" or a plain number; "", "0" or "off" mean unlimited."""
+    text = (text or "").strip().upper().rstrip("B/S")
+    if text in ("", "0", "OFF", "NONE"):
+        return None
+    unit = text[-1] if text[-1] in UNITS else ""
+    return int(float(text[:len(text) - len(unit)]) * UNITS[unit])
+
+
+def parse_schedule(text):
+    """[(start minute, end minute, rate)] from "08:00-18:00=2M,18:00-08:00=off"; windows may wrap midnight."""
+    schedule = []
+    for part in filter(None, (part.strip() for part in (text or "").split(","))):
+        window, _, rate = part.partition("=")
+        start, _, end = window.partition("-")
+        schedule.append((to_minute(start), to_minute(end), parse_rate(rate)))
+    return schedule
+
+
+def to_minute(clock):
+    hours, _, minutes = clock.strip().partition(":")
+    return int(hours) * 60 + int(minutes or 0)
+
+
+class TokenBucket:
+    """Classic token bucket: rate bytes/s refill, at most burst banked.
+
+    consume() blocks until its bytes are allowed. Callers queue by priority and
+    then arrival, and only the head of the queue takes tokens, so a bulk
+    transfer cannot drain the bucket ahead of a waiting file-list reply. A
+    request larger than the burst is let through once the bucket is full and
+    leaves it in debt, which later callers wait out.
+    """
+
+    def __init__(self, rate=None, burst=None):
+        self.condition = threading.Condition()
+        self.waiting = []
+        self.sequence = itertools.count()
+        self.rate = None
+        self.burst = None
+        self.tokens = 0
+        self.updated = time.monotonic()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        with self.condition:
+            self.refill(time.monotonic())
+            self.rate = rate or None
+            self.burst = (burst or max(int(rate * BURST_SECONDS), MIN_BURST)) if rate else None
+            self.tokens = self.burst if self.burst is not None else 0
+            self.condition.notify_all()
+
+    def refill(self, now):
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, count, priority=BULK):
+        if not self.rate:
+            return
+        with self.condition:
+            ticket = (priority, next(self.sequence))
+            heapq.heappush(self.waiting, ticket)
+            try:
+                while self.rate:
+                    self.refill(time.monotonic())
+                    need = min(count, self.burst)
+                    if self.waiting[0] != ticket:
+                        self.condition.wait()
+                    elif self.tokens >= need:
+                        self.tokens -= count
+                        return
+                    else:
+                        self.condition.wait((need - self.tokens) / self.rate)
+            finally:
+                self.waiting.remove(ticket)
+                heapq.heapify(self.waiting)
+                self.condition.notify_all()
+
+
+class RateLimiter:
+    """A global cap plus a cap per peer, optionally varying with the time of day.
+
+    schedule is a list of (start minute, end minute, rate) windows, as returned by
+    parse_schedule; outside every window the global rate applies. So
+    RateLimiter(None, schedule=parse_schedule("08:00-18:00=2M")) seeds at full
+    speed at night and at 2 MB/s during office hours.
+    """
+
+    def __init__(self, rate=None, peer_rate=None, schedule=None):
+        self.rate = rate
+        self.peer_rate = peer_rate
+        self.schedule = schedule or []
+        self.global_bucket = TokenBucket(self.scheduled_rate())
+        self.peer_buckets = {}
+        self.lock = threading.Lock()
+        self.checked = time.monotonic()
+
+    @property
+    def limited(self):
+        return bool(self.rate or self.peer_rate or self.schedule)
+
+    def scheduled_rate(self, now=None):
+        now = now or time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        for start, end, rate in self.schedule:
+            inside = start <= minute < end if start <= end else (minute >= start or minute < end)
+            if inside:
+                return rate
+        return self.rate
+
+    def set_rates(self, rate=None, peer_rate=None, schedule=None):
+        with self.lock:
+            self.rate = rate
+            self.peer_rate = peer_rate
+            self.schedule = schedule or []
+            for bucket in self.peer_buckets.values():
+                bucket.set_rate(peer_rate)
+        self.global_bucket.set_rate(self.scheduled_rate())
+
+    def consume(self, ip, count, priority=BULK):
+        if self.schedule and time.monotonic() - self.checked > SCHEDULE_CHECK_INTERVAL:
+            self.checked = time.monotonic()
+            rate = self.scheduled_rate()
+            if rate != self.global_bucket.rate:
+                self.global_bucket.set_rate(rate)
+        if self.peer_rate:
+            with self.lock:
+                bucket = self.peer_buckets.get(ip)
+                if bucket is None:
+                    bucket = self.peer_buckets[ip] = TokenBucket(self.peer_rate)
+            bucket.consume(count, priority)
+        self.global_bucket.consume(count, priority)
+
+    def wrap(self, conn, ip, priority=BULK):
+        """conn itself when nothing is limited, else a stand-in whose sends are paced."""
+        return ThrottledConnection(conn, self, ip, priority) if self.limited else conn
+
+    def meter(self, ip, priority=BULK, progress=None):
+        """A progress object that paces receiving: each add() waits for tokens, then reaches progress.
+
+        The wait holds up the reader, so the sender is held back too: by TCP on
+        a plain connection, by stream credit on a session.
+        """
+        return Meter(self, ip, priority, progress) if self.limited else progress
+
+
+class ThrottledConnection:
+    """Paces sendall/sendfile on a connection or session channel through a RateLimiter."""
+
+    def __init__(self, conn, limiter, ip, priority):
+        self.conn = conn
+        self.limiter = limiter
+        self.ip = ip
+        self.priority = priority
+
+    def sendall(self, data):
+        view = memoryview(data).cast("B")
+        while view:
+            piece = view[:QUANTUM]
+            self.limiter.consume(self.ip, len(piece), self.priority)
+            self.conn.sendall(piece)
+            view = view[QUANTUM:]
+
+    def sendfile(self, f, offset=0, count=None):
+        if count is None:
+            count = os.fstat(f.fileno()).st_size - offset
+        sent = 0
+        while sent < count:
+            n = min(QUANTUM, count - sent)
+            self.limiter.consume(self.ip, n, self.priority)
+            got = self.conn.sendfile(f, offset + sent, n)
+            sent += got
+            if got < n:
+                break
+        return sent
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+class Meter:
+    def __init__(self, limiter, ip, priority, progress=None):
+        self.limiter = limiter
+        self.ip = ip
+        self.priority = priority
+        self.progress = progress
+
+    def set_total(self, total):
+        if self.progress is not None:
+            self.progress.set_total(total)
+
+    def add(self, count):
+        self.limiter.consume(self.ip, count, self.priority)
+        if self.progress is not None:
+            self.progress.add(count)
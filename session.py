@@ -0,0 +1,455 @@
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+from collections import deque
+
+from protocol import (CREDIT, FRAME_CANCEL, FRAME_CREDIT, FRAME_DATA, FRAME_END, FRAME_HEADER, FRAME_REQUEST,
+                      SESSION_VERSION, format_request, parse_request)
+from transfer import SOCKET_BUFFER_SIZE, recv_exact, recv_into_exact, tune_socket
+
+# Replies are cut into frames of at most this size so one large transfer cannot
+# hold the connection while other requests on it are waiting.
+MAX_FRAME_DATA = 1024 * 1024
+# Reply bytes a client will hold for one stream before its reader catches up (session version 2).
+STREAM_WINDOW = 4 * 1024 * 1024
+# Requests a server works on at once for one session; later ones queue behind them.
+SESSION_WINDOW = 8
+# Request bytes a session may have queued beyond its window; more are refused with an empty reply.
+MAX_QUEUED_BYTES = 4 * 1024 * 1024
+# Smaller payloads go out in the same write as their frame header.
+COALESCE_LIMIT = 64 * 1024
+SESSION_IDLE_TIMEOUT = 300
+LEGACY_RETRY_INTERVAL = 600
+
+
+def set_nodelay(sock):
+    # Many small frames go out back to back; Nagle would hold each behind the last ACK.
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        pass
+
+
+class Channel:
+    """Socket-like reply side of one request on a server session.
+
+    Handlers written for a plain connection (sendall, sendfile, close) work on it
+    unchanged; what they send becomes data frames for the request's id.
+    """
+
+    def __init__(self, session, request_id, credit=None):
+        self.session = session
+        self.request_id = request_id
+        self.cancelled = False
+        self.closed = False
+        # Bytes the client still has room for; None if it grants no credit (session version 1).
+        self.credit = credit
+
+    def settimeout(self, timeout):
+        pass
+
+    def sendall(self, data):
+        view = memoryview(data).cast("B")
+        while view:
+            n = self.session.reserve(self, min(len(view), MAX_FRAME_DATA))
+            self.session.send_frame(self, FRAME_DATA, view[:n])
+            view = view[n:]
+
+    def sendfile(self, f, offset=0, count=None):
+        if count is None:
+            count = os.fstat(f.fileno()).st_size - offset
+        sent = 0
+        while sent < count:
+            n = self.session.reserve(self, min(MAX_FRAME_DATA, count - sent))
+            self.session.send_file_frame(self, f, offset + sent, n)
+            sent += n
+        return sent
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.session.finish(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ServerSession:
+    """Reads request frames from one peer connection and hands each to dispatch(channel, command, argument, options).
+
+    dispatch runs the request elsewhere and must eventually close the channel,
+    which ends the reply and frees its place in the window. Requests beyond the
+    window wait in a queue, so frames (cancels, credit) keep being read meanwhile.
+    """
+
+    def __init__(self, conn, addr, dispatch, window=SESSION_WINDOW, version=SESSION_VERSION):
+        self.conn = conn
+        self.addr = addr
+        self.dispatch = dispatch
+        self.window = window
+        self.active = 0
+        self.queued = deque()
+        self.queued_bytes = 0
+        self.version = version
+        self.write_lock = threading.Lock()
+        self.channels = {}
+        self.lock = threading.Lock()
+        self.credit_changed = threading.Condition()
+        self.closed = False
+
+    def run(self):
+        try:
+            self.conn.settimeout(SESSION_IDLE_TIMEOUT)
+            set_nodelay(self.conn)
+            while True:
+                request_id, kind, length = FRAME_HEADER.unpack(recv_exact(self.conn, FRAME_HEADER.size))
+                payload = recv_exact(self.conn, length)
+                if kind in (FRAME_CANCEL, FRAME_CREDIT):
+                    with self.lock:
+                        channel = self.channels.get(request_id)
+                    if channel:
+                        with self.credit_changed:
+                            if kind == FRAME_CANCEL:
+                                channel.cancelled = True
+                            elif channel.credit is not None:
+                                channel.credit += CREDIT.unpack(payload)[0]
+                            self.credit_changed.notify_all()
+                    continue
+                if kind != FRAME_REQUEST:
+                    raise ValueError(f"Unexpected frame type {kind}")
+                channel = Channel(self, request_id, STREAM_WINDOW if self.version >= 2 else None)
+                with self.lock:
+                    self.channels[request_id] = channel
+                    start = self.active < self.window
+                    if start:
+                        self.active += 1
+                    elif self.queued_bytes + len(payload) <= MAX_QUEUED_BYTES:
+                        self.queued.append((channel, payload))
+                        self.queued_bytes += len(payload)
+                        continue
+                if start:
+                    self.start(channel, payload)
+                else:
+                    logging.warning(f"Too many requests queued on session with {self.addr}; refusing one")
+                    channel.closed = True
+                    self.end(channel)
+        except (socket.timeout, ConnectionError, OSError) as e:
+            logging.debug(f"Session with {self.addr} ended: {str(e)}")
+        finally:
+            self.close()
+
+    def start(self, channel, payload):
+        if channel.cancelled:
+            channel.close()
+            return
+        try:
+            self.dispatch(channel, *parse_request(payload))
+        except Exception as e:
+            logging.error(f"Bad request on session with {self.addr}: {str(e)}")
+            channel.close()
+
+    def check(self, channel):
+        if channel.cancelled:
+            raise ConnectionError(f"Request {channel.request_id} was cancelled")
+        if self.closed:
+            raise ConnectionError(f"Session with {self.addr} was closed")
+
+    def reserve(self, channel, count):
+        """Wait until the client has room for some of the reply, then take up to count bytes of it."""
+        if channel.credit is None:
+            return count
+        with self.credit_changed:
+            while channel.credit <= 0:
+                self.check(channel)
+                self.credit_changed.wait()
+            count = min(count, channel.credit)
+            channel.credit -= count
+            return count
+
+    def send_frame(self, channel, kind, data=b""):
+        self.check(channel)
+        header = FRAME_HEADER.pack(channel.request_id, kind, len(data))
+        with self.write_lock:
+            if len(data) <= COALESCE_LIMIT:
+                self.conn.sendall(header + bytes(data))
+            else:
+                self.conn.sendall(header)
+                self.conn.sendall(data)
+
+    def send_file_frame(self, channel, f, offset, count):
+        self.check(channel)
+        with self.write_lock:
+            self.conn.sendall(FRAME_HEADER.pack(channel.request_id, FRAME_DATA, count))
+            sent = self.conn.sendfile(f, offset, count)
+            if sent != count:
+                # The frame promised count bytes; the stream cannot be resynchronised.
+                self.conn.shutdown(socket.SHUT_RDWR)
+                raise ConnectionError("File shrank while it was being sent")
+
+    def finish(self, channel):
+        """End channel's reply and start the next queued request in its place."""
+        self.end(channel)
+        with self.lock:
+            following = self.queued.popleft() if self.queued and not self.closed else None
+            if following is None:
+                self.active -= 1
+            else:
+                self.queued_bytes -= len(following[1])
+        if following is not None:
+            self.start(*following)
+
+    def end(self, channel):
+        with self.lock:
+            self.channels.pop(channel.request_id, None)
+        try:
+            with self.write_lock:
+                self.conn.sendall(FRAME_HEADER.pack(channel.request_id, FRAME_END, 0))
+        except OSError:
+            pass
+
+    def close(self):
+        with self.credit_changed:
+            self.closed = True
+            self.credit_changed.notify_all()
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.conn.close()
+
+
+class Stream:
+    """Client side of one request on a Session, with the recv/sendall/close surface of a socket.
+
+    The first sendall() carries the whole request; the reply is read with recv or
+    recv_into and ends (recv returns nothing) when the server finishes it. On a
+    version 2 session, what has been read is granted back to the server as
+    credit, so at most STREAM_WINDOW bytes wait here however slow the reader.
+    """
+
+    def __init__(self, session, request_id, timeout):
+        self.session = session
+        self.request_id = request_id
+        self.timeout = timeout
+        self.buffers = deque()
+        self.condition = threading.Condition()
+        self.finished = False
+        self.error = None
+        self.sent = False
+        self.consumed = 0
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def sendall(self, data):
+        if self.sent:
+            raise ValueError("A session stream carries a single request")
+        self.sent = True
+        self.session.send_frame(self.request_id, FRAME_REQUEST, data)
+
+    def feed(self, data):
+        with self.condition:
+            self.buffers.append(memoryview(data))
+            self.condition.notify()
+
+    def finish(self, error=None):
+        with self.condition:
+            self.finished = True
+            self.error = error
+            self.condition.notify()
+
+    def recv_into(self, view, nbytes=0):
+        view = memoryview(view).cast("B")
+        if nbytes:
+            view = view[:nbytes]
+        with self.condition:
+            deadline = None if self.timeout is None else time.monotonic() + self.timeout
+            while not self.buffers and not self.finished:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise socket.timeout(f"Timed out waiting for a reply from {self.session.ip}")
+                self.condition.wait(remaining)
+            if not self.buffers:
+                if self.error:
+                    raise ConnectionError(self.error)
+                return 0
+            received = 0
+            while self.buffers and received < len(view):
+                chunk = self.buffers[0]
+                n = min(len(chunk), len(view) - received)
+                view[received:received + n] = chunk[:n]
+                received += n
+                if n == len(chunk):
+                    self.buffers.popleft()
+                else:
+                    self.buffers[0] = chunk[n:]
+            grant = 0
+            if self.session.version >= 2 and not self.finished:
+                self.consumed += received
+                # Granting in half-window steps keeps credit frames rare without ever running dry.
+                if self.consumed >= STREAM_WINDOW // 2:
+                    grant, self.consumed = self.consumed, 0
+        if grant:
+            try:
+                self.session.send_frame(self.request_id, FRAME_CREDIT, CREDIT.pack(grant))
+            except OSError:
+                pass
+        return received
+
+    def recv(self, size):
+        buffer = bytearray(size)
+        n = self.recv_into(buffer)
+        return bytes(buffer[:n])
+
+    def close(self):
+        with self.condition:
+            done = self.finished
+            self.finished = True
+            self.buffers.clear()
+        self.session.forget(self.request_id, cancel=not done)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Session:
+    """One long-lived connection to a peer carrying many concurrent requests."""
+
+    def __init__(self, ip, port, timeout=10, socket_buffer_size=SOCKET_BUFFER_SIZE):
+        self.ip = ip
+        self.timeout = timeout
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            tune_socket(self.sock, socket_buffer_size)
+            self.sock.settimeout(timeout)
+            self.sock.connect((ip, port))
+            set_nodelay(self.sock)
+            self.sock.sendall(format_request(f"SESSION:{SESSION_VERSION}"))
+            reply = self.sock.recv(1)
+            if not reply:
+                # Peers without session support close the connection on an unknown request.
+                raise NotImplementedError(f"{ip} does not support sessions")
+            self.version = struct.unpack("!B", reply)[0]
+            self.sock.settimeout(None)
+        except BaseException:
+            self.sock.close()
+            raise
+        self.streams = {}
+        self.next_id = 1
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.closed = False
+        threading.Thread(target=self.read_frames, daemon=True).start()
+
+    def open_stream(self, timeout=None):
+        with self.lock:
+            if self.closed:
+                raise ConnectionError(f"Session with {self.ip} is closed")
+            request_id = self.next_id
+            self.next_id += 1
+            stream = Stream(self, request_id, self.timeout if timeout is None else timeout)
+            self.streams[request_id] = stream
+        return stream
+
+    def send_frame(self, request_id, kind, data=b""):
+        try:
+            with self.write_lock:
+                self.sock.sendall(FRAME_HEADER.pack(request_id, kind, len(data)) + data)
+        except OSError:
+            self.close(f"Session with {self.ip} was lost")
+            raise
+
+    def forget(self, request_id, cancel=False):
+        with self.lock:
+            known = self.streams.pop(request_id, None) is not None
+        if cancel and known and not self.closed:
+            try:
+                self.send_frame(request_id, FRAME_CANCEL)
+            except OSError:
+                pass
+
+    def read_frames(self):
+        error = f"Session with {self.ip} was closed"
+        try:
+            while True:
+                request_id, kind, length = FRAME_HEADER.unpack(recv_exact(self.sock, FRAME_HEADER.size))
+                data = bytearray(length)
+                if length:
+                    recv_into_exact(self.sock, memoryview(data))
+                with self.lock:
+                    stream = self.streams.get(request_id)
+                    if kind == FRAME_END:
+                        self.streams.pop(request_id, None)
+                if stream is None:
+                    continue
+                if kind == FRAME_DATA:
+                    stream.feed(data)
+                elif kind == FRAME_END:
+                    stream.finish()
+        except (ConnectionError, OSError) as e:
+            error = f"Session with {self.ip} was lost: {str(e)}"
+        finally:
+            self.close(error)
+
+    def close(self, error=None):
+        with self.lock:
+            self.closed = True
+            streams = list(self.streams.values())
+            self.streams.clear()
+        for stream in streams:
+            stream.finish(error or f"Session with {self.ip} was closed")
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class SessionPool:
+    """Keeps one Session per peer and reuses it for every request to that peer."""
+
+    def __init__(self):
+        self.sessions = {}
+        self.legacy = {}
+        self.connecting = {}
+        self.lock = threading.Lock()
+
+    def open_stream(self, ip, port, timeout=10, socket_buffer_size=SOCKET_BUFFER_SIZE):
+        """A new stream to (ip, port), or None if the peer only speaks one request per connection."""
+        key = (ip, port)
+        with self.lock:
+            if time.monotonic() < self.legacy.get(key, 0):
+                return None
+            session = self.sessions.get(key)
+            # Connecting to one slow peer must not hold up requests to the others.
+            connect_lock = self.connecting.setdefault(key, threading.Lock())
+        if session is None or session.closed:
+            with connect_lock:
+                with self.lock:
+                    session = self.sessions.get(key)
+                if session is None or session.closed:
+                    try:
+                        session = Session(ip, port, timeout, socket_buffer_size)
+                    except NotImplementedError:
+                        with self.lock:
+                            self.legacy[key] = time.monotonic() + LEGACY_RETRY_INTERVAL
+                        return None
+                    with self.lock:
+                        self.sessions[key] = session
+        return session.open_stream(timeout)
+
+    def close(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+        for session in sessions:
+            session.close()
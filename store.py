@@ -0,0 +1,239 @@
+import errno
+import logging
+import os
+import shutil
+import stat
+import sys
+import threading
+import uuid
+
+from file_index import STATE_DIRNAME
+from hashing import HASH_CHUNK_SIZE, chunk_digest, content_hash, hash_file
+
+OBJECTS_DIRNAME = "objects"
+# Objects still being copied in; never collected.
+INCOMING_PREFIX = "incoming-"
+# From linux/fs.h: make the destination share the source's blocks (btrfs, XFS, bcachefs...).
+FICLONE = 0x40049409
+
+# copy_file_range errors meaning "not between these two files", not a failed copy.
+NO_KERNEL_COPY = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF, errno.EPERM}
+
+
+def reflink(src, dst):
+    """Make dst a copy-on-write clone of src; False if this platform or filesystem cannot."""
+    if not sys.platform.startswith("linux"):
+        return False
+    import fcntl
+
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError:
+        try:
+            os.remove(dst)
+        except OSError:
+            pass
+        return False
+    return True
+
+
+def copy_and_hash(src, dst, progress=None, chunk_size=HASH_CHUNK_SIZE):
+    """Copy src to dst and return its chunk digests, reading src only once.
+
+    Each chunk is hashed from the read buffer and then copied in the kernel with
+    os.copy_file_range, which some filesystems turn into a block clone or a
+    server-side copy; where it is unavailable the buffer is written instead.
+    """
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    chunks = []
+    kernel_copy = hasattr(os, "copy_file_range")
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        position = 0
+        while True:
+            n = fsrc.readinto(buffer)
+            if not n:
+                break
+            chunks.append(chunk_digest(view[:n]))
+            copied = 0
+            while kernel_copy and copied < n:
+                try:
+                    got = os.copy_file_range(fsrc.fileno(), fdst.fileno(), n - copied,
+                                             position + copied, position + copied)
+                except OSError as e:
+                    if e.errno not in NO_KERNEL_COPY:
+                        raise
+                    kernel_copy = False
+                    break
+                if not got:
+                    raise OSError(f"{src} shrank while it was being copied")
+                copied += got
+            if copied < n:
+                fdst.seek(position + copied)
+                fdst.write(view[copied:n])
+            position += n
+            if progress is not None:
+                progress.add(n)
+    return chunks
+
+
+class ContentStore:
+    """The share's file contents, each stored once under .memo/objects/<hash> and linked wherever it is shared.
+
+    add() places a file into the share as a reflink of the stored object where
+    the filesystem supports it (an independent copy-on-write file), else as a
+    hardlink, else as a plain copy. Hardlinked files share one inode, so objects
+    are made read-only: an editor that saves in place would otherwise change
+    every copy, and the object would no longer match its name. share_in_place()
+    links to the original instead of copying at all.
+
+    An object is held from the moment add() finds or stores it until it is
+    linked into the share, and collect() leaves held objects alone.
+    """
+
+    def __init__(self, shared_directory):
+        self.shared_directory = shared_directory
+        self.objects = os.path.join(shared_directory, STATE_DIRNAME, OBJECTS_DIRNAME)
+        self.sizes = None
+        self.lock = threading.Lock()
+        # Object path -> adds about to link it.
+        self.held = {}
+
+    def object_path(self, digest):
+        return os.path.join(self.objects, digest[:2], digest)
+
+    def stored_sizes(self):
+        if self.sizes is None:
+            sizes = set()
+            for root, _, files in os.walk(self.objects):
+                for name in files:
+                    try:
+                        sizes.add(os.path.getsize(os.path.join(root, name)))
+                    except OSError:
+                        pass
+            self.sizes = sizes
+        return self.sizes
+
+    def add(self, src, dest, progress=None):
+        """Put a copy of src at dest (replacing it) and return dest's manifest, as hashing.hash_file would."""
+        os.makedirs(self.objects, exist_ok=True)
+        if os.path.getsize(src) in self.stored_sizes():
+            # Probably stored already: hashing first costs a read but saves writing a copy.
+            chunks = hash_file(src, progress=progress)["chunks"]
+            obj = self.object_path(content_hash(chunks))
+            with self.lock:
+                stored = os.path.exists(obj)
+                if stored:
+                    self.held[obj] = self.held.get(obj, 0) + 1
+            if stored:
+                return self.place(obj, dest, src, chunks)
+            progress = None
+        temp = os.path.join(self.objects, f"{INCOMING_PREFIX}{uuid.uuid4().hex}")
+        try:
+            if reflink(src, temp):
+                # The clone cost no data copying; hash it (one read) to learn its name.
+                chunks = hash_file(temp, progress=progress)["chunks"]
+            else:
+                chunks = copy_and_hash(src, temp, progress)
+            obj = self.object_path(content_hash(chunks))
+            with self.lock:
+                if os.path.exists(obj):
+                    logging.debug(f"{src} is already stored as {obj}")
+                else:
+                    shutil.copystat(src, temp)
+                    os.makedirs(os.path.dirname(obj), exist_ok=True)
+                    os.replace(temp, obj)
+                    make_read_only(obj)
+                    self.stored_sizes().add(os.path.getsize(obj))
+                self.held[obj] = self.held.get(obj, 0) + 1
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+        return self.place(obj, dest, src, chunks)
+
+    def place(self, obj, dest, src, chunks):
+        """Link the held object obj at dest and let it go; returns dest's manifest."""
+        try:
+            self.link(obj, dest, src)
+        finally:
+            with self.lock:
+                self.held[obj] -= 1
+                if not self.held[obj]:
+                    del self.held[obj]
+        st = os.stat(dest)
+        return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "chunk_size": HASH_CHUNK_SIZE,
+                "hash": content_hash(chunks), "chunks": chunks}
+
+    def link(self, obj, dest, src):
+        # Built beside dest and moved over it, so an existing file is replaced in one step.
+        # The .part name keeps the half-made file out of the index and listings.
+        temp = f"{dest}.{uuid.uuid4().hex[:8]}.part"
+        try:
+            if reflink(obj, temp):
+                shutil.copystat(src, temp)
+            else:
+                try:
+                    os.link(obj, temp)
+                except OSError:
+                    shutil.copyfile(obj, temp)
+                    shutil.copystat(src, temp)
+            os.replace(temp, dest)
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+
+    def share_in_place(self, src, dest):
+        """Share src from where it is: dest becomes a symbolic link to it, and nothing is copied.
+
+        Where symbolic links cannot be made (Windows without the privilege, some
+        filesystems) dest becomes a hardlink to src, or failing that a copy.
+        """
+        temp = f"{dest}.{uuid.uuid4().hex[:8]}.part"
+        try:
+            try:
+                os.symlink(os.path.abspath(src), temp)
+            except OSError as e:
+                logging.debug(f"Could not make a symbolic link to {src}: {str(e)}")
+                try:
+                    os.link(src, temp)
+                except OSError:
+                    shutil.copy2(src, temp)
+            os.replace(temp, dest)
+        finally:
+            if os.path.lexists(temp):
+                os.remove(temp)
+
+    def collect(self):
+        """Remove objects nothing in the share links to any more; returns the bytes freed.
+
+        Files placed by reflink or copy never hold a link to their object, so
+        those objects go too; reflinked files keep sharing their blocks anyway.
+        """
+        freed = 0
+        for root, _, files in os.walk(self.objects):
+            for name in files:
+                if name.startswith(INCOMING_PREFIX):
+                    continue
+                path = os.path.join(root, name)
+                with self.lock:
+                    if path in self.held:
+                        continue
+                    try:
+                        st = os.stat(path)
+                        if st.st_nlink == 1:
+                            os.chmod(path, stat.S_IWRITE | stat.S_IREAD)
+                            os.remove(path)
+                            freed += st.st_size
+                    except OSError as e:
+                        logging.debug(f"Could not collect {path}: {str(e)}")
+        if freed:
+            self.sizes = None
+        return freed
+
+
+def make_read_only(path):
+    # Windows refuses to delete read-only files, and deleting from the share must keep working there.
+    if os.name != "nt":
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+        os.chmod(path, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
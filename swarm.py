@@ -0,0 +1,173 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from hashing import chunk_digest
+from networking import open_connection, request_locate, request_manifest, request_range
+from transfer import SOCKET_BUFFER_SIZE, OffsetWriter, preallocate, recv_body, write_partial_tag
+
+CONNECTIONS_PER_PEER = 2
+MAX_PEER_FAILURES = 3
+
+
+def find_sources(ip, item_name, peers, port, timeout=10, socket_buffer_size=SOCKET_BUFFER_SIZE):
+    """Return the (ip, name) sources holding the same content as ip's item_name, and its manifest.
+
+    Peers are matched through their indexes by content hash, so a copy stored
+    under a different name or folder still counts.
+    """
+    manifest = request_manifest(ip, port, item_name, timeout, socket_buffer_size)
+    peers = [peer for peer in peers if peer != ip]
+
+    def locate(peer):
+        try:
+            paths = request_locate(peer, port, manifest["hash"], timeout, socket_buffer_size)
+        except Exception as e:
+            logging.debug(f"{peer} cannot serve {item_name}: {str(e)}")
+            return None
+        return (peer, paths[0]) if paths else None
+
+    sources = [(ip, item_name)]
+    if peers:
+        with ThreadPoolExecutor(max_workers=min(16, len(peers))) as pool:
+            sources += [source for source in pool.map(locate, peers) if source]
+    return sources, manifest
+
+
+class Swarm:
+    """Hands out manifest chunks to per-peer workers and tracks which ones have been verified."""
+
+    def __init__(self, sources, manifest):
+        self.manifest = manifest
+        self.chunk_count = len(manifest["chunks"])
+        self.pending = list(range(self.chunk_count - 1, -1, -1))
+        self.in_flight = {}
+        self.done = set()
+        self.lock = threading.Lock()
+        self.failures = {source: 0 for source in sources}
+        self.received = {source: 0 for source in sources}
+
+    def record_failure(self, source):
+        with self.lock:
+            self.failures[source] += 1
+
+    def record_received(self, source, length):
+        with self.lock:
+            self.received[source] += length
+
+    def mark_done(self, index):
+        with self.lock:
+            self.done.add(index)
+            self.in_flight.pop(index, None)
+            if index in self.pending:
+                self.pending.remove(index)
+
+    def next_chunk(self):
+        with self.lock:
+            if self.pending:
+                index = self.pending.pop()
+                self.in_flight[index] = [time.monotonic(), 1]
+                return index
+            # End game: nothing is left to hand out, so race the slowest outstanding chunk
+            # on this (idle, therefore faster) peer; whichever copy verifies first is kept.
+            outstanding = [i for i in self.in_flight if i not in self.done]
+            if not outstanding:
+                return None
+            index = min(outstanding, key=lambda i: (self.in_flight[i][1], self.in_flight[i][0]))
+            self.in_flight[index][1] += 1
+            return index
+
+    def release(self, index):
+        with self.lock:
+            state = self.in_flight.get(index)
+            if state is None:
+                return
+            state[1] -= 1
+            if state[1] == 0 and index not in self.done:
+                del self.in_flight[index]
+                self.pending.append(index)
+
+    def chunk_range(self, index):
+        start = index * self.manifest["chunk_size"]
+        return start, min(self.manifest["chunk_size"], self.manifest["size"] - start)
+
+
+def fetch_chunk(source, port, start, length, timeout, socket_buffer_size):
+    ip, name = source
+    with open_connection(ip, port, timeout, socket_buffer_size) as s:
+        _, _, got_start, got_length, codec = request_range(s, name, start, length)
+        if (got_start, got_length) != (start, length):
+            raise ConnectionError(f"{ip} returned the wrong range for {name}")
+        buffer = BytesIO()
+        recv_body(s, buffer, length, codec)
+        return buffer.getbuffer()
+
+
+def swarm_download(sources, port, manifest, part_path, timeout=10, socket_buffer_size=SOCKET_BUFFER_SIZE,
+                   connections_per_peer=CONNECTIONS_PER_PEER, progress=None):
+    """Fetch manifest's chunks from all sources at once, verifying each chunk before it is written.
+
+    Workers pull chunks from a shared queue, so faster peers naturally take more of
+    the file, and a peer that keeps failing or serving bad data is dropped.
+    progress, if given, is advanced by each verified chunk.
+    """
+    swarm = Swarm(sources, manifest)
+    started = time.monotonic()
+
+    def work(source):
+        while swarm.failures[source] < MAX_PEER_FAILURES:
+            index = swarm.next_chunk()
+            if index is None:
+                return
+            start, length = swarm.chunk_range(index)
+            try:
+                data = fetch_chunk(source, port, start, length, timeout, socket_buffer_size)
+                if chunk_digest(data) != manifest["chunks"][index]:
+                    raise ValueError(f"chunk {index} failed verification")
+            except Exception as e:
+                swarm.record_failure(source)
+                swarm.release(index)
+                logging.warning(f"Swarm chunk from {source[0]} failed: {str(e)}")
+                continue
+            if index not in swarm.done:
+                OffsetWriter(fd, start).write(data)
+                swarm.mark_done(index)
+                swarm.record_received(source, length)
+            swarm.release(index)
+            if progress is not None:
+                progress.add(length)
+
+    with open(part_path, "r+b" if os.path.exists(part_path) else "wb") as f:
+        fd = f.fileno()
+        write_partial_tag(part_path, f"{manifest['size']}-{manifest['mtime_ns']}")
+        # Chunks already on disk from an interrupted attempt are kept if they verify.
+        existing = os.fstat(fd).st_size
+        for index in range(swarm.chunk_count):
+            start, length = swarm.chunk_range(index)
+            if start + length > existing:
+                break
+            f.seek(start)
+            if chunk_digest(f.read(length)) == manifest["chunks"][index]:
+                swarm.mark_done(index)
+                if progress is not None:
+                    progress.add(length)
+        preallocate(f, manifest["size"])
+        try:
+            workers = [source for source in sources for _ in range(connections_per_peer)]
+            with ThreadPoolExecutor(max_workers=len(workers), thread_name_prefix="memo-swarm") as pool:
+                for future in [pool.submit(work, source) for source in workers]:
+                    future.result()
+        finally:
+            resume_point = 0
+            while resume_point < swarm.chunk_count and resume_point in swarm.done:
+                resume_point += 1
+            f.truncate(min(resume_point * manifest["chunk_size"], manifest["size"]))
+
+    if len(swarm.done) < swarm.chunk_count:
+        raise ConnectionError(f"Every source failed; {len(swarm.done)} of {swarm.chunk_count} chunks downloaded")
+    elapsed = time.monotonic() - started
+    for source, received in swarm.received.items():
+        logging.info(f"Swarm source {source[0]}: {received / 1e6:.1f} MB ({received / elapsed / 1e6:.1f} MB/s)")
@@ -0,0 +1,175 @@
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Progress events from one task are forwarded at most this often.
+PROGRESS_INTERVAL = 0.2
+RATE_WINDOW = 5.0
+
+
+class TaskCancelled(Exception):
+    pass
+
+
+class Task:
+    """A unit of background work with progress a UI can show and a cancel flag.
+
+    Work functions receive the task and report through add()/set_total(); both
+    raise TaskCancelled once cancel() has been called, which unwinds the work at
+    its next progress report.
+    """
+
+    def __init__(self, scheduler, task_id, title, kind):
+        self.scheduler = scheduler
+        self.id = task_id
+        self.title = title
+        self.kind = kind
+        self.state = "queued"
+        self.total = None
+        self.done = 0
+        self.error = None
+        self.result = None
+        self.started = None
+        self.finished = None
+        self.cancel_event = threading.Event()
+        self.lock = threading.Lock()
+        self.samples = deque()
+        self.last_report = 0
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def check(self):
+        if self.cancel_event.is_set():
+            raise TaskCancelled(f"{self.title} was cancelled")
+
+    def set_total(self, total):
+        self.check()
+        self.total = total
+        self.report(force=True)
+
+    def add(self, count):
+        self.check()
+        with self.lock:
+            self.done += count
+        self.report()
+
+    def report(self, force=False):
+        now = time.monotonic()
+        if force or now - self.last_report >= PROGRESS_INTERVAL:
+            self.last_report = now
+            with self.lock:
+                self.samples.append((now, self.done))
+                while len(self.samples) > 2 and now - self.samples[0][0] > RATE_WINDOW:
+                    self.samples.popleft()
+            self.scheduler.events.put(("progress", self))
+
+    def rate(self):
+        """Bytes per second over the last few seconds."""
+        with self.lock:
+            if len(self.samples) < 2:
+                return 0.0
+            (t0, d0), (t1, d1) = self.samples[0], self.samples[-1]
+        return (d1 - d0) / (t1 - t0) if t1 > t0 else 0.0
+
+    def eta(self):
+        rate = self.rate()
+        if not self.total or not rate or self.state != "running":
+            return None
+        return max(0.0, (self.total - self.done) / rate)
+
+
+class TaskScheduler:
+    """Runs blocking work on background executors and reports back through a queue the UI thread polls.
+
+    Each kind of work has its own executor, so a queue of large downloads never
+    delays a file-list request. Callbacks passed to submit() run inside poll(),
+    that is on whichever thread polls (the Tk thread in the app).
+    """
+
+    def __init__(self, workers=None):
+        workers = workers or {"control": 4, "transfer": 3, "disk": 2}
+        self.executors = {kind: ThreadPoolExecutor(max_workers=count, thread_name_prefix=f"memo-{kind}")
+                          for kind, count in workers.items()}
+        self.events = queue.Queue()
+        self.tasks = {}
+        self.callbacks = {}
+        self.next_id = 1
+        self.lock = threading.Lock()
+
+    def submit(self, title, work, *args, kind="control", on_done=None, on_error=None, **kwargs):
+        """Run work(task, *args, **kwargs) on the executor for kind and return the Task."""
+        with self.lock:
+            task = Task(self, self.next_id, title, kind)
+            self.next_id += 1
+            self.tasks[task.id] = task
+            self.callbacks[task.id] = (on_done, on_error)
+        self.events.put(("queued", task))
+        self.executors[kind].submit(self.run, task, work, args, kwargs)
+        return task
+
+    def run(self, task, work, args, kwargs):
+        if task.cancelled:
+            task.state = "cancelled"
+            self.events.put(("finished", task))
+            return
+        task.state = "running"
+        task.started = time.monotonic()
+        self.events.put(("started", task))
+        try:
+            task.result = work(task, *args, **kwargs)
+            task.state = "done"
+        except TaskCancelled:
+            task.state = "cancelled"
+        except Exception as e:
+            task.state = "failed"
+            task.error = e
+            logging.error(f"{task.title} failed: {str(e)}")
+        finally:
+            task.finished = time.monotonic()
+            task.report(force=True)
+            self.events.put(("finished", task))
+
+    def cancel(self, task_id):
+        task = self.tasks.get(task_id)
+        if task:
+            task.cancel()
+
+    def poll(self):
+        """Drain pending events, run completion callbacks, and return the tasks that changed."""
+        changed = {}
+        try:
+            while True:
+                event, task = self.events.get_nowait()
+                changed[task.id] = task
+                if event != "finished":
+                    continue
+                with self.lock:
+                    on_done, on_error = self.callbacks.pop(task.id, (None, None))
+                try:
+                    if task.state == "done" and on_done:
+                        on_done(task.result)
+                    elif task.state == "failed" and on_error:
+                        on_error(task.error)
+                except Exception as e:
+                    logging.error(f"Callback for {task.title} failed: {str(e)}")
+        except queue.Empty:
+            pass
+        return list(changed.values())
+
+    def forget(self, task_id):
+        with self.lock:
+            self.tasks.pop(task_id, None)
+
+    def shutdown(self):
+        for task in list(self.tasks.values()):
+            task.cancel()
+        for executor in self.executors.values():
+            executor.shutdown(wait=False)
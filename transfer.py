@@ -0,0 +1,570 @@
+import os
+import queue
+import shutil
+import socket
+import struct
+import threading
+from collections import deque
+from io import BytesIO
+from compression import BLOCK_HEADER, BLOCK_SIZE, CODECS_BY_ID, MAX_BLOCK_SIZE, choose_codec, compress_block
+from hashing import DIGEST_SIZE, ChunkVerifier, VerifyingWriter, data_hash
+
+CHUNK_SIZE = 1024 * 1024
+SOCKET_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Reply to a ranged DOWNLOAD: file size, mtime_ns, first byte sent, bytes sent.
+RANGE_HEADER = struct.Struct("!QQQQ")
+PARTIAL_SUFFIX = ".part"
+PARALLEL_THRESHOLD = 64 * 1024 * 1024
+
+# Folder stream entry: kind, codec id (0 = raw), path length, file size,
+# then the UTF-8 path and the file body.
+ENTRY_HEADER = struct.Struct("!BBHQ")
+ENTRY_END = 0
+ENTRY_FILE = 1
+ENTRY_DIR = 2
+# Batch streams only: a requested file the sender could not open.
+ENTRY_MISSING = 3
+# Sent after a file body when the receiver asked to verify: the file's content
+# hash (hashing.content_hash), DIGEST_SIZE raw bytes in place of a path.
+ENTRY_HASH = 4
+
+# Files up to this size are gathered into the sender's write buffer instead of
+# getting a sendfile() of their own, and are saved by the receiver's writer thread.
+SMALL_FILE_SIZE = 256 * 1024
+MAX_PENDING_WRITES = 64 * 1024 * 1024
+
+
+def send_file(conn, f, offset=0, count=None, use_sendfile=True):
+    """Send count bytes (default: to EOF) of an open binary file, zero-copy where the OS allows it."""
+    if count == 0:
+        return 0
+    if use_sendfile and hasattr(os, "sendfile"):
+        try:
+            f.fileno()
+        except (AttributeError, OSError):
+            pass
+        else:
+            return conn.sendfile(f, offset, count)
+    return send_file_buffered(conn, f, offset, count)
+
+
+def send_file_buffered(conn, f, offset=0, count=None, chunk_size=CHUNK_SIZE):
+    f.seek(offset)
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    sent = 0
+    while count is None or sent < count:
+        want = chunk_size if count is None else min(chunk_size, count - sent)
+        n = f.readinto(view[:want])
+        if not n:
+            break
+        conn.sendall(view[:n])
+        sent += n
+    return sent
+
+
+class CoalescingWriter:
+    """Stands in for a connection and gathers small sends and small files into buffer-sized writes.
+
+    Files too big for the buffer are still sent zero-copy; call flush() at the end.
+    """
+
+    def __init__(self, conn, buffer_size=CHUNK_SIZE, small_file_size=SMALL_FILE_SIZE):
+        self.conn = conn
+        self.view = memoryview(bytearray(buffer_size))
+        self.used = 0
+        self.small_file_size = small_file_size
+
+    def sendall(self, data):
+        data = memoryview(data).cast("B")
+        if self.used + len(data) > len(self.view):
+            self.flush()
+        if len(data) >= len(self.view):
+            self.conn.sendall(data)
+            return
+        self.view[self.used:self.used + len(data)] = data
+        self.used += len(data)
+
+    def sendfile(self, f, offset=0, count=None):
+        if count is None:
+            count = os.fstat(f.fileno()).st_size - offset
+        if count > self.small_file_size:
+            self.flush()
+            return self.conn.sendfile(f, offset, count)
+        if self.used + count > len(self.view):
+            self.flush()
+        f.seek(offset)
+        got = 0
+        while got < count:
+            n = f.readinto(self.view[self.used + got:self.used + count])
+            if not n:
+                break
+            got += n
+        self.used += got
+        f.seek(offset + got)
+        return got
+
+    def flush(self):
+        if self.used:
+            self.conn.sendall(self.view[:self.used])
+            self.used = 0
+
+
+class FileWriter:
+    """Saves whole files on a background thread so the socket reader never waits on the disk.
+
+    write() only blocks once max_pending bytes are queued; close() waits for the
+    queue to drain and re-raises the first write error.
+    """
+
+    def __init__(self, max_pending=MAX_PENDING_WRITES):
+        self.max_pending = max_pending
+        self.pending = 0
+        self.condition = threading.Condition()
+        self.queue = queue.Queue()
+        self.error = None
+        self.made_dirs = set()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, path, data):
+        if self.error:
+            raise self.error
+        with self.condition:
+            while self.pending and self.pending + len(data) > self.max_pending:
+                self.condition.wait()
+            self.pending += len(data)
+        self.queue.put((path, data))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            path, data = item
+            try:
+                if self.error is None:
+                    directory = os.path.dirname(path)
+                    if directory not in self.made_dirs:
+                        os.makedirs(directory, exist_ok=True)
+                        self.made_dirs.add(directory)
+                    with open(path, "wb") as f:
+                        f.write(data)
+            except OSError as e:
+                self.error = e
+            finally:
+                with self.condition:
+                    self.pending -= len(data)
+                    self.condition.notify_all()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self.queue.put(None)
+            self.thread.join()
+
+
+def tune_socket(sock, buffer_size=SOCKET_BUFFER_SIZE):
+    # Must run before connect()/listen() for the kernel to pick a large window scale.
+    for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, option, buffer_size)
+        except OSError:
+            pass
+
+
+def preallocate(f, size):
+    if size and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+        except OSError:
+            pass
+
+
+class OffsetWriter:
+    """Write target that lands sequential writes at a fixed file position, for parallel ranges."""
+
+    seek_lock = threading.Lock()
+
+    def __init__(self, fd, offset):
+        self.fd = fd
+        self.offset = offset
+        self.written = 0
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            position = self.offset + self.written
+            if hasattr(os, "pwrite"):
+                n = os.pwrite(self.fd, view, position)
+            else:
+                with self.seek_lock:
+                    os.lseek(self.fd, position, os.SEEK_SET)
+                    n = os.write(self.fd, view)
+            self.written += n
+            view = view[n:]
+        return len(data)
+
+
+def split_ranges(start, end, count):
+    """Split [start, end) into at most count (offset, length) ranges of near-equal size."""
+    total = end - start
+    count = max(1, min(count, total))
+    step, extra = divmod(total, count)
+    ranges = []
+    for i in range(count):
+        length = step + (1 if i < extra else 0)
+        ranges.append((start, length))
+        start += length
+    return ranges
+
+
+def recv_into_exact(sock, view):
+    size = len(view)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if not n:
+            raise ConnectionError(f"Connection closed after {received} of {size} bytes")
+        received += n
+    return view
+
+
+def recv_exact(sock, size):
+    buffer = bytearray(size)
+    recv_into_exact(sock, memoryview(buffer))
+    return bytes(buffer)
+
+
+def recv_file(sock, f, size, chunk_size=CHUNK_SIZE, view=None, progress=None):
+    """Write exactly size bytes from sock into f through one reusable buffer.
+
+    progress, if given, has add(count) called as bytes arrive; it may raise to abandon the transfer.
+    """
+    if view is None:
+        view = memoryview(bytearray(chunk_size))
+    chunk_size = len(view)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[:min(chunk_size, size - received)])
+        if not n:
+            raise ConnectionError(f"Connection closed after {received} of {size} bytes")
+        f.write(view[:n])
+        received += n
+        if progress is not None:
+            progress.add(n)
+    return received
+
+
+def send_compressed(conn, f, size, codec, pool=None, max_pending=8, block_size=BLOCK_SIZE):
+    """Send size bytes of f as independently compressed blocks.
+
+    Blocks are compressed on pool (zlib, lzma and zstd all release the GIL) while
+    earlier ones are written to the socket, with at most max_pending in flight.
+    """
+    pending = deque()
+    remaining = size
+    sent = 0
+    while remaining or pending:
+        while remaining and len(pending) < max_pending:
+            data = f.read(min(block_size, remaining))
+            if not data:
+                raise ConnectionError("File shrank while it was being sent")
+            remaining -= len(data)
+            if pool is None:
+                pending.append(compress_block(codec, data))
+            else:
+                pending.append(pool.submit(compress_block, codec, data))
+        block = pending.popleft()
+        if pool is not None:
+            block = block.result()
+        conn.sendall(block)
+        sent += len(block)
+    return sent
+
+
+def recv_compressed(sock, f, size, codec, view=None, progress=None):
+    if view is None:
+        view = memoryview(bytearray(BLOCK_SIZE))
+    written = 0
+    while written < size:
+        raw_length, wire_length = BLOCK_HEADER.unpack(recv_exact(sock, BLOCK_HEADER.size))
+        if raw_length > min(size - written, MAX_BLOCK_SIZE) or wire_length > raw_length:
+            raise ValueError(f"Compressed block of {raw_length} bytes ({wire_length} sent) does not fit the reply")
+        if wire_length > len(view):
+            view = memoryview(bytearray(wire_length))
+        data = recv_into_exact(sock, view[:wire_length])
+        if wire_length != raw_length:
+            data = codec.decompress(data, raw_length)
+        if len(data) != raw_length:
+            raise ValueError("Compressed block does not match its declared length")
+        f.write(data)
+        written += raw_length
+        if progress is not None:
+            progress.add(raw_length)
+    return written
+
+
+def send_body(conn, f, size, codec=None, pool=None):
+    if codec is not None:
+        return send_compressed(conn, f, size, codec, pool)
+    sent = send_file(conn, f, offset=f.tell(), count=size)
+    if sent != size:
+        raise ConnectionError("File shrank while it was being sent")
+    return sent
+
+
+def recv_body(sock, f, size, codec=None, view=None, progress=None):
+    if codec is not None:
+        return recv_compressed(sock, f, size, codec, view, progress)
+    return recv_file(sock, f, size, view=view, progress=progress)
+
+
+def folder_size(folder_path):
+    total = 0
+    for root, _, files in os.walk(folder_path):
+        for file in files:
+            try:
+                total += os.path.getsize(os.path.join(root, file))
+            except OSError:
+                pass
+    return total
+
+
+def send_entry_header(conn, kind, rel_path, size, codec=None):
+    path = rel_path.encode()
+    conn.sendall(ENTRY_HEADER.pack(kind, codec.id if codec else 0, len(path), size) + path)
+
+
+def send_entry_hash(conn, content_hash):
+    if content_hash:
+        conn.sendall(ENTRY_HEADER.pack(ENTRY_HASH, 0, DIGEST_SIZE, 0) + bytes.fromhex(content_hash))
+
+
+def send_folder(conn, folder_path, codec=None, pool=None, hashes=None):
+    """Stream every directory and file under folder_path as framed entries.
+
+    With a negotiated codec each file is sampled and only compressed if it shrinks.
+    hashes, if given, maps a file's path in the stream to its content hash (or
+    None if unknown), which is sent after the file for the receiver to check.
+    """
+    conn = CoalescingWriter(conn)
+    for root, dirs, files in os.walk(folder_path):
+        rel_root = os.path.relpath(root, folder_path)
+        for d in dirs:
+            rel_path = os.path.normpath(os.path.join(rel_root, d)).replace(os.sep, "/")
+            send_entry_header(conn, ENTRY_DIR, rel_path, 0)
+        for file in files:
+            rel_path = os.path.normpath(os.path.join(rel_root, file)).replace(os.sep, "/")
+            try:
+                f = open(os.path.join(root, file), "rb")
+            except OSError:
+                continue
+            with f:
+                size = os.fstat(f.fileno()).st_size
+                file_codec = choose_codec(rel_path, f, size, codec)
+                send_entry_header(conn, ENTRY_FILE, rel_path, size, file_codec)
+                send_body(conn, f, size, file_codec, pool)
+            if hashes is not None:
+                send_entry_hash(conn, hashes(rel_path))
+    conn.sendall(ENTRY_HEADER.pack(ENTRY_END, 0, 0, 0))
+    conn.flush()
+
+
+def send_batch(conn, base_path, item_names, codec=None, pool=None, hashes=None):
+    """Stream the named files under base_path as framed entries, small files coalesced into large writes.
+
+    Names that cannot be opened are sent as ENTRY_MISSING so the receiver can
+    report them. hashes works as for send_folder.
+    """
+    conn = CoalescingWriter(conn)
+    for rel_path in item_names:
+        try:
+            f = open(safe_join(base_path, rel_path), "rb")
+        except (OSError, ValueError):
+            send_entry_header(conn, ENTRY_MISSING, rel_path, 0)
+            continue
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            file_codec = choose_codec(rel_path, f, size, codec)
+            send_entry_header(conn, ENTRY_FILE, rel_path, size, file_codec)
+            send_body(conn, f, size, file_codec, pool)
+        if hashes is not None:
+            send_entry_hash(conn, hashes(rel_path))
+    conn.sendall(ENTRY_HEADER.pack(ENTRY_END, 0, 0, 0))
+    conn.flush()
+
+
+def codec_from_id(codec_id):
+    if not codec_id:
+        return None
+    if codec_id not in CODECS_BY_ID:
+        raise ValueError(f"Peer used an unsupported codec (id {codec_id})")
+    return CODECS_BY_ID[codec_id]
+
+
+def safe_join(base, rel_path):
+    parts = rel_path.split("/")
+    unsafe = any(part in ("", ".", "..") for part in parts)
+    if os.name == "nt":
+        unsafe = unsafe or "\\" in rel_path or ":" in rel_path
+    if unsafe:
+        raise ValueError(f"Refusing unsafe path in folder stream: {rel_path!r}")
+    return os.path.join(base, *parts)
+
+
+def recv_folder(sock, dest_path, chunk_size=CHUNK_SIZE, progress=None, verify=False):
+    """Recreate a stream written by send_folder under dest_path; returns (bytes received, corrupt paths).
+
+    With verify each file is hashed as it is written and checked against the
+    ENTRY_HASH that follows it; the sender must have been asked for hashes.
+    """
+    view = memoryview(bytearray(chunk_size))
+    os.makedirs(dest_path, exist_ok=True)
+    received = 0
+    corrupt = []
+    last = None
+    while True:
+        kind, codec_id, path_length, size = ENTRY_HEADER.unpack(recv_exact(sock, ENTRY_HEADER.size))
+        if kind == ENTRY_END:
+            return received, corrupt
+        if kind == ENTRY_HASH:
+            check_entry_hash(recv_exact(sock, path_length), last, corrupt)
+            continue
+        rel_path = recv_exact(sock, path_length).decode()
+        target = safe_join(dest_path, rel_path)
+        if kind == ENTRY_DIR:
+            os.makedirs(target, exist_ok=True)
+        elif kind == ENTRY_FILE:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, "wb") as f:
+                preallocate(f, size)
+                if verify:
+                    last = (rel_path, recv_hashed(sock, f, size, codec_from_id(codec_id), view, progress))
+                else:
+                    recv_body(sock, f, size, codec_from_id(codec_id), view, progress)
+                received += size
+        else:
+            raise ValueError(f"Unknown folder stream entry type {kind}")
+
+
+def recv_hashed(sock, f, size, codec=None, view=None, progress=None):
+    """recv_body that also returns the content hash of what it wrote, computed while receiving."""
+    verifier = ChunkVerifier(size, background=size > SMALL_FILE_SIZE)
+    try:
+        recv_body(sock, VerifyingWriter(f, verifier), size, codec, view, progress)
+    finally:
+        verifier.close()
+    return verifier.content_hash()
+
+
+def check_entry_hash(digest, last, corrupt):
+    if last is not None and last[1] is not None and last[1] != digest.hex():
+        corrupt.append(last[0])
+
+
+def recv_batch(sock, dest_path, chunk_size=CHUNK_SIZE, progress=None, verify=False):
+    """Save a stream written by send_batch under dest_path; returns (bytes received, missing names, corrupt names).
+
+    Small files are read whole and handed to a writer thread; larger ones are
+    written straight from the socket. verify works as for recv_folder.
+    """
+    view = memoryview(bytearray(chunk_size))
+    received = 0
+    missing = []
+    corrupt = []
+    last = None
+    with FileWriter() as writer:
+        while True:
+            kind, codec_id, path_length, size = ENTRY_HEADER.unpack(recv_exact(sock, ENTRY_HEADER.size))
+            if kind == ENTRY_END:
+                return received, missing, corrupt
+            if kind == ENTRY_HASH:
+                check_entry_hash(recv_exact(sock, path_length), last, corrupt)
+                continue
+            rel_path = recv_exact(sock, path_length).decode()
+            if kind == ENTRY_MISSING:
+                missing.append(rel_path)
+                continue
+            if kind != ENTRY_FILE:
+                raise ValueError(f"Unknown batch stream entry type {kind}")
+            target = safe_join(dest_path, rel_path)
+            codec = codec_from_id(codec_id)
+            if size <= SMALL_FILE_SIZE:
+                if codec is None:
+                    data = recv_into_exact(sock, memoryview(bytearray(size)))
+                else:
+                    data = BytesIO()
+                    recv_compressed(sock, data, size, codec)
+                    data = data.getvalue()
+                if verify:
+                    last = (rel_path, data_hash(data))
+                writer.write(target, data)
+                if progress is not None:
+                    progress.add(size)
+            else:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                with open(target, "wb") as f:
+                    preallocate(f, size)
+                    if verify:
+                        last = (rel_path, recv_hashed(sock, f, size, codec, view, progress))
+                    else:
+                        recv_body(sock, f, size, codec, view, progress)
+            received += size
+
+
+def copy_file(src, dst, progress=None, chunk_size=CHUNK_SIZE):
+    """Copy src to dst with its metadata, in chunks that progress can follow and cancel.
+
+    A copy that fails or is cancelled part way is removed rather than left half written.
+    """
+    view = memoryview(bytearray(chunk_size))
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            while True:
+                n = fsrc.readinto(view)
+                if not n:
+                    break
+                fdst.write(view[:n])
+                if progress is not None:
+                    progress.add(n)
+    except BaseException:
+        try:
+            os.remove(dst)
+        except OSError:
+            pass
+        raise
+    shutil.copystat(src, dst)
+
+
+def read_partial(part_path):
+    """Return (bytes already downloaded, server validator) for an interrupted download."""
+    try:
+        offset = os.path.getsize(part_path)
+        with open(part_path + ".tag") as f:
+            return offset, f.read().strip()
+    except OSError:
+        return 0, None
+
+
+def write_partial_tag(part_path, tag):
+    with open(part_path + ".tag", "w") as f:
+        f.write(tag)
+
+
+def remove_partial_tag(part_path):
+    try:
+        os.remove(part_path + ".tag")
+    except OSError:
+        pass
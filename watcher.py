@@ -0,0 +1,203 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+from file_index import is_internal, walk_share
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# IN_MODIFY is left out on purpose: a large copy fires it for every write, while
+# IN_CLOSE_WRITE arrives once when the file is complete.
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class Debouncer:
+    """Collects changed paths and hands them to callback in batches.
+
+    A batch is flushed once no event has arrived for `quiet` seconds, or after
+    `max_delay` seconds so a continuous stream (copying 10k files) still shows
+    progress. A None path means "rescan everything".
+    """
+
+    def __init__(self, callback, quiet=0.5, max_delay=3.0):
+        self.callback = callback
+        self.quiet = quiet
+        self.max_delay = max_delay
+        self.paths = set()
+        self.full_rescan = False
+        self.first_event = None
+        self.last_event = None
+        self.condition = threading.Condition()
+        self.stopped = False
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def add(self, path):
+        with self.condition:
+            if path is None:
+                self.full_rescan = True
+            else:
+                self.paths.add(path)
+            now = time.monotonic()
+            self.first_event = self.first_event or now
+            self.last_event = now
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopped and self.first_event is None:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                now = time.monotonic()
+                due = min(self.last_event + self.quiet, self.first_event + self.max_delay)
+                if now < due:
+                    self.condition.wait(due - now)
+                    continue
+                paths = None if self.full_rescan else self.paths
+                self.paths = set()
+                self.full_rescan = False
+                self.first_event = self.last_event = None
+            try:
+                self.callback(paths)
+            except Exception as e:
+                logging.error(f"Error handling shared directory changes: {str(e)}")
+
+
+class InotifyWatcher:
+    def __init__(self, root, debouncer):
+        self.root = root
+        self.debouncer = debouncer
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+        self.stop_event = threading.Event()
+        self.add_tree("")
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def add_watch(self, rel_path):
+        full_path = os.path.join(self.root, *rel_path.split("/")) if rel_path else self.root
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(full_path), WATCH_MASK)
+        if wd < 0:
+            logging.debug(f"Cannot watch {full_path}: {os.strerror(ctypes.get_errno())}")
+            return
+        self.watches[wd] = rel_path
+
+    def add_tree(self, rel_path):
+        self.add_watch(rel_path)
+        for path, is_dir, _, _ in walk_share(self.root, rel_path):
+            if is_dir and path != rel_path:
+                self.add_watch(path)
+
+    def remove_tree(self, rel_path):
+        for wd, path in list(self.watches.items()):
+            if path == rel_path or path.startswith(rel_path + "/"):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def stop(self):
+        self.stop_event.set()
+        self.debouncer.stop()
+
+    def run(self):
+        try:
+            while not self.stop_event.is_set():
+                ready, _, _ = select.select([self.fd], [], [], 1.0)
+                if ready:
+                    self.handle(os.read(self.fd, 256 * 1024))
+        except Exception as e:
+            logging.error(f"inotify watcher stopped: {str(e)}")
+        finally:
+            os.close(self.fd)
+
+    def handle(self, data):
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + name_length].split(b"\0", 1)[0].decode(errors="surrogateescape")
+            offset += name_length
+            if mask & IN_Q_OVERFLOW:
+                self.debouncer.add(None)
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            parent = self.watches.get(wd)
+            if parent is None or is_internal(name):
+                continue
+            rel_path = f"{parent}/{name}" if parent and name else (name or parent)
+            if mask & IN_ISDIR and mask & IN_MOVED_FROM:
+                self.remove_tree(rel_path)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_tree(rel_path)
+            if rel_path:
+                self.debouncer.add(rel_path)
+
+
+class PollingWatcher:
+    """Fallback for platforms without inotify: diff (size, mtime) snapshots of the tree."""
+
+    def __init__(self, root, debouncer, interval=2.0):
+        self.root = root
+        self.debouncer = debouncer
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.snapshot = self.take_snapshot()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def take_snapshot(self):
+        return {path: (is_dir, size, mtime_ns) for path, is_dir, size, mtime_ns in walk_share(self.root)}
+
+    def stop(self):
+        self.stop_event.set()
+        self.debouncer.stop()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            snapshot = self.take_snapshot()
+            for path in snapshot.keys() | self.snapshot.keys():
+                old, new = self.snapshot.get(path), snapshot.get(path)
+                # Folder mtimes move whenever their contents do; the children report themselves.
+                if old != new and not (old and new and old[0] and new[0]):
+                    self.debouncer.add(path)
+            self.snapshot = snapshot
+
+
+def start_watcher(root, callback, quiet=0.5, max_delay=3.0, poll_interval=2.0):
+    """Watch root and call callback(paths) with debounced batches of changed relative paths."""
+    debouncer = Debouncer(callback, quiet, max_delay)
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(root, debouncer)
+        except (OSError, AttributeError) as e:
+            logging.warning(f"inotify unavailable, falling back to polling: {str(e)}")
+    return PollingWatcher(root, debouncer, poll_interval)